@@ -8,15 +8,14 @@ The meta data inputs are a plate map, a cell set definition file, a plate tracki
 import os
 import sys
 import ast
-import json
 import yaml
 import logging
 import argparse
 import traceback
+import concurrent.futures
 
 
 
-import requests
 import configparser
 from urllib.request import urlopen
 
@@ -26,7 +25,12 @@ import utils.path_utils as path_utils
 
 import davepool_data as davepool_data
 import prism_metadata as prism_metadata
+import parse_data as parse_data
 import assemble_core as assemble_core
+import plate_geometry as plate_geometry
+import clue_api_client as clue_api_client
+import metadata_bundle as metadata_bundle
+import fingerprint as fingerprint
 
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
@@ -40,9 +44,15 @@ prismcell_row_metadata_fields = ['ccle_name', 'davepool_id', 'analyte_id', 'barc
 
 API_URL = 'https://api.clue.io/api/'
 DEV_API_URL = 'https://dev-api.clue.io/api/'
+
 API_KEY = os.environ['API_KEY']
 default_config_filepath = "https://s3.amazonaws.com/analysis.clue.io/vdb/merino/prism_pipeline.cfg"
 
+#result of assemble_plate
+plate_assembled = "assembled"
+plate_skipped = "skipped"
+plate_failed = "failed"
+
 def build_parser():
 
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -50,7 +60,7 @@ def build_parser():
     # frequently between cohorts, replicates, etc.
     parser.add_argument("-config_filepath", "-cfg", help="path to the location of the configuration file", type=str,
                         default=default_config_filepath)
-    parser.add_argument("-csv_filepath", "-csv", help="full path to csv", type=str,  required=True)
+    parser.add_argument("-csv_filepath", "-csv", help="full path to csv", type=str,  required=False)
     parser.add_argument("-assay_type", "-at", help="assay data was profiled in",
                         type=str, required=False)
     parser.add_argument("-beadset", "-bs", help="Bead set used in detection",
@@ -71,6 +81,34 @@ def build_parser():
                         type=str, default=None, required=False)
     parser.add_argument("-outfile", "-out", help="location to write gct", type=str,
                         default='')
+
+    # Batch mode - assemble many plates in one process, sharing the metadata lookups between plates
+    parser.add_argument("-csv_filepaths", "-csvs", help="full paths to csvs of multiple plates to assemble in batch mode",
+                        type=str, nargs="+", default=None, required=False)
+    parser.add_argument("-plates", help="comma separated list of plates (PLATES) to assemble in batch mode, csvs are "
+                        "read from {project_dir}/lxb/{plate}/{plate}.jcsv", type=str, default=None, required=False)
+    parser.add_argument("-project_dir", "-pdir", help="project directory used to find the csvs of -plates, also the "
+                        "default output location in batch mode", type=str, default=None, required=False)
+    parser.add_argument("-n_workers", "-nw", help="number of processes used in batch mode, default is the number of cpus",
+                        type=int, default=None, required=False)
+
+    # clue API cache - defaults come from the CLUE_API_CACHE_DIR, CLUE_API_CACHE_TTL and CLUE_API_OFFLINE environment variables
+    parser.add_argument("-api_cache_dir", help="directory of the on-disk cache of clue API responses",
+                        type=str, default=None, required=False)
+    parser.add_argument("-api_cache_ttl", help="seconds a cached clue API response is used before it is revalidated, "
+                        "0 (the default) revalidates every response",
+                        type=float, default=None, required=False)
+    parser.add_argument("-metadata_bundle", "-mb", help="metadata bundle written by metadata_bundle.py, used in place of "
+                        "the API for beadset, plate map and cell set lookups", type=str, default=None, required=False)
+    parser.add_argument("-offline", help="only use cached clue API responses, never call the API",
+                        action="store_true", default=None)
+    parser.add_argument("-output_format", "-of", help="gct writes MEDIAN and COUNT gcts plus inst_info, gctx writes one "
+                        "container per plate holding both matrices and the shared metadata", type=str,
+                        choices=["gct", "gctx"], default="gct")
+    parser.add_argument("-extra_datatypes", "-edt", help="comma separated DataType sections of the csv to output in "
+                        "addition to Median and Count, e.g. \"Net MFI,Trimmed Mean\"", type=str, default=None, required=False)
+    parser.add_argument("-force", help="assemble plates even when their input fingerprint matches the previous run",
+                        action="store_true", default=False)
     parser.add_argument("-truncate_to_plate_map", "-trunc", help="True or false, if true truncate data to fit framework of platemap provided",
                         action="store_true", default=True)
 
@@ -81,9 +119,14 @@ def write_args_to_file(args, outfile):
         print(vars(args))
         yaml.dump(vars(args), f)
 
-def read_csv(csv_filepath, assay_type):
+def parse_extra_datatypes(extra_datatypes):
+    if extra_datatypes is None:
+        return []
+    return [dn.strip() for dn in extra_datatypes.split(",") if dn.strip()]
+
+def read_csv(csv_filepath, assay_type, extra_datatype_names=()):
 
-    pd = davepool_data.read_data(csv_filepath)
+    pd = davepool_data.read_data(csv_filepath, extra_datatype_names=extra_datatype_names)
     pd.davepool_id = assay_type
     return pd
 
@@ -110,112 +153,276 @@ This was the case for PPCN. As such, we need a function to truncate the data to
 :return:
 '''
 def truncate_data_objects_to_plate_map(davepool_data_objects, all_perturbagens, truncate_to_platemap):
-    platemap_well_list = set([p.pert_well for p in all_perturbagens])
+    platemap_well_list = [p.pert_well for p in all_perturbagens]
     for davepool in davepool_data_objects:
-        if platemap_well_list == set(davepool.median_data.keys()):
-            return davepool_data_objects
+        # compare integer well indexes rather than sets of well names
+        if (plate_geometry.isin_wells(davepool.well_list, platemap_well_list).all() and
+                plate_geometry.isin_wells(platemap_well_list, davepool.well_list).all()):
+            continue
         elif truncate_to_platemap == True:
-            for d in list(davepool_data_objects[0].median_data):
-                 if d not in platemap_well_list:
-                     del davepool_data_objects[0].median_data[d]
-
-            for c in list(davepool_data_objects[0].count_data):
-                if c not in platemap_well_list:
-                    del davepool_data_objects[0].count_data[c]
-
+            davepool.subset_wells(platemap_well_list)
         else:
             msg = "Assemble truncate data objects to plate map: Well lists of platemap and csv do not match"
             raise assemble_exception.DataMappingMismatch(msg)
 
     return davepool_data_objects
 
-def main(args, all_perturbagens=None, assay_plates=None):
-
-    prism_replicate_name = os.path.basename(args.csv_filepath).rsplit(".", 1)[0]
+def parse_prism_replicate_name(csv_filepath):
+    prism_replicate_name = os.path.basename(csv_filepath).rsplit(".", 1)[0]
     (_, assay, tp, replicate_number, bead) = prism_replicate_name.rsplit("_")
+    return (prism_replicate_name, tp, bead)
 
-    if args.beadset:
-        beadset = args.beadset
-    else:
-        beadset = bead
-
-
-    if beadset is not None and args.assay_type is None:
-        api_call = os.path.join('https://api.clue.io/api', 'beadset', beadset)
-        db_entry = requests.get(api_call)
-        args.assay_type = json.loads(db_entry.text)['assay_variant']
+def resolve_assay_type(assay_type, beadset, api_url=API_URL, bundle=None):
+    if beadset is not None and assay_type is None:
+        if bundle is not None:
+            assay_type = bundle.get_assay_type(beadset)
+        else:
+            assay_type = prism_metadata.get_assay_type_from_db(beadset, api_url)
 
-    if args.assay_type == None:
+    if assay_type == None:
         msg = "No assay type found from beadset - must be specified in arg -assay_type"
         raise assemble_exception.NoAssayTypeFound(msg)
 
+    return assay_type
 
-    davepool_id_csv_list = args.csv_filepath
-    davepool_data_objects = [read_csv(davepool_id_csv_list, args.assay_type)]
-
-    # Set up output directory
-    if not os.path.exists(os.path.join(args.outfile, "assemble", prism_replicate_name)):
-        os.makedirs(os.path.join(args.outfile, "assemble", prism_replicate_name))
-
-    # Write args used to yaml file
-    write_args_to_file(args, os.path.join(args.outfile, "assemble", prism_replicate_name, 'config.yaml'))
-
-    #Select API TODO: move to config file
-    api_url = DEV_API_URL if args.dev else API_URL
-
-    if args.map_src_plate is not None:
+def build_perturbagens(args, tp, api_url, bundle=None):
+    if args.map_src_plate is not None and bundle is not None:
+        all_perturbagens = bundle.build_perturbagens(args.map_src_plate, tp)
+    elif args.map_src_plate is not None:
         all_perturbagens = prism_metadata.build_perturbagens_from_db(args.map_src_plate, tp, api_url=api_url) # Read from DB
     elif args.plate_map_path is not None:
         all_perturbagens = prism_metadata.build_perturbagens_from_file(args.plate_map_path, tp)
     else:
         raise ValueError("One of -plate_map_path or -map_src_plate is required")
 
-    for pert in all_perturbagens:
-        pert.validate_properties(pert_column_metadata_fields)
+    parse_data.validate_columns(all_perturbagens, pert_column_metadata_fields)
 
-    #read actual data from relevant csv files, associate it with davepool ID
-    prism_cell_list = prism_metadata.build_prism_cell_list_from_db(args.assay_type, beadset, api_url=api_url)
+    return all_perturbagens
+
+def build_prism_cell_list(assay_type, beadset, api_url, bundle=None):
+    if bundle is not None:
+        prism_cell_list = bundle.build_prism_cell_list(assay_type, beadset)
+    else:
+        prism_cell_list = prism_metadata.build_prism_cell_list_from_db(assay_type, beadset, api_url=api_url)
 
     # check if any analytes are duplicated and if so raise an exception
     check_for_duplicate_analytes(prism_cell_list)
 
-    #prism_cell_list = prism_metadata.build_prism_cell_list(cp, cell_set_file)
-
     logger.info("len(prism_cell_list):  {}".format(len(prism_cell_list)))
 
     #expected_prism_cell_metadata_fields = prismcell_row_metadata_fields
-    for cell in prism_cell_list:
-        cell.validate_properties(prismcell_row_metadata_fields)
+    parse_data.validate_columns(prism_cell_list, prismcell_row_metadata_fields)
+
+    return prism_cell_list
+
+def read_metadata_bundle(args):
+    if args.metadata_bundle is None:
+        return None
 
-    # truncate csv to plate map size if indicated by args.truncate_to_plate_map
-    truncate_data_objects_to_plate_map(davepool_data_objects, all_perturbagens, args.truncate_to_plate_map)
+    bundle = metadata_bundle.read_bundle(args.metadata_bundle)
+    logger.info("using metadata bundle {} in place of the API:  {}".format(args.metadata_bundle, bundle))
+    return bundle
 
+def write_failure(outfile, prism_replicate_name, exc_info):
+    failure_path = os.path.join(outfile, "assemble", prism_replicate_name,  "failure.txt")
+    ex_type, ex, tb = exc_info
+    print("plate {} failed for reason: {}: {}".format(prism_replicate_name, ex_type, ex))
+    traceback.print_tb(tb)
+    with open(failure_path, "w") as file:
+        file.write("plate {} failed for reason: {}: {}\n".format(prism_replicate_name, ex_type, ex))
+        file.write("\ntraceback:\n")
+        traceback.print_tb(tb, file=file)
+
+def setup_output_dir(args, prism_replicate_name):
+    # Set up output directory
+    if not os.path.exists(os.path.join(args.outfile, "assemble", prism_replicate_name)):
+        os.makedirs(os.path.join(args.outfile, "assemble", prism_replicate_name))
+
+    # Write args used to yaml file
+    write_args_to_file(args, os.path.join(args.outfile, "assemble", prism_replicate_name, 'config.yaml'))
+
+def assemble_plate(args, prism_replicate_name, all_perturbagens, prism_cell_list):
+    '''
+    assemble a single plate from already resolved metadata, writing success.txt or failure.txt next to the outputs.
+    Plates whose input fingerprint matches the one stored by a previous successful run are skipped unless args.force
+    :param args: arguments for this plate, args.outfile is the output directory of the plate
+    :param prism_replicate_name:
+    :param all_perturbagens:
+    :param prism_cell_list:
+    :return: one of plate_assembled, plate_skipped, plate_failed
+    '''
     # Pass python objects to the core assembly module (this is where command line and automated assembly intersect)
     # here the outfile for automation is defined as project_dir/prism_replicate_set_name
     try:
-        assemble_core.main(prism_replicate_name, args.outfile, all_perturbagens, davepool_data_objects, prism_cell_list, verbose=args.verbose)
-
-    except Exception as e:
-        failure_path = os.path.join(args.outfile, "assemble", prism_replicate_name,  "failure.txt")
-        ex_type, ex, tb = sys.exc_info()
-        print("plate {} failed for reason: {}: {}".format(prism_replicate_name, ex_type, ex))
-        traceback.print_tb(tb)
-        with open(failure_path, "w") as file:
-            file.write("plate {} failed for reason: {}: {}\n".format(prism_replicate_name, ex_type, ex))
-            file.write("\ntraceback:\n")
-            traceback.print_tb(tb, file=file)
-        sys.exit(-1)
+        extra_datatype_names = parse_extra_datatypes(getattr(args, "extra_datatypes", None))
+
+        plate_fingerprint = fingerprint.compute_fingerprint(args.csv_filepath, all_perturbagens, prism_cell_list, args)
+        output_suffixes = assemble_core.output_suffixes(args.output_format, extra_datatype_names)
+        if not getattr(args, "force", False) and fingerprint.is_up_to_date(
+                args.outfile, prism_replicate_name, plate_fingerprint, output_suffixes):
+            logger.info("inputs of {} are unchanged since the last run, skipping - fingerprint:  {}".format(
+                prism_replicate_name, plate_fingerprint))
+            return plate_skipped
+
+        fingerprint.remove_fingerprint(args.outfile, prism_replicate_name)
+
+        davepool_data_objects = [read_csv(args.csv_filepath, args.assay_type, extra_datatype_names)]
+
+        # truncate csv to plate map size if indicated by args.truncate_to_plate_map
+        truncate_data_objects_to_plate_map(davepool_data_objects, all_perturbagens, args.truncate_to_plate_map)
+
+        assemble_core.main(prism_replicate_name, args.outfile, all_perturbagens, davepool_data_objects, prism_cell_list,
+                           verbose=args.verbose, output_format=args.output_format)
+
+    except (Exception, SystemExit) as e:
+        write_failure(args.outfile, prism_replicate_name, sys.exc_info())
+        return plate_failed
 
     success_path = os.path.join(args.outfile, "assemble", prism_replicate_name, "success.txt")
     with open(success_path, "w") as file:
         file.write("plate {} successfully assembled".format(prism_replicate_name))
 
+    fingerprint.write_fingerprint(args.outfile, prism_replicate_name, plate_fingerprint)
+
+    return plate_assembled
+
+def main(args, all_perturbagens=None, assay_plates=None):
+
+    (prism_replicate_name, tp, bead) = parse_prism_replicate_name(args.csv_filepath)
+
+    if args.beadset:
+        beadset = args.beadset
+    else:
+        beadset = bead
+
+    bundle = read_metadata_bundle(args)
+
+    #Select API TODO: move to config file
+    api_url = DEV_API_URL if args.dev else API_URL
+
+    args.assay_type = resolve_assay_type(args.assay_type, beadset, api_url=api_url, bundle=bundle)
+
+    setup_output_dir(args, prism_replicate_name)
+
+    all_perturbagens = build_perturbagens(args, tp, api_url, bundle=bundle)
+
+    #read actual data from relevant csv files, associate it with davepool ID
+    prism_cell_list = build_prism_cell_list(args.assay_type, beadset, api_url, bundle=bundle)
+
+    logger.info("clue api cache stats:  {}".format(clue_api_client.get_client().stats))
+
+    if assemble_plate(args, prism_replicate_name, all_perturbagens, prism_cell_list) == plate_failed:
+        sys.exit(-1)
+
+def _assemble_plate_task(task):
+    (plate_args, prism_replicate_name, all_perturbagens, prism_cell_list) = task
+    setup_logger.setup(verbose=plate_args.verbose)
+    return (prism_replicate_name, assemble_plate(plate_args, prism_replicate_name, all_perturbagens, prism_cell_list))
+
+def build_batch_csv_filepaths(args):
+    if args.csv_filepaths:
+        return list(args.csv_filepaths)
+
+    plates = [p.strip() for p in args.plates.split(",") if p.strip()]
+    return [os.path.join(args.project_dir, "lxb", p, p + ".jcsv") for p in plates]
+
+def batch_main(args):
+    '''
+    assemble many plates in one process pool.  The cell set and plate maps are resolved once per distinct
+    (assay_type, beadset) and map_src in the parent process and shared by all plates that use them.  Each plate
+    is written to {outfile}/{pert_plate}_{assay}_{time}/assemble/{plate}, the layout used by batch_assemble.sh
+    :param args:
+    :return: number of plates that failed
+    '''
+    #Select API TODO: move to config file
+    api_url = DEV_API_URL if args.dev else API_URL
+
+    out_root = args.outfile if args.outfile else (args.project_dir or '')
+
+    bundle = read_metadata_bundle(args)
+
+    assay_type_cache = {}
+    perturbagen_cache = {}
+    prism_cell_cache = {}
+
+    csv_filepaths = build_batch_csv_filepaths(args)
+
+    tasks = []
+    failed = []
+    skipped = []
+    for csv_filepath in csv_filepaths:
+        (prism_replicate_name, tp, bead) = parse_prism_replicate_name(csv_filepath)
+
+        plate_args = argparse.Namespace(**vars(args))
+        plate_args.csv_filepath = csv_filepath
+        plate_args.csv_filepaths = None
+        plate_args.plates = None
+        plate_args.outfile = os.path.join(out_root, "_".join(prism_replicate_name.split("_")[:3]))
+        if args.map_src_plate is None and args.plate_map_path is None:
+            plate_args.map_src_plate = prism_metadata.build_map_src_name(prism_replicate_name)
+
+        beadset = args.beadset if args.beadset else bead
+
+        try:
+            if beadset not in assay_type_cache:
+                assay_type_cache[beadset] = resolve_assay_type(args.assay_type, beadset, api_url=api_url, bundle=bundle)
+            plate_args.assay_type = assay_type_cache[beadset]
+
+            setup_output_dir(plate_args, prism_replicate_name)
+
+            map_key = (plate_args.map_src_plate, plate_args.plate_map_path, tp)
+            if map_key not in perturbagen_cache:
+                perturbagen_cache[map_key] = build_perturbagens(plate_args, tp, api_url, bundle=bundle)
+
+            cell_key = (plate_args.assay_type, beadset)
+            if cell_key not in prism_cell_cache:
+                prism_cell_cache[cell_key] = build_prism_cell_list(plate_args.assay_type, beadset, api_url, bundle=bundle)
+
+        except Exception:
+            if not os.path.exists(os.path.join(plate_args.outfile, "assemble", prism_replicate_name)):
+                os.makedirs(os.path.join(plate_args.outfile, "assemble", prism_replicate_name))
+            write_failure(plate_args.outfile, prism_replicate_name, sys.exc_info())
+            failed.append(prism_replicate_name)
+            continue
+
+        tasks.append((plate_args, prism_replicate_name, perturbagen_cache[map_key], prism_cell_cache[cell_key]))
+
+    logger.info("resolved metadata for {} plates - distinct plate maps:  {}  distinct cell sets:  {}".format(
+        len(tasks), len(perturbagen_cache), len(prism_cell_cache)))
+    logger.info("clue api cache stats:  {}".format(clue_api_client.get_client().stats))
+
+    n_workers = args.n_workers if args.n_workers else os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for (prism_replicate_name, status) in executor.map(_assemble_plate_task, tasks):
+            if status == plate_failed:
+                failed.append(prism_replicate_name)
+            elif status == plate_skipped:
+                skipped.append(prism_replicate_name)
+
+    logger.info("rebuilt {} plates, skipped {} unchanged plates, {} failed".format(
+        len(csv_filepaths) - len(failed) - len(skipped), len(skipped), len(failed)))
+    if failed:
+        logger.error("failed plates:  {}".format(",".join(failed)))
+
+    return len(failed)
+
 if __name__ == "__main__":
     args = build_parser().parse_args(sys.argv[1:])
     setup_logger.setup(verbose=args.verbose)
 
     logger.info("args:  {}".format(args))
 
+    clue_api_client.configure(cache_dir=args.api_cache_dir, ttl=args.api_cache_ttl, offline=args.offline,
+                              logger=logger)
+
+    if args.csv_filepaths or args.plates:
+        if args.plates and not args.project_dir:
+            raise ValueError("-project_dir is required with -plates")
+        sys.exit(-1 if batch_main(args) else 0)
+
+    if not args.csv_filepath:
+        raise ValueError("One of -csv_filepath, -csv_filepaths or -plates is required")
+
     if not (args.map_src_plate or args.plate_map_path):
         raise ValueError("One of -plate_map_path or -map_src_plate is required")
 
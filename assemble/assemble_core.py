@@ -3,11 +3,14 @@ import logging
 import os
 import cmapPy.pandasGEXpress.GCToo as GCToo
 import prism_metadata
+import parse_data
+import davepool_data
+import dose_codec
 import pandas
-import pandas as pd
 import cmapPy.pandasGEXpress.write_gct as write_gct
+import cmapPy.pandasGEXpress.write_gctx as write_gctx
+import h5py
 import numpy as np
-from math import floor, log10
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -16,15 +19,28 @@ _remove_col_annotations = ["assay_plate_barcode"]
 
 _null = "-666"
 _NaN = "NaN"
+_count_float_format = "%d"
+
+#-output_format gctx writes one container per plate instead of the two gcts and inst_info
+_container_suffix = "_ASSEMBLE.gctx"
+_container_count_node = "/0/DATA/COUNT/matrix"
+_container_count_null = -666
+#additional DataType sections are stored as float32 at _container_datatype_node.format(davepool_data.datatype_suffix(name))
+_container_datatype_node = "/0/DATA/{}/matrix"
 
 
 class DataByCell:
-    def __init__(self, cell_data_map=None, well_list=None):
-        self.cell_data_map = cell_data_map
+    '''
+    data for a set of cells across a set of wells - data is a matrix of cells x wells, the rows ordered as in
+    cell_list and the columns as in well_list
+    '''
+    def __init__(self, cell_list=None, data=None, well_list=None):
+        self.cell_list = cell_list
+        self.data = data
         self.well_list = well_list
 
     def __str__(self):
-        return "cell_data_map:  {}  well_list:  {}".format(self.cell_data_map, self.well_list)
+        return "cell_list:  {}  data:  {}  well_list:  {}".format(self.cell_list, self.data, self.well_list)
 
 
 def build_davepool_id_to_cells_map(prism_cell_list):
@@ -42,59 +58,62 @@ def build_davepool_id_to_cells_map(prism_cell_list):
     return r
 
 
-def build_data_by_cell(cells, davepool_data_obj):
-    cell_to_median_data_map = {}
-    median_wells = []
-    cell_to_count_data_map = {}
-    count_wells = []
-
-    ld = [(cell_to_median_data_map, median_wells, davepool_data_obj.median_headers, davepool_data_obj.median_data),
-          (cell_to_count_data_map, count_wells, davepool_data_obj.count_headers, davepool_data_obj.count_data)]
-
-    for (cell_data_map, wells, headers, data) in ld:
+def build_cell_header_indexes(cells, headers):
+    '''
+    find the column of headers that holds the data for each cell, using a hash index of the headers
+    :param cells:
+    :param headers: analyte headers of the davepool data, one per column of the data matrix
+    :return: numpy array with the column index for each cell, -1 for cells that are ignored
+    '''
+    header_index = {h:i for (i, h) in enumerate(headers)}
+    columns = parse_data.get_columns(cells, names=["ignore", "analyte_id"])
+
+    r = np.full(len(cells), -1, dtype=np.intp)
+    for (i, (ignore, analyte_id)) in enumerate(zip(columns["ignore"], columns["analyte_id"])):
+        if ignore == False:
+            analyte_id = str(analyte_id).capitalize()
+            if analyte_id not in header_index:
+                raise ValueError("assemble_core build_cell_header_indexes analyte_id not found in headers - analyte_id:  {}".format(
+                    analyte_id))
+            r[i] = header_index[analyte_id]
 
-        cell_header_map = {}
-        for c in cells:
-            if c.ignore == False:
-                analyte_id = str(c.analyte_id).capitalize()
-                
-                cell_header_map[c] = headers.index(analyte_id)
-            cell_data_map[c] = []
+    return r
 
-        for d in data.keys():
-            wells.append(d)
-            for c in cells:
-                if c in cell_header_map:
-                    datum_index = cell_header_map[c]
-                    datum = data[d][datum_index - 1]
-                else:
-                    datum = float('nan')
 
-                cell_data_map[c].append(datum)
+def take_cell_columns(data, column_indexes, null_value=None):
+    '''
+    gather the columns of a wells x analytes matrix for a list of cells in one take
+    :param data: wells x analytes matrix
+    :param column_indexes: column index for each cell, -1 for cells without data
+    :param null_value: value used in data for missing entries, these are converted to NaN
+    :return: float matrix of cells x wells, NaN for cells without data
+    '''
+    taken = np.take(data, column_indexes, axis=1).T
+    r = taken.astype(np.float64)
+    if null_value is not None:
+        r[taken == null_value] = np.nan
+    r[column_indexes < 0] = np.nan
+    return r
 
-    return (DataByCell(cell_to_median_data_map, median_wells), DataByCell(cell_to_count_data_map, count_wells))
 
+def build_data_by_cell(cells, davepool_data_obj):
+    median_indexes = build_cell_header_indexes(cells, davepool_data_obj.median_headers)
+    median_data = take_cell_columns(davepool_data_obj.median_data, median_indexes)
 
-def combine_maps_with_checks(source_map, dest_map):
-    source_keys = set(source_map.keys())
-    dest_keys = set(dest_map.keys())
+    count_indexes = build_cell_header_indexes(cells, davepool_data_obj.count_headers)
+    count_data = take_cell_columns(davepool_data_obj.count_data, count_indexes, null_value=davepool_data.count_null)
 
-    common_keys = source_keys & dest_keys
+    well_list = list(davepool_data_obj.well_list)
 
-    if len(common_keys) > 0:
-        msg = "the source_map and dest_map had common_keys:  {}".format(common_keys)
-        logger.error(msg)
-        raise Exception("assemble combine_maps_with_checks " + msg)
-    else:
-        dest_map.update(source_map)
+    return (DataByCell(list(cells), median_data, well_list), DataByCell(list(cells), count_data, well_list))
 
 
 def process_data(davepool_data_objects, davepool_id_to_cells_map):
     logger.debug("davepool_id_to_cells_map.keys():  {}".format(davepool_id_to_cells_map.keys()))
 
     authoritative_well_list = []
-    all_median_data_by_cell = DataByCell(cell_data_map={})
-    all_count_data_by_cell = DataByCell(cell_data_map={})
+    median_data_by_cell_list = []
+    count_data_by_cell_list = []
     for dd in davepool_data_objects:
         cells = davepool_id_to_cells_map[dd.davepool_id]
         logger.debug("pools:  {}".format(cells))
@@ -106,24 +125,57 @@ def process_data(davepool_data_objects, davepool_id_to_cells_map):
         else:
             assert authoritative_well_list == median_data_by_cell.well_list, (authoritative_well_list,
                                                                               median_data_by_cell.well_list)
-            assert authoritative_well_list == count_data_by_cell.well_list, (authoritative_well_list,
-                                                                             count_data_by_cell.well_list)
 
-        combine_maps_with_checks(median_data_by_cell.cell_data_map, all_median_data_by_cell.cell_data_map)
-        combine_maps_with_checks(count_data_by_cell.cell_data_map, all_count_data_by_cell.cell_data_map)
+        median_data_by_cell_list.append(median_data_by_cell)
+        count_data_by_cell_list.append(count_data_by_cell)
+
+    all_cells = [c for dbc in median_data_by_cell_list for c in dbc.cell_list]
+    if len(set(all_cells)) != len(all_cells):
+        msg = "the same cell was found in more than one davepool"
+        logger.error(msg)
+        raise Exception("assemble process_data " + msg)
 
-    all_median_data_by_cell.well_list = authoritative_well_list
-    all_count_data_by_cell.well_list = authoritative_well_list
+    all_median_data_by_cell = DataByCell(all_cells, np.vstack([dbc.data for dbc in median_data_by_cell_list]),
+                                         authoritative_well_list)
+    all_count_data_by_cell = DataByCell(all_cells, np.vstack([dbc.data for dbc in count_data_by_cell_list]),
+                                        authoritative_well_list)
 
     return (all_median_data_by_cell, all_count_data_by_cell)
 
 
-def build_gctoo(prism_replicate_name, perturbagen_list, data_by_cell):
-    # build column metadata dataframe:
-    def column_ID_builder(perturbagen):
-        return prism_replicate_name + ":" + perturbagen.pert_well
+def process_extra_data(davepool_data_objects, davepool_id_to_cells_map):
+    '''
+    gct-able form of the additional DataType sections read from the csvs, cells are stacked in the same order as in
+    process_data
+    :return: dict of DataType section name to DataByCell
+    '''
+    datatype_names = list(davepool_data_objects[0].extra_data.keys()) if len(davepool_data_objects) > 0 else []
+
+    r = {}
+    for name in datatype_names:
+        data_by_cell_list = []
+        for dd in davepool_data_objects:
+            assert name in dd.extra_data, "DataType {} is missing for davepool_id:  {}".format(name, dd.davepool_id)
+            cells = davepool_id_to_cells_map[dd.davepool_id]
+            indexes = build_cell_header_indexes(cells, dd.extra_headers[name])
+            data_by_cell_list.append(DataByCell(list(cells), take_cell_columns(dd.extra_data[name], indexes),
+                                                list(dd.well_list)))
+
+        r[name] = DataByCell([c for dbc in data_by_cell_list for c in dbc.cell_list],
+                             np.vstack([dbc.data for dbc in data_by_cell_list]), data_by_cell_list[0].well_list)
+
+    return r
+
+
+def build_column_ids(prism_replicate_name, well_list):
+    return [prism_replicate_name + ":" + w for w in well_list]
 
-    col_metadata_df = prism_metadata.convert_objects_to_metadata_df(column_ID_builder, perturbagen_list, None)
+
+def build_col_metadata_df(prism_replicate_name, perturbagen_list):
+    columns = parse_data.get_columns(perturbagen_list)
+    column_ids = build_column_ids(prism_replicate_name, columns.get("pert_well", []))
+
+    col_metadata_df = prism_metadata.convert_columns_to_metadata_df(columns, column_ids, None)
 
     for col_annot in _remove_col_annotations:
         if col_annot in col_metadata_df.columns:
@@ -136,14 +188,13 @@ def build_gctoo(prism_replicate_name, perturbagen_list, data_by_cell):
     logger.info("my_gctoo.col_metadata_df.shape:  {}".format(col_metadata_df.shape))
     logger.debug("my_gctoo.col_metadata_df:  {}".format(col_metadata_df))
 
-    ########################################
+    return col_metadata_df
 
-    # build row metadata dataframe:
-    def row_ID_builder(prism_cell_obj):
-        return prism_cell_obj.feature_id
 
-    row_metadata_df = prism_metadata.convert_objects_to_metadata_df(row_ID_builder,
-                                                                    data_by_cell.cell_data_map.keys(), {})
+def build_row_metadata_df(cell_list):
+    columns = parse_data.get_columns(cell_list)
+
+    row_metadata_df = prism_metadata.convert_columns_to_metadata_df(columns, columns.get("feature_id", []), {})
 
     for row_annot in _remove_row_annotations:
         if row_annot in row_metadata_df.columns:
@@ -152,43 +203,45 @@ def build_gctoo(prism_replicate_name, perturbagen_list, data_by_cell):
     row_metadata_df.sort_index(inplace=True)
     logger.info("my_gctoo.row_metadata_df.shape:  {}".format(row_metadata_df.shape))
     logger.debug("my_gctoo.row_metadata_df:  {}".format(row_metadata_df))
-    ########################################
-
-    # build data dataframe - will have the cells as columns and rows as wells, and then transpose
-    # start by building mapping between cell ID and corresponding data for that cell, to populate dataframe columns
-    cell_id_data_map = {}
-    for (c, data) in data_by_cell.cell_data_map.items():
-        id = row_ID_builder(c)
-        cell_id_data_map[id] = data
-    logger.debug("cell_id_data_map:  {}".format(cell_id_data_map))
-
-    # build index for the rows of the dataframe using what is actually the column ID (since it will be transposed)
-    well_perturbagen_map = {}
-    for p in perturbagen_list:
-        well_perturbagen_map[p.pert_well] = p
-    data_df_column_ids = []
-    for w in data_by_cell.well_list:
-        p = well_perturbagen_map[w]
-        data_df_column_ids.append(column_ID_builder(p))
-
-    data_df = build_gctoo_data_df(cell_id_data_map, data_df_column_ids)
-    ########################################
+
+    return row_metadata_df
+
+
+def build_gctoo(prism_replicate_name, col_metadata_df, row_metadata_df, data_by_cell):
+    '''
+    build a gctoo from the data of data_by_cell, sharing the provided column and row metadata - these are built once
+    per plate by build_col_metadata_df and build_row_metadata_df and reused for the MEDIAN and COUNT gcts
+    :param prism_replicate_name:
+    :param col_metadata_df:
+    :param row_metadata_df:
+    :param data_by_cell:
+    :return:
+    '''
+    row_ids = parse_data.get_columns(data_by_cell.cell_list, names=["feature_id"])["feature_id"]
+    column_ids = build_column_ids(prism_replicate_name, data_by_cell.well_list)
+
+    data_df = build_gctoo_data_df(data_by_cell.data, row_ids, column_ids)
+
     my_gctoo = GCToo.GCToo(data_df=data_df, row_metadata_df=row_metadata_df, col_metadata_df=col_metadata_df)
 
     return my_gctoo
 
 
-def build_gctoo_data_df(cell_id_data_map, data_df_column_ids):
+def build_gctoo_data_df(data, row_ids, column_ids):
     '''
-    build the pandas dataframe that will be used for the data_df part of a gctoo object
-    :param cell_id_data_map:
-    :param data_df_column_ids:
+    build the pandas dataframe that will be used for the data_df part of a gctoo object, with the rows and columns
+    sorted by their ids
+    :param data: matrix of rows x columns
+    :param row_ids:
+    :param column_ids:
     :return:
     '''
-    data_df = pandas.DataFrame(cell_id_data_map, index=data_df_column_ids).T
-    data_df.sort_index(axis=0, inplace=True)
-    data_df.sort_index(axis=1, inplace=True)
-    data_df.replace("", value=_NaN, inplace=True)
+    row_order = np.argsort(np.array(row_ids, dtype=object), kind="stable")
+    column_order = np.argsort(np.array(column_ids, dtype=object), kind="stable")
+
+    data_df = pandas.DataFrame(data[np.ix_(row_order, column_order)],
+                               index=pandas.Index(np.array(row_ids, dtype=object)[row_order]),
+                               columns=pandas.Index(np.array(column_ids, dtype=object)[column_order]))
     logger.info("data_df.shape:  {}".format(data_df.shape))
     logger.debug("data_df:  {}".format(data_df))
 
@@ -198,82 +251,61 @@ def build_gctoo_data_df(cell_id_data_map, data_df_column_ids):
 """
 stringify method to write floats as numerical non-scientific notation
 """
-def float_to_str(f):
-    float_string = repr(f)
-    if 'e' in float_string:  # detect scientific notation
-        digits, exp = float_string.split('e')
-        digits = digits.replace('.', '').replace('-', '')
-        exp = int(exp)
-        zero_padding = '0' * (abs(int(exp)) - 1)  # minus 1 for decimal point in the sci notation
-        sign = '-' if f < 0 else ''
-        if exp > 0:
-            float_string = '{}{}{}.0'.format(sign, digits, zero_padding)
-        else:
-            float_string = '{}0.{}{}'.format(sign, zero_padding, digits)
-    return float_string
+def stringify_inst_doses(inst):
+    # cast pert_dose and pert_idose fields to canonical strings, each distinct dose is formatted once
+    inst['pert_dose'] = dose_codec.encode_doses(inst['pert_dose'])
 
+    if 'pert_idose' in inst.columns:
+        inst['pert_idose'] = dose_codec.encode_idoses(inst['pert_idose'])
 
-"""
-rounds to significant figures
-"""
-def _round_sig(x, sig=5):
-    if x == 0:
-        return 0
-    else:
-        return round(x, sig - int(floor(log10(abs(x)))) - 1)
+    return inst
 
 
-"""
-prints string as decimal value not scientific notation
-"""
-def _format_floats(fl, sig=4, max_precision=50):
-    if type(fl) == str:
-        fl = float(fl)
-    if (fl is None) or np.isnan(fl):
-        return np.nan
-    else:
-        return float_to_str(round(_round_sig(fl, sig=sig), max_precision))
-
-
-def process_pert_doses(el):
-    logger.debug("el:  {}".format(el))
-    if pd.isna(el) or (el == 'nan'):
-        return el
-    if type(el) == str:
-        el = el.strip()
-        return '|'.join(map(_format_floats, map(float, el.split('|'))))
-    else:
-        return _format_floats(el)
-
-
-def process_pert_idoses(el):
-    logger.debug("el:  {}".format(el))
-    if pd.isna(el) or (el=='nan') or ~(el):
-        return el
-    if type(el) == str:
-        el = el.strip()
-        idoses = el.split('|')
-        idoses = [i.split(" ") for i in idoses]
-        return "|".join(["{} {}".format(_format_floats(idose[0]), idose[1]) for idose in idoses])
-    else:
-        return _format_floats(el)
+def output_suffixes(output_format, extra_datatype_names=()):
+    '''
+    suffixes of the files written for a plate by main, appended to the prism_replicate_name
+    :param extra_datatype_names: additional DataType sections, written as their own gct unless output_format is gctx
+    '''
+    if output_format == "gctx":
+        return [_container_suffix]
+    return (["_MEDIAN.gct", "_COUNT.gct", "_inst_info.txt"] +
+            ["_{}.gct".format(davepool_data.datatype_suffix(dn)) for dn in extra_datatype_names])
 
-def stringify_inst_doses(inst):
-    # cast pert_dose field to str
-    inst['pert_dose'] = inst['pert_dose'].apply(
-        lambda el: process_pert_doses(el)
-    )
 
-    if 'pert_idose' in inst.columns:
-        inst['pert_idose'] = inst['pert_idose'].apply(
-            lambda el: process_pert_idoses(el)
-        )
+def write_plate_container(median_gctoo, count_gctoo, outfile, extra_gctoos=None):
+    '''
+    write the MEDIAN and COUNT data of a plate to one gctx.  MEDIAN is the float32 matrix of the gctx, so any gctx reader
+    sees the plate as its MEDIAN gct; COUNT is stored as int32 at _container_count_node, in the same orientation, and
+    shares the row and column metadata
+    :param median_gctoo:
+    :param count_gctoo: must have the same rows and columns as median_gctoo
+    :param outfile:
+    :param extra_gctoos: dict of DataType section name to gctoo with the same rows and columns as median_gctoo, each
+    stored as float32 at _container_datatype_node
+    :return:
+    '''
+    extra_gctoos = extra_gctoos if extra_gctoos is not None else {}
+    for (name, g) in [("COUNT", count_gctoo)] + list(extra_gctoos.items()):
+        assert median_gctoo.data_df.index.equals(g.data_df.index), "MEDIAN and {} rows differ".format(name)
+        assert median_gctoo.data_df.columns.equals(g.data_df.columns), "MEDIAN and {} columns differ".format(name)
 
-    inst['pert_dose'] = inst['pert_dose'].astype(str)
-    return inst
+    write_gctx.write(median_gctoo, outfile, matrix_dtype=np.float32)
 
+    counts = count_gctoo.data_df.transpose().values
+    counts = np.where(np.isnan(counts), _container_count_null, counts).astype(np.int32)
+    with h5py.File(outfile, "a") as f:
+        dataset = f.create_dataset(_container_count_node, data=counts, dtype=np.int32)
+        dataset.attrs["null_value"] = _container_count_null
 
-def main(prism_replicate_name, outfile, all_perturbagens, davepool_data_objects, prism_cell_list, verbose=False):
+        for (name, g) in extra_gctoos.items():
+            f.create_dataset(_container_datatype_node.format(davepool_data.datatype_suffix(name)),
+                             data=g.data_df.transpose().values, dtype=np.float32)
+
+    logger.info("plate container has been written to {}".format(outfile))
+
+
+def main(prism_replicate_name, outfile, all_perturbagens, davepool_data_objects, prism_cell_list, verbose=False,
+         output_format="gct"):
     level = (logging.DEBUG if verbose else logging.INFO)
     logging.basicConfig(level=level)
     logger.setLevel(level)
@@ -283,24 +315,35 @@ def main(prism_replicate_name, outfile, all_perturbagens, davepool_data_objects,
 
     # Put all the data in gct-able form
     (all_median_data_by_cell, all_count_data_by_cell) = process_data(davepool_data_objects, davepool_id_to_cells_map)
+    extra_data_by_cell = process_extra_data(davepool_data_objects, davepool_id_to_cells_map)
 
-    # Create full outfile, build the gct, and write it out!
-    median_outfile = os.path.join(outfile, "assemble", prism_replicate_name, prism_replicate_name + "_MEDIAN.gct")
-    median_gctoo = build_gctoo(prism_replicate_name, all_perturbagens, all_median_data_by_cell)
-
+    # Build the metadata shared by the MEDIAN, COUNT and any additional DataType gcts
+    col_metadata_df = build_col_metadata_df(prism_replicate_name, all_perturbagens)
+    row_metadata_df = build_row_metadata_df(all_median_data_by_cell.cell_list)
 
     # enforce doses as strings
     try:
         logger.info("Attempting to convert doses to strings")
-        inst = stringify_inst_doses(median_gctoo.col_metadata_df)
+        inst = stringify_inst_doses(col_metadata_df)
     except TypeError as e:
-        inst = median_gctoo.col_metadata_df
+        inst = col_metadata_df
         logger.warning("Could not stringify doses due to TypeError: {}".format(e))
     except Exception as e:
         logger.error("Could not stringify doses due to ValueError: {}".format(e))
         exit(-1)
-    median_gctoo.col_metadata_df = inst
 
+    median_gctoo = build_gctoo(prism_replicate_name, inst, row_metadata_df, all_median_data_by_cell)
+    count_gctoo = build_gctoo(prism_replicate_name, inst, row_metadata_df, all_count_data_by_cell)
+    extra_gctoos = {name:build_gctoo(prism_replicate_name, inst, row_metadata_df, dbc)
+                    for (name, dbc) in extra_data_by_cell.items()}
+
+    if output_format == "gctx":
+        container_outfile = os.path.join(outfile, "assemble", prism_replicate_name, prism_replicate_name + _container_suffix)
+        write_plate_container(median_gctoo, count_gctoo, container_outfile, extra_gctoos=extra_gctoos)
+        return
+
+    # Create full outfile, build the gct, and write it out!
+    median_outfile = os.path.join(outfile, "assemble", prism_replicate_name, prism_replicate_name + "_MEDIAN.gct")
     write_gct.write(median_gctoo, median_outfile, data_null=_NaN, filler_null=_null)
 
     # Write Inst info file
@@ -309,6 +352,9 @@ def main(prism_replicate_name, outfile, all_perturbagens, davepool_data_objects,
     logger.info("Instinfo has been written to {}".format(instinfo_outfile))
 
     count_outfile = os.path.join(outfile, "assemble", prism_replicate_name, prism_replicate_name + "_COUNT.gct")
-    count_gctoo = build_gctoo(prism_replicate_name, all_perturbagens, all_count_data_by_cell)
-    count_gctoo.col_metadata_df = inst
-    write_gct.write(count_gctoo, count_outfile, data_null=_NaN, filler_null=_null)
+    write_gct.write(count_gctoo, count_outfile, data_null=_NaN, filler_null=_null, data_float_format=_count_float_format)
+
+    for (name, g) in extra_gctoos.items():
+        extra_outfile = os.path.join(outfile, "assemble", prism_replicate_name,
+                                     "{}_{}.gct".format(prism_replicate_name, davepool_data.datatype_suffix(name)))
+        write_gct.write(g, extra_outfile, data_null=_NaN, filler_null=_null)
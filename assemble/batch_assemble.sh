@@ -33,6 +33,28 @@ while test $# -gt 0; do
       shift # past argument
       BEADSET="$1"
       ;;
+    -batch|--batch)
+      BATCH=TRUE
+      ;;
+    -n_workers|--n_workers)
+      shift # past argument
+      N_WORKERS="$1"
+      ;;
+    -metadata_bundle|--metadata_bundle)
+      shift # past argument
+      METADATA_BUNDLE="$1"
+      ;;
+    -output_format|--output_format)
+      shift # past argument
+      OUTPUT_FORMAT="$1"
+      ;;
+    -extra_datatypes|--extra_datatypes)
+      shift # past argument
+      EXTRA_DATATYPES="$1"
+      ;;
+    -force|--force)
+      FORCE=TRUE
+      ;;
     --default)
       DEFAULT=YES
       ;;
@@ -59,6 +81,74 @@ echo PROJECT_CODE = "${PROJECT_CODE}"
 echo REPLICATE_MAP = "${REPLICATE_MAP}"
 echo ASSAY_TYPE = "${ASSAY_TYPE}"
 
+# share cached clue API responses between all plates of the project
+if [[ -z $CLUE_API_CACHE_DIR ]]
+then
+  export CLUE_API_CACHE_DIR="${CONFIG_ROOT}${PROJECT_CODE}/.clue_api_cache"
+fi
+echo CLUE_API_CACHE_DIR = "${CLUE_API_CACHE_DIR}"
+
+if [[ -n $BATCH ]]
+then
+  # assemble every plate of PLATES in this container, sharing the metadata lookups
+  args=(
+    -plates "${PLATES}"
+    -project_dir "${CONFIG_ROOT}${PROJECT_CODE}"
+  )
+
+  if [[ -n $ASSAY_TYPE ]]
+  then
+    args+=(-assay_type ${ASSAY_TYPE})
+  fi
+
+  if [[ -n $N_WORKERS ]]
+  then
+    args+=(-n_workers ${N_WORKERS})
+  fi
+
+  if [[ -n $METADATA_BUNDLE ]]
+  then
+    args+=(-metadata_bundle "${METADATA_BUNDLE}")
+  fi
+
+  if [[ -n $FORCE ]]
+  then
+    args+=(-force)
+  fi
+
+  if [[ -n $OUTPUT_FORMAT ]]
+  then
+    args+=(-output_format ${OUTPUT_FORMAT})
+  fi
+
+  if [[ -n $EXTRA_DATATYPES ]]
+  then
+    args+=(-extra_datatypes "${EXTRA_DATATYPES}")
+  fi
+
+  if [[ -n $DEV ]]
+  then
+    args+=(--dev)
+  fi
+
+  if [[ -n $BEADSET ]]
+  then
+    args+=(-beadset $BEADSET)
+  fi
+
+  if [[ -n $VERBOSE ]]
+  then
+    args+=(-verbose)
+  fi
+
+  echo python /clue/bin/assemble/assemble.py "${args[@]}"
+  python /clue/bin/assemble/assemble.py "${args[@]}"
+  exit_code=$?
+
+  source deactivate
+  exit $exit_code
+fi
+
 IFS=',' read -r -a plates <<< "${PLATES}"
 
 batch_index=${AWS_BATCH_JOB_ARRAY_INDEX}
@@ -99,6 +189,26 @@ then
   args+=(--dev)
 fi
 
+if [[ -n $METADATA_BUNDLE ]]
+then
+  args+=(-metadata_bundle "${METADATA_BUNDLE}")
+fi
+
+if [[ -n $FORCE ]]
+then
+  args+=(-force)
+fi
+
+if [[ -n $OUTPUT_FORMAT ]]
+then
+  args+=(-output_format ${OUTPUT_FORMAT})
+fi
+
+if [[ -n $EXTRA_DATATYPES ]]
+then
+  args+=(-extra_datatypes "${EXTRA_DATATYPES}")
+fi
+
 if [[ -n $BEADSET ]]
 then
   args+=(--beadset $BEADSET)
@@ -0,0 +1,131 @@
+"""
+Pooled, cached client for the clue API.
+
+Responses are stored on disk keyed by the full request url (endpoint plus filter), so repeated lookups of the same
+cell set or plate map are served without downloading it again.  Entries younger than ttl seconds are used as is, older
+ones are revalidated with their ETag.  ttl is 0 by default, so every response is checked with the server and a plate map
+or cell set fixed on clue is picked up by the next run.  In offline mode only the cache is used and a missing entry
+raises OfflineCacheMiss.
+
+The module is copied as is into assemble and filter-skipped-wells, each passing its own logger.
+
+The defaults can be set with the environment variables CLUE_API_CACHE_DIR, CLUE_API_CACHE_TTL and CLUE_API_OFFLINE.
+"""
+import os
+import json
+import time
+import hashlib
+import logging
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+# logger of the clients that are not given one
+_default_logger = logging.getLogger('clue_api_client')
+
+default_cache_dir = os.path.join(os.path.expanduser("~"), ".cache", "clue_api")
+default_ttl = 0
+
+_timeout = (10, 120)
+_retries = Retry(total=5, backoff_factor=1, status_forcelist=[429, 500, 502, 503, 504])
+
+
+class OfflineCacheMiss(Exception):
+    pass
+
+
+class ClueApiClient(object):
+    def __init__(self, cache_dir=None, ttl=None, offline=None, pool_maxsize=10, logger=None):
+        self.logger = logger if logger is not None else _default_logger
+        self.cache_dir = cache_dir if cache_dir is not None else os.environ.get("CLUE_API_CACHE_DIR", default_cache_dir)
+        self.ttl = ttl if ttl is not None else float(os.environ.get("CLUE_API_CACHE_TTL", default_ttl))
+        self.offline = offline if offline is not None else os.environ.get("CLUE_API_OFFLINE", "") not in ("", "0", "false", "FALSE")
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_maxsize, pool_maxsize=pool_maxsize, max_retries=_retries)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self.stats = {"hit": 0, "revalidated": 0, "miss": 0}
+
+    def __repr__(self):
+        return "ClueApiClient cache_dir:{} ttl:{} offline:{} stats:{}".format(self.cache_dir, self.ttl, self.offline, self.stats)
+
+    def _cache_path(self, request_url):
+        key = hashlib.sha1(request_url.encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, key + ".json")
+
+    def _read_entry(self, request_url):
+        path = self._cache_path(request_url)
+        if not os.path.exists(path):
+            return None
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except ValueError:
+            self.logger.warning("ignoring corrupt clue api cache entry:  {}".format(path))
+            return None
+        return entry if entry.get("url") == request_url else None
+
+    def _write_entry(self, request_url, entry):
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+        path = self._cache_path(request_url)
+        # write to a temporary file and rename so concurrent jobs never read a partial entry
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "w") as f:
+            json.dump(entry, f)
+        os.replace(tmp_path, path)
+
+    def get_json(self, request_url, headers=None):
+        entry = self._read_entry(request_url)
+
+        if entry is not None and (self.offline or time.time() - entry["fetched_at"] < self.ttl):
+            self.stats["hit"] += 1
+            self.logger.debug("clue api cache hit:  {}".format(request_url))
+            return entry["data"]
+
+        if self.offline:
+            raise OfflineCacheMiss("clue api offline mode and no cached response for request_url:  {}".format(request_url))
+
+        request_headers = dict(headers) if headers else {}
+        if entry is not None and entry.get("etag"):
+            request_headers["If-None-Match"] = entry["etag"]
+
+        response = self.session.get(request_url, headers=request_headers, timeout=_timeout)
+
+        if response.status_code == 304 and entry is not None:
+            self.stats["revalidated"] += 1
+            self.logger.debug("clue api cache revalidated:  {}".format(request_url))
+            entry["fetched_at"] = time.time()
+            self._write_entry(request_url, entry)
+            return entry["data"]
+
+        response.raise_for_status()
+
+        self.stats["miss"] += 1
+        self.logger.debug("clue api cache miss:  {}".format(request_url))
+        data = response.json()
+        self._write_entry(request_url, {"url": request_url, "etag": response.headers.get("ETag"),
+                                        "fetched_at": time.time(), "data": data})
+        return data
+
+
+_client = None
+
+
+def configure(cache_dir=None, ttl=None, offline=None, logger=None):
+    """
+    replace the shared client, arguments that are None fall back to the environment / module defaults
+    """
+    global _client
+    _client = ClueApiClient(cache_dir=cache_dir, ttl=ttl, offline=offline, logger=logger)
+    return _client
+
+
+def get_client():
+    global _client
+    if _client is None:
+        _client = ClueApiClient()
+    return _client
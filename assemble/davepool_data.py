@@ -1,7 +1,10 @@
 import logging
 import csv
 
+import numpy as np
+
 import setup_logger as setup_logger
+import plate_geometry
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -9,14 +12,27 @@ datatype_names = ["Median", "Count"]
 date_header = "Date"
 datatype_header = "DataType:"
 
+#value stored in the integer count matrix for cells that are missing from the csv
+count_null = -1
+
+
+def datatype_suffix(datatype_name):
+    '''
+    name used for a DataType section in output file names and container nodes, e.g. "Net MFI" becomes "NET_MFI"
+    '''
+    return "_".join(datatype_name.upper().split())
+
 
 class DavepoolData(object):
     '''
     contains the data associated with a davepool - davepool id, csv file information,
-    relevant data read from the csv
+    relevant data read from the csv.  median_data and count_data are matrices of wells x analytes, the rows
+    are ordered as in well_list and the columns as in median_headers / count_headers.  Any additional DataType
+    sections that were requested are in extra_headers / extra_data, keyed by section name, with float32 matrices
+    ordered the same way
     '''
     def __init__(self, csv_filepath=None, csv_datetime=None, median_headers=None, median_data=None,
-        count_headers=None, count_data=None, davepool_id=None):
+        count_headers=None, count_data=None, davepool_id=None, well_list=None, extra_headers=None, extra_data=None):
 
         self.csv_filepath = csv_filepath
         self.csv_datetime = csv_datetime
@@ -25,34 +41,35 @@ class DavepoolData(object):
         self.count_headers = count_headers
         self.count_data = count_data
         self.davepool_id = davepool_id
+        self.well_list = well_list
+        self.extra_headers = extra_headers if extra_headers is not None else {}
+        self.extra_data = extra_data if extra_data is not None else {}
 
     def __repr__(self):
         return " ".join(["{}:{}".format(k,v) for (k,v) in self.__dict__.items()])
 
     def validate_data(self):
-        data_arrays = [("median", self.median_data), ("count", self.count_data)]
-        for (data_name, da) in data_arrays:
-            for (i, md) in enumerate(da):
-                assert len(md) > 0, "data row is empty - self.davepool_id:  {}  self.csv_filepath:  {}  data_name:  {}  row number i:  {}  previous row - self.median_data[i-1]:  {}".format(
-                    self.davepool_id, self.csv_filepath, data_name, i, self.median_data[i-1])
-
-def get_datatype_range(data, datatype_names):
-    datatype_indexes = [i for (i,row) in enumerate(data) if len(row) > 0 and row[0] == datatype_header]
-    datatypes = [data[i][1] for i in datatype_indexes]
-    i = len(data) - 1
-    while i > datatype_indexes[-1] and len(data[i]) == 0:
-        i = i - 1
-    datatype_indexes.append(i + 2)
-
-    r = {}
-    for dn in datatype_names:
-        if dn in datatypes:
-            dn_index = datatypes.index(dn)
-            r[dn] = (datatype_indexes[dn_index], datatype_indexes[dn_index+1])
-        else:
-            r[dn] = (None, None)
-
-    return r
+        data_arrays = [("median", self.median_headers, self.median_data), ("count", self.count_headers, self.count_data)]
+        data_arrays.extend([(name, self.extra_headers[name], da) for (name, da) in self.extra_data.items()])
+        for (data_name, headers, da) in data_arrays:
+            assert da.size > 0, "data is empty - self.davepool_id:  {}  self.csv_filepath:  {}  data_name:  {}".format(
+                self.davepool_id, self.csv_filepath, data_name)
+
+            expected_shape = (len(self.well_list), len(headers))
+            assert da.shape == expected_shape, "data shape does not match wells x headers - self.davepool_id:  {}  self.csv_filepath:  {}  data_name:  {}  da.shape:  {}  expected_shape:  {}".format(
+                self.davepool_id, self.csv_filepath, data_name, da.shape, expected_shape)
+
+    def subset_wells(self, wells):
+        '''
+        keep only the rows of the data matrices whose well is in wells, preserving the original row order
+        :param wells: collection of well names to keep
+        :return:
+        '''
+        keep = plate_geometry.isin_wells(self.well_list, list(wells))
+        self.well_list = [w for (w, k) in zip(self.well_list, keep) if k]
+        self.median_data = self.median_data[keep]
+        self.count_data = self.count_data[keep]
+        self.extra_data = {name:da[keep] for (name, da) in self.extra_data.items()}
 
 
 def get_datetime_from_header_rows(header_rows, csv_filepath):
@@ -67,73 +84,139 @@ def get_datetime_from_header_rows(header_rows, csv_filepath):
     return r
 
 
-def read_data(csv_filepath):
-    f = open(csv_filepath, 'rU')
-    reader = csv.reader(f)
+def read_sections(csv_filepath, section_names):
+    '''
+    single pass over the csv, keeping only the rows belonging to the requested DataType sections.  Each section
+    starts with a "DataType:" row, followed by its header row and then one row per well up to the next blank row
+    :param csv_filepath:
+    :param section_names: names of the DataType sections to keep
+    :return: (rows preceding the first DataType section, {section name:(header row, data rows)})
+    '''
+    header_rows = []
+    sections = {}
+
+    current = None
+    in_preamble = True
+    with open(csv_filepath, newline='') as f:
+        for row in csv.reader(f):
+            if len(row) > 0 and row[0] == datatype_header:
+                in_preamble = False
+                name = row[1] if len(row) > 1 else None
+                if name in section_names and name not in sections:
+                    current = [None, []]
+                    sections[name] = current
+                else:
+                    current = None
+            elif in_preamble:
+                header_rows.append(row)
+            elif current is not None:
+                if not any(row):
+                    current = None
+                elif current[0] is None:
+                    current[0] = row
+                else:
+                    current[1].append(row)
+
+    return (header_rows, {name:tuple(section) for (name, section) in sections.items()})
+
+
+def build_data_matrix(headers, rows, dtype):
+    '''
+    convert the data rows of a section into a wells x analytes matrix.  Rows shorter than the header are padded
+    with missing values, as are empty cells
+    :param headers: header row of the section, first entry is the location column
+    :param rows: data rows of the section, first entry of each row is the location
+    :param dtype: numpy dtype of the returned matrix
+    :return: (list of locations, matrix)
+    '''
+    n_cols = len(headers) - 1
+    locations = []
+    values = []
+    for row in rows:
+        locations.append(row[0])
+        row_values = [v or "nan" for v in row[1:n_cols + 1]]
+        row_values.extend(["nan"] * (n_cols - len(row_values)))
+        values.extend(row_values)
 
-    data = list()
-    for row in reader:
-        data.append(row)
-    f.close()
+    matrix = np.array(values).astype(np.float64).reshape(len(rows), n_cols)
 
-    logger.debug("len(data):  {}".format(len(data)))
+    if np.issubdtype(dtype, np.integer):
+        matrix[np.isnan(matrix)] = count_null
 
-    datatype_ranges = get_datatype_range(data, datatype_names)
+    return (locations, matrix.astype(dtype))
 
-    datetime = get_datetime_from_header_rows(data[0:datatype_ranges[datatype_names[0]][0]], csv_filepath)
 
-    for dn in datatype_names:
-        if datatype_ranges[dn][0] is None:
-            raise Exception("davepool_data read_data did not find expected DataType dn:  {}".format(dn))
+def _location_indexes(locations):
+    # indexes in the largest plate, which holds the wells of any plate, only used to compare sections
+    (rows, cols) = plate_geometry.locations_to_rowcol(locations)
+    return plate_geometry.rowcol_to_indexes(rows, cols, plate_geometry.geometries[1536])
 
-    median_range = datatype_ranges[datatype_names[0]]
-    count_range = datatype_ranges[datatype_names[1]]
 
-    pd = DavepoolData(csv_filepath=csv_filepath, csv_datetime=datetime)
-    pd.median_headers = data[median_range[0]+1]
-    logger.info("len(pd.median_headers):  {}".format(len(pd.median_headers)))
+def _align_to_wells(well_indexes, locations, data, datatype_name, csv_filepath):
+    '''
+    reorder the rows of a section matrix to follow well_indexes, the wells of the Median section
+    '''
+    section_indexes = _location_indexes(locations)
+    if np.array_equal(section_indexes, well_indexes):
+        return data
 
-    pd.median_data = {}
-    pd.count_data = {}
+    if not np.array_equal(np.sort(section_indexes), np.sort(well_indexes)):
+        raise Exception("davepool_data read_data wells of {} DataType do not match wells of Median DataType - csv_filepath:  {}".format(
+            datatype_name, csv_filepath))
+    order = np.argsort(section_indexes)
+    return data[order[np.searchsorted(section_indexes, well_indexes, sorter=order)]]
 
-    median_data = data[(median_range[0]+2):(median_range[1]-1)]
 
-    for well in median_data:
-        if len(well) < len(pd.median_headers):
-            well.extend(['Nan'] * (len(pd.median_headers) - len(well)))
-            pd.median_data[parse_location_to_well(well[0])] = well[1:]
-        else:
-            pd.median_data[parse_location_to_well(well[0])] = well[1:]
+def read_data(csv_filepath, extra_datatype_names=()):
+    '''
+    read the Median and Count DataType sections of a csv, along with any extra_datatype_names, in a single pass
+    :param csv_filepath:
+    :param extra_datatype_names: names of additional DataType sections to read, e.g. "Net MFI", "Trimmed Mean"
+    :return: DavepoolData
+    '''
+    extra_datatype_names = [dn for dn in extra_datatype_names if dn not in datatype_names]
+    all_datatype_names = datatype_names + extra_datatype_names
 
-    logger.info("len(pd.median_data):  {}".format(len(pd.median_data)))
-    logger.debug("first line of median data - pd.median_data[0]:  {}".format(pd.median_data['A01']))
-    logger.debug("last line of median data - pd.median_data[-1]:  {}".format(pd.median_data['P24']))
+    (header_rows, sections) = read_sections(csv_filepath, all_datatype_names)
 
-    pd.count_headers = data[count_range[0]+1]
-    logger.info("len(pd.count_headers):  {}".format(len(pd.count_headers)))
+    for dn in all_datatype_names:
+        if dn not in sections or sections[dn][0] is None:
+            raise Exception("davepool_data read_data did not find expected DataType dn:  {}".format(dn))
 
-    count_data = data[(count_range[0]+2):(count_range[1]-1)]
+    datetime = get_datetime_from_header_rows(header_rows, csv_filepath)
+
+    pd = DavepoolData(csv_filepath=csv_filepath, csv_datetime=datetime)
+
+    (median_headers, median_rows) = sections[datatype_names[0]]
+    (median_locations, pd.median_data) = build_data_matrix(median_headers, median_rows, np.float32)
+    pd.median_headers = median_headers[1:]
+    pd.well_list = plate_geometry.locations_to_wells(median_locations)
+    well_indexes = _location_indexes(median_locations)
+    logger.info("len(pd.median_headers):  {}".format(len(pd.median_headers)))
+    logger.info("pd.median_data.shape:  {}".format(pd.median_data.shape))
+
+    (count_headers, count_rows) = sections[datatype_names[1]]
+    (count_locations, count_data) = build_data_matrix(count_headers, count_rows, np.int32)
+    pd.count_data = _align_to_wells(well_indexes, count_locations, count_data, datatype_names[1], csv_filepath)
+    pd.count_headers = count_headers[1:]
+    logger.info("len(pd.count_headers):  {}".format(len(pd.count_headers)))
+    logger.info("pd.count_data.shape:  {}".format(pd.count_data.shape))
 
-    for well in count_data:
-        if len(well) < len(pd.count_headers):
-            well.extend(['Nan'] * (len(pd.count_headers) - len(well)))
-            pd.count_data[parse_location_to_well(well[0])] = well[1:]
-        else:
-            pd.count_data[parse_location_to_well(well[0])] = well[1:]
+    for dn in extra_datatype_names:
+        (headers, rows) = sections[dn]
+        (locations, data) = build_data_matrix(headers, rows, np.float32)
+        pd.extra_data[dn] = _align_to_wells(well_indexes, locations, data, dn, csv_filepath)
+        pd.extra_headers[dn] = headers[1:]
+        logger.info("{} - len(headers):  {}  data.shape:  {}".format(dn, len(pd.extra_headers[dn]), pd.extra_data[dn].shape))
 
-    logger.info("len(pd.count_data):  {}".format(len(pd.count_data)))
-    logger.debug("first line of count data - pd.count_data[0]:  {}".format(pd.count_data['A01']))
-    logger.debug("last line of count data - pd.count_data[-1]:  {}".format(pd.count_data['P24']))
+    if len(pd.well_list) > 0:
+        geometry = plate_geometry.infer_geometry(*plate_geometry.indexes_to_rowcol(well_indexes, plate_geometry.geometries[1536]))
+        logger.debug("plate of {} wells - first well:  {}  last well:  {}".format(geometry.n_wells, pd.well_list[0],
+                                                                                pd.well_list[-1]))
 
     pd.validate_data()
 
     return pd
 
 def parse_location_to_well(location):
-    split = location.split(",")
-    right_paren_index = split[1].index(")")
-    raw_well = split[1][0:right_paren_index]
-    row = raw_well[0]
-    raw_col = raw_well[1:]
-    col = raw_col.zfill(2)
-    return row + col
+    return plate_geometry.locations_to_wells([location])[0]
@@ -0,0 +1,137 @@
+"""
+Canonical string formatting of perturbagen doses (pert_dose) and idoses (pert_idose).
+
+A dose column is factorized so each distinct value is formatted only once - a plate has thousands of wells but only a
+handful of distinct doses.  Numbers are rounded to significant figures and written as plain decimals, never in
+scientific notation.  Multi-agent doses separated by '|' are formatted agent by agent and idoses keep their unit,
+e.g. "0.0123456|10 uM" becomes "0.01235|10.0 uM".  Missing values are left as they are.
+"""
+import numpy as np
+import pandas as pd
+
+dose_separator = "|"
+
+
+def float_to_str(f):
+    float_string = repr(f)
+    if 'e' in float_string:  # detect scientific notation
+        digits, exp = float_string.split('e')
+        digits = digits.replace('.', '').replace('-', '')
+        exp = int(exp)
+        zero_padding = '0' * (abs(int(exp)) - 1)  # minus 1 for decimal point in the sci notation
+        sign = '-' if f < 0 else ''
+        if exp > 0:
+            float_string = '{}{}{}.0'.format(sign, digits, zero_padding)
+        else:
+            float_string = '{}0.{}{}'.format(sign, zero_padding, digits)
+    return float_string
+
+
+def _to_python_number(v):
+    if isinstance(v, (bool, np.bool_)):
+        return float(v)
+    if isinstance(v, (int, np.integer)):
+        return int(v)
+    return float(v)
+
+
+def format_numbers(numbers, sig=4, max_precision=50):
+    '''
+    canonical strings for a list of numbers - the number of decimals needed for sig significant figures is computed
+    for all of them at once, zero is written as "0" and NaN as "nan"
+    :param numbers: list of int / float
+    :param sig: significant figures
+    :param max_precision: maximum number of decimals
+    :return: list of strings
+    '''
+    numbers = [_to_python_number(v) for v in numbers]
+    x = np.array(numbers, dtype=np.float64)
+
+    nonzero = np.isfinite(x) & (x != 0)
+    decimals = np.zeros(len(x), dtype=int)
+    decimals[nonzero] = sig - np.floor(np.log10(np.abs(x[nonzero]))).astype(int) - 1
+
+    r = []
+    for (v, is_nonzero, d) in zip(numbers, nonzero.tolist(), decimals.tolist()):
+        if v != v:
+            r.append("nan")
+        else:
+            v = round(v, d) if is_nonzero else 0
+            r.append(float_to_str(round(v, max_precision)))
+    return r
+
+
+def format_unique_doses(uniques, with_unit=False, sig=4, max_precision=50):
+    '''
+    format distinct, non-missing dose values.  The numbers of all values are collected first and formatted in one
+    call to format_numbers
+    :param uniques: list of distinct doses - numbers or strings
+    :param with_unit: True for idoses, where each agent is a number followed by its unit
+    :return: list of canonical strings, one per entry of uniques
+    '''
+    numbers = []
+    layouts = []
+    for u in uniques:
+        if isinstance(u, str):
+            if u == 'nan':
+                layouts.append(u)
+                continue
+
+            agents = []
+            for agent in u.strip().split(dose_separator):
+                tokens = agent.split() if with_unit else [agent]
+                agents.append((len(numbers), tokens[1] if len(tokens) > 1 else None))
+                numbers.append(float(tokens[0]))
+            layouts.append(agents)
+        else:
+            layouts.append([(len(numbers), None)])
+            numbers.append(u)
+
+    formatted = format_numbers(numbers, sig=sig, max_precision=max_precision)
+
+    r = []
+    for layout in layouts:
+        if isinstance(layout, str):
+            r.append(layout)
+        else:
+            r.append(dose_separator.join([formatted[i] if unit is None else "{} {}".format(formatted[i], unit)
+                                          for (i, unit) in layout]))
+    return r
+
+
+def encode_doses(values, with_unit=False, sig=4, max_precision=50):
+    '''
+    canonical strings for a column of doses.  The column is factorized, each distinct value is formatted once and the
+    results are mapped back to the rows
+    :param values: pandas Series (or list) of doses
+    :param with_unit: True for idoses, e.g. "10 uM|5 uM"
+    :param sig: significant figures
+    :param max_precision: maximum number of decimals
+    :return: pandas Series with the same index, missing values are kept as they are
+    '''
+    series = values if isinstance(values, pd.Series) else pd.Series(values, dtype=object)
+
+    (codes, uniques) = pd.factorize(series)
+    formatted = np.empty(len(uniques), dtype=object)
+    formatted[:] = format_unique_doses(list(uniques), with_unit=with_unit, sig=sig, max_precision=max_precision)
+
+    r = series.to_numpy(dtype=object, copy=True)
+    present = codes >= 0
+    r[present] = formatted[codes[present]]
+
+    return pd.Series(r, index=series.index, name=series.name, dtype=object)
+
+
+def encode_idoses(values, sig=4, max_precision=50):
+    return encode_doses(values, with_unit=True, sig=sig, max_precision=max_precision)
+
+
+def canonicalize_dose_columns(df, sig=4):
+    '''
+    replace the pert_dose and pert_idose columns of df, when present, by their canonical strings
+    '''
+    if 'pert_dose' in df.columns:
+        df['pert_dose'] = encode_doses(df['pert_dose'], sig=sig)
+    if 'pert_idose' in df.columns:
+        df['pert_idose'] = encode_idoses(df['pert_idose'], sig=sig)
+    return df
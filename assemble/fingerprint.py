@@ -0,0 +1,106 @@
+"""
+Input fingerprints for incremental assembly.
+
+The fingerprint of a plate is a sha256 over everything its outputs are built from - the jcsv bytes, the resolved plate
+map rows, the cell set rows and the arguments that change the outputs.  It is stored next to the outputs in
+assemble/<prism_replicate_name>/, a later run with the same fingerprint can skip the plate.
+"""
+import os
+import json
+import hashlib
+import logging
+
+import setup_logger as setup_logger
+import parse_data as parse_data
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+#change when the outputs built from the same inputs change, so that existing fingerprints no longer match
+_fingerprint_version = 1
+
+_fingerprint_filename = "fingerprint.txt"
+_success_filename = "success.txt"
+
+#arguments that change the outputs of a plate
+fingerprint_args = ["assay_type", "truncate_to_plate_map", "output_format", "extra_datatypes"]
+
+_chunk_size = 1 << 20
+
+
+def _update_with_file(h, filepath):
+    with open(filepath, "rb") as f:
+        for chunk in iter(lambda: f.read(_chunk_size), b""):
+            h.update(chunk)
+
+
+def _update_with_rows(h, rows):
+    columns = parse_data.get_columns(rows)
+    h.update(json.dumps(columns, sort_keys=True, default=str).encode("utf-8"))
+
+
+def compute_fingerprint(csv_filepath, all_perturbagens, prism_cell_list, args):
+    '''
+    :param csv_filepath: jcsv of the plate
+    :param all_perturbagens: resolved plate map
+    :param prism_cell_list: resolved cell set
+    :param args: arguments of the plate, only fingerprint_args are used
+    :return: hex digest
+    '''
+    h = hashlib.sha256()
+    h.update("version:{}\n".format(_fingerprint_version).encode("utf-8"))
+
+    h.update(b"csv\n")
+    _update_with_file(h, csv_filepath)
+
+    h.update(b"\nperturbagens\n")
+    _update_with_rows(h, all_perturbagens)
+
+    h.update(b"\ncells\n")
+    _update_with_rows(h, prism_cell_list)
+
+    h.update(b"\nargs\n")
+    h.update(json.dumps({k:getattr(args, k, None) for k in fingerprint_args}, sort_keys=True, default=str).encode("utf-8"))
+
+    return h.hexdigest()
+
+
+def _plate_dir(outfile, prism_replicate_name):
+    return os.path.join(outfile, "assemble", prism_replicate_name)
+
+
+def read_fingerprint(outfile, prism_replicate_name):
+    path = os.path.join(_plate_dir(outfile, prism_replicate_name), _fingerprint_filename)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return f.read().strip()
+
+
+def write_fingerprint(outfile, prism_replicate_name, fingerprint):
+    path = os.path.join(_plate_dir(outfile, prism_replicate_name), _fingerprint_filename)
+    with open(path, "w") as f:
+        f.write(fingerprint + "\n")
+
+
+def remove_fingerprint(outfile, prism_replicate_name):
+    path = os.path.join(_plate_dir(outfile, prism_replicate_name), _fingerprint_filename)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def is_up_to_date(outfile, prism_replicate_name, fingerprint, output_suffixes):
+    '''
+    True when the stored fingerprint matches and the previous run succeeded with all of its outputs still present
+    :param output_suffixes: suffixes of the output files, appended to prism_replicate_name
+    '''
+    if read_fingerprint(outfile, prism_replicate_name) != fingerprint:
+        return False
+
+    plate_dir = _plate_dir(outfile, prism_replicate_name)
+    expected = [_success_filename] + [prism_replicate_name + s for s in output_suffixes]
+    missing = [x for x in expected if not os.path.exists(os.path.join(plate_dir, x))]
+    if missing:
+        logger.info("fingerprint of {} matches but outputs are missing:  {}".format(prism_replicate_name, missing))
+        return False
+
+    return True
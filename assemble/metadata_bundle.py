@@ -0,0 +1,151 @@
+"""
+
+Command line script which prefetches the clue API metadata needed to assemble every plate of a screen - the beadset
+assay types, the plate maps (v_plate_map_src) and the cell sets (cell_set_definition_files) - concurrently, and writes
+them to a single gzipped json bundle.  assemble.py reads the bundle with -metadata_bundle in place of the API.
+"""
+import sys
+import gzip
+import json
+import logging
+import argparse
+import concurrent.futures
+
+import setup_logger as setup_logger
+import prism_metadata as prism_metadata
+import clue_api_client as clue_api_client
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+API_URL = 'https://api.clue.io/api/'
+DEV_API_URL = 'https://dev-api.clue.io/api/'
+
+_bundle_version = 1
+
+
+def build_parser():
+
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument("-plates", help="comma separated list of plates (PLATES) of the screen", type=str, required=True)
+    parser.add_argument("-out", help="path of the bundle to write", type=str, required=True)
+    parser.add_argument("-assay_type", "-at", help="assay type used for all plates instead of the beadset lookup",
+                        type=str, default=None, required=False)
+    parser.add_argument("-beadset", "-bs", help="bead set used for all plates instead of the one in the plate name",
+                        type=str, default=None, required=False)
+    parser.add_argument("-n_threads", "-nt", help="number of concurrent API requests", type=int, default=16)
+    parser.add_argument("-verbose", '-v', help="Whether to print a bunch of output", action="store_true", default=False)
+    parser.add_argument("--dev", help=argparse.SUPPRESS, action="store_true", default=False)
+
+    return parser
+
+
+def _cell_set_key(assay_type, beadset):
+    return "{}|{}".format(assay_type, beadset)
+
+
+class MetadataBundle(object):
+    '''
+    clue API rows prefetched for a screen - assay_types maps beadset to assay type, map_srcs maps map_src name to
+    its v_plate_map_src rows and cell_sets maps "assay_type|beadset" to its cell_set_definition_files rows
+    '''
+    def __init__(self, assay_types=None, map_srcs=None, cell_sets=None):
+        self.assay_types = assay_types if assay_types is not None else {}
+        self.map_srcs = map_srcs if map_srcs is not None else {}
+        self.cell_sets = cell_sets if cell_sets is not None else {}
+
+    def __repr__(self):
+        return "MetadataBundle assay_types:{} map_srcs:{} cell_sets:{}".format(
+            self.assay_types, list(self.map_srcs.keys()), list(self.cell_sets.keys()))
+
+    def get_assay_type(self, beadset):
+        if beadset not in self.assay_types:
+            raise KeyError("beadset not found in metadata bundle:  {}".format(beadset))
+        return self.assay_types[beadset]
+
+    def build_perturbagens(self, map_src_name, pert_time):
+        if map_src_name not in self.map_srcs:
+            raise KeyError("map_src not found in metadata bundle:  {}".format(map_src_name))
+        return prism_metadata.build_perturbagens_from_json(self.map_srcs[map_src_name], map_src_name, pert_time)
+
+    def build_prism_cell_list(self, assay_type, beadset):
+        key = _cell_set_key(assay_type, beadset)
+        if key not in self.cell_sets:
+            raise KeyError("cell set not found in metadata bundle (assay_type, beadset):  {}".format((assay_type, beadset)))
+        return prism_metadata.build_prism_cell_list_from_json(self.cell_sets[key], assay_type)
+
+
+def write_bundle(bundle, path):
+    content = {"version": _bundle_version, "assay_types": bundle.assay_types, "map_srcs": bundle.map_srcs,
+               "cell_sets": bundle.cell_sets}
+    with gzip.open(path, "wt") as f:
+        json.dump(content, f, separators=(",", ":"))
+
+
+def read_bundle(path):
+    with gzip.open(path, "rt") as f:
+        content = json.load(f)
+
+    if content.get("version") != _bundle_version:
+        raise ValueError("unsupported metadata bundle version:  {}  path:  {}".format(content.get("version"), path))
+
+    return MetadataBundle(assay_types=content["assay_types"], map_srcs=content["map_srcs"], cell_sets=content["cell_sets"])
+
+
+def parse_plate_requests(plates, beadset=None):
+    '''
+    derive the distinct map_src names and beadsets needed by the plates, using the naming of batch_assemble.sh
+    :param plates: list of plate names, e.g. PCAL001_PR500_120H_X1_B1
+    :param beadset: beadset used for all plates, overrides the one in the plate name
+    :return: (set of map_src names, set of beadsets)
+    '''
+    map_src_names = set()
+    beadsets = set()
+    for plate in plates:
+        map_src_names.add(prism_metadata.build_map_src_name(plate))
+        beadsets.add(beadset if beadset else plate.split("_")[4])
+
+    return (map_src_names, beadsets)
+
+
+def prefetch(plates, api_url, assay_type=None, beadset=None, n_threads=16):
+    (map_src_names, beadsets) = parse_plate_requests(plates, beadset=beadset)
+    logger.info("prefetching {} map_srcs and {} beadsets for {} plates".format(len(map_src_names), len(beadsets), len(plates)))
+
+    bundle = MetadataBundle()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        if assay_type is None:
+            futures = {bs: executor.submit(prism_metadata.get_assay_type_from_db, bs, api_url)
+                       for bs in beadsets}
+            bundle.assay_types = {bs: f.result() for (bs, f) in futures.items()}
+        else:
+            bundle.assay_types = {bs: assay_type for bs in beadsets}
+
+        map_src_futures = {name: executor.submit(prism_metadata.fetch_perturbagen_rows, name, api_url)
+                           for name in map_src_names}
+        cell_set_futures = {_cell_set_key(at, bs): executor.submit(prism_metadata.fetch_prism_cell_rows, at, bs, api_url)
+                            for (bs, at) in bundle.assay_types.items()}
+
+        bundle.map_srcs = {name: f.result() for (name, f) in map_src_futures.items()}
+        bundle.cell_sets = {key: f.result() for (key, f) in cell_set_futures.items()}
+
+    return bundle
+
+
+def main(args):
+    api_url = DEV_API_URL if args.dev else API_URL
+
+    plates = [p.strip() for p in args.plates.split(",") if p.strip()]
+    bundle = prefetch(plates, api_url, assay_type=args.assay_type, beadset=args.beadset, n_threads=args.n_threads)
+
+    write_bundle(bundle, args.out)
+    logger.info("metadata bundle has been written to {}".format(args.out))
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args(sys.argv[1:])
+    setup_logger.setup(verbose=args.verbose)
+    clue_api_client.configure(logger=logger)
+
+    logger.info("args:  {}".format(args))
+
+    main(args)
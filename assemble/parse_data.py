@@ -1,11 +1,253 @@
-
-import urllib3
+import os
+import mmap
+import urllib.parse
+import urllib.request
 import setup_logger as setup_logger
 import logging
+import numpy as np
 import utils.path_utils as path_utils
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+#marks a field that a row does not have, e.g. a json object without that key or a tsv row that is too short
+_missing = object()
+
+
+def column_array(values):
+    '''
+    values of a column as a numpy array - float64 when every value is a float, object otherwise (strings, None for empty
+    values, _missing...)
+    '''
+    values = list(values)
+    if len(values) > 0 and all(isinstance(v, float) for v in values):
+        return np.array(values, dtype=np.float64)
+    r = np.empty(len(values), dtype=object)
+    for (i, v) in enumerate(values):
+        r[i] = v
+    return r
+
+
+class MetadataTable(object):
+    '''
+    columnar metadata - one numpy array of values per field (see column_array), every array has n_rows entries.  Rows
+    that do not have a field hold _missing in its column
+    '''
+    def __init__(self, n_rows=0):
+        self.n_rows = n_rows
+        self.columns = {}
+        self.rows = None
+
+    def __repr__(self):
+        return "MetadataTable n_rows:{} columns:{}".format(self.n_rows, list(self.columns.keys()))
+
+    def set_column(self, name, values):
+        assert len(values) == self.n_rows, "column length does not match table - name:  {}  len(values):  {}  self.n_rows:  {}".format(
+            name, len(values), self.n_rows)
+        self.columns[name] = column_array(values)
+
+    def set_value(self, name, index, value):
+        if name not in self.columns:
+            self.columns[name] = column_array([_missing] * self.n_rows)
+        elif self.columns[name].dtype != object and not isinstance(value, float):
+            self.columns[name] = self.columns[name].astype(object)
+        self.columns[name][index] = value
+
+    def take(self, indexes=None, names=None):
+        '''
+        columns of the table for the rows at indexes (all rows when None), missing values are returned as None
+        :param indexes:
+        :param names: fields to return, all fields when None
+        :return: {field:list of values}
+        '''
+        r = {}
+        for (name, values) in self.columns.items():
+            if names is not None and name not in names:
+                continue
+            if indexes is not None:
+                values = values[np.asarray(indexes, dtype=np.int64)]
+            if values.dtype != object:
+                r[name] = values.tolist()
+            else:
+                r[name] = [None if v is _missing else v for v in values]
+        return r
+
+    def build_rows(self, RowClass):
+        '''
+        build one row view of RowClass per row of the table, they are kept in self.rows so later conversions can
+        recognize a complete, in order list of rows
+        '''
+        self.rows = [RowClass.view(self, i) for i in range(self.n_rows)]
+        return self.rows
+
+
+class MetadataRow(object):
+    '''
+    view of one row of a MetadataTable, fields are read and written as attributes.  Subclasses list their default
+    fields in _defaults, these are always present and come first in the table
+    '''
+    __slots__ = ("_table", "_index")
+    _defaults = ()
+
+    def __init__(self, **fields):
+        table = build_table(1, self._defaults)
+        for (k, v) in fields.items():
+            table.set_value(k, 0, v)
+        object.__setattr__(self, "_table", table)
+        object.__setattr__(self, "_index", 0)
+
+    @classmethod
+    def view(cls, table, index):
+        r = cls.__new__(cls)
+        object.__setattr__(r, "_table", table)
+        object.__setattr__(r, "_index", index)
+        return r
+
+    def __getattr__(self, name):
+        if name.startswith("_"):
+            raise AttributeError(name)
+        values = self._table.columns.get(name)
+        if values is None or values[self._index] is _missing:
+            raise AttributeError(name)
+        return values[self._index] if values.dtype == object else values[self._index].item()
+
+    def __setattr__(self, name, value):
+        self._table.set_value(name, self._index, value)
+
+    def __delattr__(self, name):
+        if name in self._table.columns:
+            self._table.set_value(name, self._index, _missing)
+
+    def __getstate__(self):
+        return (self._table, self._index)
+
+    def __setstate__(self, state):
+        object.__setattr__(self, "_table", state[0])
+        object.__setattr__(self, "_index", state[1])
+
+    def fields(self):
+        return {k:(v[self._index] if v.dtype == object else v[self._index].item())
+                for (k, v) in self._table.columns.items() if v[self._index] is not _missing}
+
+    def __repr__(self):
+        return " ".join(["{}:{}".format(str(k),str(v)) for (k,v) in self.fields().items()])
+
+    def __str__(self):
+        return self.__repr__()
+
+    def validate_properties(self, expected_properties):
+        for property in expected_properties:
+            if hasattr(self,property):
+                continue
+            else:
+                raise Exception("missing property: {}".format(property))
+
+
+def build_table(n_rows, defaults):
+    table = MetadataTable(n_rows)
+    for (name, value) in defaults:
+        table.set_column(name, [value] * n_rows)
+    return table
+
+
+def get_table(rows):
+    '''
+    the table that rows are a complete, in order view of, None if rows is anything else (a subset, rows of several tables...)
+    '''
+    if len(rows) == 0 or not isinstance(rows[0], MetadataRow):
+        return None
+    table = rows[0]._table
+    if table.rows is not None and (rows is table.rows or rows == table.rows):
+        return table
+    return None
+
+
+def get_columns(rows, names=None):
+    '''
+    field values of the rows as columns, in order of first appearance of the fields.  Rows of one table are
+    gathered column by column, other objects (legacy classes using __dict__) field by field
+    :param rows:
+    :param names: fields to return, all fields when None
+    :return: {field:list of values, None for rows that do not have the field}
+    '''
+    table = get_table(rows)
+    if table is not None:
+        return table.take(names=names)
+
+    if len(rows) > 0 and all(isinstance(r, MetadataRow) for r in rows):
+        tables = {id(r._table):r._table for r in rows}
+        if len(tables) == 1:
+            return rows[0]._table.take([r._index for r in rows], names=names)
+
+    object_fields = [r.fields() if isinstance(r, MetadataRow) else r.__dict__ for r in rows]
+    all_names = {}
+    for f in object_fields:
+        for k in f.keys():
+            all_names[k] = None
+    if names is not None:
+        all_names = {k:None for k in names}
+    return {k:[f.get(k) for f in object_fields] for k in all_names}
+
+
+def validate_columns(rows, expected_properties):
+    '''
+    check that every row has the expected properties - for a complete table only the columns are inspected
+    '''
+    table = get_table(rows)
+    if table is None:
+        for r in rows:
+            r.validate_properties(expected_properties)
+        return
+
+    for property in expected_properties:
+        values = table.columns.get(property)
+        if values is None or any(v is _missing for v in values):
+            raise Exception("missing property: {}".format(property))
+
+
+def parse_column(raw_values):
+    '''
+    type inference for a whole column - when every value is empty or a number the column is converted to floats in one
+    pass, otherwise each value is parsed by parse_raw_value.  _missing entries are kept as they are
+    :return: numpy array, see column_array
+    '''
+    try:
+        values = [v if v is _missing else (float(v) if v else None) for v in raw_values]
+    except (ValueError, TypeError):
+        values = [v if v is _missing else parse_raw_value(v) for v in raw_values]
+    return column_array(values)
+
+
+def _fill_table(table, columns):
+    for (name, raw_values) in columns.items():
+        values = parse_column(raw_values)
+        if name in table.columns:
+            #keep the default value for rows that do not have the field
+            default_values = table.columns[name]
+            values = [d if v is _missing else v for (d, v) in zip(default_values, values)]
+        table.set_column(name, values)
+
+    return table
+
+
+def parse_table(header_map, data, defaults=()):
+    table = build_table(len(data), defaults)
+    columns = {h:[row[i] if len(row) > i else _missing for row in data] for (h, i) in header_map.items()}
+    return _fill_table(table, columns)
+
+
+def parse_json_table(data, defaults=()):
+    table = build_table(len(data), defaults)
+    names = {}
+    for obj in data:
+        for k in obj.keys():
+            names[k] = None
+    columns = {k:[obj.get(k, _missing) for obj in data] for k in names}
+    return _fill_table(table, columns)
+
+
 def parse_data(header_map, data, BuildClass):
+    if issubclass(BuildClass, MetadataRow):
+        return parse_table(header_map, data, BuildClass._defaults).build_rows(BuildClass)
+
     r = []
     for row in data:
         bc = BuildClass()
@@ -20,6 +262,9 @@ def parse_data(header_map, data, BuildClass):
     return r
 
 def parse_json(data, BuildClass):
+    if issubclass(BuildClass, MetadataRow):
+        return parse_json_table(data, BuildClass._defaults).build_rows(BuildClass)
+
     r = []
     for obj in data:
         bc = BuildClass()
@@ -27,7 +272,6 @@ def parse_json(data, BuildClass):
         for k,v in obj.items():
             bc.__dict__[k] = parse_raw_value(v)
 
-        #bc.__dict__ = { k:parse_raw_value(v) for k,v in obj.items() }
     return r
 
 def parse_raw_value(raw_value):
@@ -73,20 +317,74 @@ def generate_header_map(headers, internal_header_file_header_pairs, do_keep_all)
     return header_map
 
 
-def read_data(tsv_filepath):
-    tsv_filepath = path_utils.validate_path_as_uri(tsv_filepath)
+def iter_lines(tsv_filepath):
+    '''
+    stream the lines of a local file or https URI without reading the whole text into memory - local files are
+    memory mapped, https responses are read in chunks as the lines are consumed.  Line endings are removed
+    :param tsv_filepath: local path, file URI or https URI
+    :return: generator of str
+    '''
+    uri = path_utils.validate_path_as_uri(tsv_filepath)
+    parsed = urllib.parse.urlparse(uri)
 
-    f = urllib3.urlopen(tsv_filepath)
-    raw_data = f.read().strip().split("\n")
-    f.close()
+    if parsed.scheme == "file":
+        local_path = urllib.request.url2pathname(parsed.path)
+        with open(local_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                for line in iter(mm.readline, b""):
+                    yield line.decode("utf-8").rstrip("\r\n")
+    else:
+        with urllib.request.urlopen(uri) as response:
+            for line in response:
+                yield line.decode("utf-8").rstrip("\r\n")
 
-    split_raw_data = [x.split("\t") for x in raw_data]
 
-    headers = [x.lower() for x in split_raw_data[0]]
+def read_table(tsv_filepath, internal_header_file_header_pairs=None, do_keep_all=True, defaults=(), skip_comments=False):
+    '''
+    stream a tab separated file into a MetadataTable, keeping only the columns selected by generate_header_map.  Each
+    line is split as it is read and its projected fields appended to their column, the types are then inferred once per
+    column by parse_column.  Blank lines are skipped, as are lines starting with "#" when skip_comments is set
+    :param tsv_filepath: local path, file URI or https URI
+    :param internal_header_file_header_pairs: see generate_header_map
+    :param do_keep_all: see generate_header_map
+    :param defaults: (name, value) pairs of fields every row has, see build_table
+    :param skip_comments:
+    :return: MetadataTable
+    '''
+    lines = (line for line in iter_lines(tsv_filepath) if line.strip())
+
+    header_line = next(lines, None)
+    if header_line is None:
+        raise Exception("parse_data read_table file is empty - tsv_filepath:  {}".format(tsv_filepath))
+    headers = [x.lower() for x in header_line.strip().split("\t")]
     logger.debug("headers:  {}".format(headers))
 
-    data = split_raw_data[1:]
-    return (headers, data)
+    header_map = generate_header_map(headers, internal_header_file_header_pairs, do_keep_all)
+    projection = list(header_map.items())
+    columns = {h:[] for (h, i) in projection}
+
+    n_rows = 0
+    for line in lines:
+        if skip_comments and line[0] == "#":
+            continue
+        fields = line.split("\t")
+        n_fields = len(fields)
+        for (h, i) in projection:
+            columns[h].append(fields[i] if n_fields > i else _missing)
+        n_rows += 1
 
+    return _fill_table(build_table(n_rows, defaults), columns)
 
 
+def read_data(tsv_filepath):
+    lines = (line for line in iter_lines(tsv_filepath) if line.strip())
+
+    split_raw_data = [x.split("\t") for x in lines]
+
+    headers = [x.lower() for x in split_raw_data[0]]
+    logger.debug("headers:  {}".format(headers))
+
+    data = split_raw_data[1:]
+    return (headers, data)
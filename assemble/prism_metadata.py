@@ -5,6 +5,7 @@ import pandas
 import logging
 import requests
 import parse_data
+import clue_api_client
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
@@ -23,45 +24,27 @@ CELL_SET_DEFINITION_HEADERS = [
     'barcode_id'
 ]
 
-class PrismCell(object):
-    def __init__(self, pool_id=None, analyte_id=None, davepool_id=None, feature_id=None):
-        self.pool_id = pool_id
-        self.analyte_id = analyte_id
-        self.davepool_id = davepool_id
-        self.feature_id = feature_id
-
-        self.ignore = False
-
-    def __repr__(self):
-        return " ".join(["{}:{}".format(str(k),str(v)) for (k,v) in self.__dict__.items()])
+class PrismCell(parse_data.MetadataRow):
+    '''
+    row view of the PRISM cell metadata table, see parse_data.MetadataRow
+    '''
+    __slots__ = ()
+    _defaults = (("pool_id", None), ("analyte_id", None), ("davepool_id", None), ("feature_id", None), ("ignore", False))
 
-    def __str__(self):
-        return self.__repr__()
+    def __init__(self, pool_id=None, analyte_id=None, davepool_id=None, feature_id=None):
+        super(PrismCell, self).__init__(pool_id=pool_id, analyte_id=analyte_id, davepool_id=davepool_id,
+                                        feature_id=feature_id)
 
-    def validate_properties(self, expected_properties):
-        for property in expected_properties:
-            if hasattr(self,property):
-                continue
-            else:
-                raise Exception("missing property: {}".format(property))
 
+class Perturbagen(parse_data.MetadataRow):
+    '''
+    row view of the perturbagen (plate map) metadata table, see parse_data.MetadataRow
+    '''
+    __slots__ = ()
+    _defaults = (("pert_well", None),)
 
-class Perturbagen(object):
     def __init__(self, pert_well=None):
-        self.pert_well = pert_well
-
-    def __repr__(self):
-        return " ".join(["{}:{}".format(str(k),str(v)) for (k,v) in self.__dict__.items()])
-
-    def __str__(self):
-        return self.__repr__()
-
-    def validate_properties(self, expected_properties):
-        for property in expected_properties:
-            if hasattr(self,property):
-                continue
-            else:
-                raise Exception("missing property: {}".format(property))
+        super(Perturbagen, self).__init__(pert_well=pert_well)
 
 
 def make_request_url_filter(endpoint_url, where=None, fields=None):
@@ -97,24 +80,14 @@ def get_data_from_db(endpoint_url, user_key, where = None, fields=None):
     request_url = make_request_url_filter(endpoint_url, where = where, fields=fields)
     logger.debug(request_url)
     # print(request_url)
-    response = requests.get(request_url, headers={'user_key': user_key})
-    if response.ok:
-        return response.json()
-    else:
-        response.raise_for_status()
+    return clue_api_client.get_client().get_json(request_url, headers={'user_key': user_key})
 
 def read_prism_cell_from_file(row_metadata_file, items):
 
-    filepath = row_metadata_file
+    table = parse_data.read_table(row_metadata_file, items, False, defaults=PrismCell._defaults, skip_comments=True)
 
-    (headers, data) = parse_data.read_data(filepath)
-
-    data = [x for x in data if x[0][0] != "#"]
-
-    header_map = parse_data.generate_header_map(headers, items, False)
-
-    logger.debug("header_map:  {}".format(header_map))
-    return parse_data.parse_data(header_map, data, PrismCell)
+    logger.debug("table:  {}".format(table))
+    return table.build_rows(PrismCell)
 
 def build_prism_cell_list(config_parser, cell_set_definition_file):
     '''
@@ -134,14 +107,17 @@ def build_prism_cell_list(config_parser, cell_set_definition_file):
 
     return prism_cell_list
 
-def _read_prism_cell_from_db(cell_set_name, beadset, api_url):
+def fetch_prism_cell_rows(cell_set_name, beadset, api_url):
     cell_set_def_url = api_url + 'cell_set_definition_files/'
-    data = get_data_from_db(
+    return get_data_from_db(
         cell_set_def_url,
         where={'davepool_id':cell_set_name, 'beadset':beadset},
         fields= CELL_SET_DEFINITION_HEADERS,
         user_key=API_KEY)
 
+def _read_prism_cell_from_db(cell_set_name, beadset, api_url):
+    data = fetch_prism_cell_rows(cell_set_name, beadset, api_url)
+
     return parse_data.parse_json(data, PrismCell)
 
 def build_prism_cell_list_from_db(cell_set_name, beadset, api_url):
@@ -162,6 +138,25 @@ def build_prism_cell_list_from_db(cell_set_name, beadset, api_url):
 
     return prism_cell_list
 
+def build_prism_cell_list_from_json(data, cell_set_name):
+    '''
+    build the PRISM cell list from cell_set_definition_files rows that were already fetched, e.g. from a metadata bundle
+    :param data: list of cell_set_definition_files rows
+    :param cell_set_name:
+    :return:
+    '''
+    prism_cell_list = parse_data.parse_json(data, PrismCell)
+
+    if not prism_cell_list:
+        raise ValueError("cell set name not found in db (davepool_id): {}".format(cell_set_name))
+
+    return prism_cell_list
+
+def get_assay_type_from_db(beadset, api_url=API_URL):
+    api_call = os.path.join(api_url.rstrip("/"), 'beadset', beadset)
+    db_entry = clue_api_client.get_client().get_json(api_call)
+    return db_entry['assay_variant']
+
 
 def build_perturbagens_from_file(filepath, pert_time):
 
@@ -180,31 +175,54 @@ def build_perturbagens_from_db(map_src_name, pert_time, api_url):
 
     return perturbagens
 
+def build_perturbagens_from_json(data, map_src_name, pert_time):
+    '''
+    build the perturbagens from v_plate_map_src rows that were already fetched, e.g. from a metadata bundle
+    :param data: list of v_plate_map_src rows
+    :param map_src_name:
+    :param pert_time:
+    :return:
+    '''
+    perturbagens = parse_data.parse_json(data, Perturbagen)
+    _add_pert_time_info(perturbagens, pert_time)
+
+    if not perturbagens:
+        raise ValueError("Map Src name not found (pert_plate, replicate): {}".format(map_src_name))
+
+    return perturbagens
+
 
 def _read_perturbagen_from_file(filepath, do_keep_all):
 
-    (headers, data) = parse_data.read_data(filepath)
+    table = parse_data.read_table(filepath, None, do_keep_all, defaults=Perturbagen._defaults)
 
     #todo: think about other checks / better notification of wrong map type
-    if "well_position" in headers:
+    if "well_position" in table.columns:
         Exception("Merino no longer supports CM map type, please convert map to CMap map type")
 
-    header_map = parse_data.generate_header_map(headers, None, do_keep_all)
-    logger.debug("header_map:  {}".format(header_map))
+    logger.debug("table:  {}".format(table))
 
-    return parse_data.parse_data(header_map, data, Perturbagen)
+    return table.build_rows(Perturbagen)
 
-def _read_perturbagen_from_db(map_src_name, api_url):
+def build_map_src_name(prism_replicate_name):
+    # same naming used by batch_assemble.sh: pert plate plus the replicate without any suffix
+    plate_token = prism_replicate_name.split("_")
+    return plate_token[0] + "." + plate_token[3].split(".")[0]
+
+def fetch_perturbagen_rows(map_src_name, api_url):
     tok = map_src_name.split('.')
     pert_plate, replicate = '.'.join(tok[:-1]),tok[-1]
 
     map_src_url = api_url + 'v_plate_map_src/'
-    data = get_data_from_db(
+    return get_data_from_db(
         map_src_url,
         user_key=API_KEY,
         where={'pert_plate': pert_plate, 'replicate': replicate}
     )
 
+def _read_perturbagen_from_db(map_src_name, api_url):
+    data = fetch_perturbagen_rows(map_src_name, api_url)
+
     return parse_data.parse_json(data, Perturbagen)
 
 
@@ -212,11 +230,19 @@ def _read_perturbagen_from_db(map_src_name, api_url):
 def _add_pert_time_info(perturbagens, pert_time):
 
     pert_time_unit = "h"
+    pert_itime = pert_time + " " + pert_time_unit
+
+    table = parse_data.get_table(perturbagens)
+    if table is not None:
+        table.set_column("pert_time", [pert_time] * table.n_rows)
+        table.set_column("pert_time_unit", [pert_time_unit] * table.n_rows)
+        table.set_column("pert_itime", [pert_itime] * table.n_rows)
+        return
 
     for p in perturbagens:
         p.pert_time = pert_time
         p.pert_time_unit = pert_time_unit
-        p.pert_itime = p.pert_time + " " + p.pert_time_unit
+        p.pert_itime = pert_itime
 
 
 def convert_objects_to_metadata_df(index_builder, object_list, meta_renaming_map):
@@ -228,22 +254,20 @@ def convert_objects_to_metadata_df(index_builder, object_list, meta_renaming_map
     :param meta_renaming_map: A mapping between the name of a property and the column header to be used in the output.
     :return: A dataframe where each row corresponds to one of the objects in the object list.
     """
-    logger.debug("len(object_list):  {}".format(len(object_list)))
-
-    col_metadata_map = {}
-    for p in object_list:
-        for k in p.__dict__.keys():
-            if k not in col_metadata_map:
-                col_metadata_map[k] = []
- 
-    logger.debug("col_metadata_map.keys():  {}".format(col_metadata_map.keys()))
-    index = []
-    for p in object_list:
-        index.append(index_builder(p))
+    index = [index_builder(p) for p in object_list]
+    return convert_columns_to_metadata_df(parse_data.get_columns(object_list), index, meta_renaming_map)
+
 
-        for (field, list) in col_metadata_map.items():
-            value = p.__dict__[field] if field in p.__dict__ else None
-            list.append(value)
+def convert_columns_to_metadata_df(col_metadata_map, index, meta_renaming_map):
+    """
+
+    :param col_metadata_map: columns of the metadata, e.g. from parse_data.get_columns
+    :param index: unique index for each row
+    :param meta_renaming_map: A mapping between the name of a property and the column header to be used in the output.
+    :return: A dataframe with one column per entry of col_metadata_map
+    """
+    logger.debug("len(index):  {}".format(len(index)))
+    logger.debug("col_metadata_map.keys():  {}".format(col_metadata_map.keys()))
 
     if meta_renaming_map is not None:
         for (original_name, new_name) in meta_renaming_map.items():
@@ -257,5 +281,3 @@ def convert_objects_to_metadata_df(index_builder, object_list, meta_renaming_map
                 ))
 
     return pandas.DataFrame(col_metadata_map, index=index)
-
-
@@ -1,10 +1,13 @@
 import assemble
 import unittest
+import time
 import merino.setup_logger as setup_logger
 import logging
 import os
 import glob
 import mock
+import tempfile
+import prism_metadata
 
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
@@ -154,6 +157,80 @@ class TestAssemble(unittest.TestCase):
             assert x > 0
             os.remove(map_file)
 
+    def test_batch_main(self):
+        project_dir = tempfile.mkdtemp()
+        plates = ["PTST001_PR500_120H_X1_B1", "PTST001_PR500_120H_X2_B1", "PTST001_PR500_120H_X2.A_B1"]
+        wells = ["A01", "A02", "B01"]
+
+        for plate in plates:
+            os.makedirs(os.path.join(project_dir, "lxb", plate))
+            with open(os.path.join(project_dir, "lxb", plate, plate + ".jcsv"), "w") as f:
+                f.write("Date,10/18/2016,10:01 AM\n\n")
+                for datatype in ["Median", "Count"]:
+                    f.write("DataType:,{}\n".format(datatype))
+                    f.write("Location,Analyte 1,Analyte 2\n")
+                    for (i, w) in enumerate(wells):
+                        f.write("\"{}(1,{})\",{},{}\n".format(i + 1, w, 10 * i + 1, 10 * i + 2))
+                    f.write("\n")
+
+        def build_perturbagens(args, tp, api_url, bundle=None):
+            perts = []
+            for w in wells:
+                p = prism_metadata.Perturbagen(pert_well=w)
+                p.pert_id = "BRD-" + w
+                p.pert_dose = 1.0
+                p.pert_type = "trt_cp"
+                perts.append(p)
+            return perts
+
+        def build_prism_cell_list(assay_type, beadset, api_url, bundle=None):
+            return [prism_metadata.PrismCell(pool_id="P1", analyte_id="Analyte {}".format(i), davepool_id=assay_type,
+                                             feature_id="c-{}".format(i)) for i in [1, 2]]
+
+        args = assemble.build_parser().parse_args(["-plates", ",".join(plates), "-project_dir", project_dir,
+                                                   "-at", "PR500", "-n_workers", "2"])
+
+        with mock.patch("assemble.build_perturbagens", side_effect=build_perturbagens) as perts_mock, \
+                mock.patch("assemble.build_prism_cell_list", side_effect=build_prism_cell_list) as cells_mock:
+            r = assemble.batch_main(args)
+
+        self.assertEqual(0, r)
+        # X2 and X2.A share the PTST001.X2 map
+        self.assertEqual(2, perts_mock.call_count)
+        self.assertEqual(1, cells_mock.call_count)
+
+        for plate in plates:
+            plate_dir = os.path.join(project_dir, "PTST001_PR500_120H", "assemble", plate)
+            for suffix in ["_MEDIAN.gct", "_COUNT.gct", "_inst_info.txt"]:
+                assert os.path.exists(os.path.join(plate_dir, plate + suffix)), plate + suffix
+            assert os.path.exists(os.path.join(plate_dir, "success.txt")), plate
+            assert os.path.exists(os.path.join(plate_dir, "fingerprint.txt")), plate
+
+        def median_mtime(plate):
+            return os.path.getmtime(os.path.join(project_dir, "PTST001_PR500_120H", "assemble", plate, plate + "_MEDIAN.gct"))
+
+        mtimes = {plate:median_mtime(plate) for plate in plates}
+        time.sleep(0.01)
+
+        # rerun with unchanged inputs skips every plate, a changed jcsv rebuilds only that plate
+        with open(os.path.join(project_dir, "lxb", plates[0], plates[0] + ".jcsv"), "a") as f:
+            f.write("\n")
+
+        with mock.patch("assemble.build_perturbagens", side_effect=build_perturbagens), \
+                mock.patch("assemble.build_prism_cell_list", side_effect=build_prism_cell_list):
+            r = assemble.batch_main(args)
+
+        self.assertEqual(0, r)
+        self.assertNotEqual(mtimes[plates[0]], median_mtime(plates[0]))
+        for plate in plates[1:]:
+            self.assertEqual(mtimes[plate], median_mtime(plate))
+
+        args.force = True
+        with mock.patch("assemble.build_perturbagens", side_effect=build_perturbagens), \
+                mock.patch("assemble.build_prism_cell_list", side_effect=build_prism_cell_list):
+            assemble.batch_main(args)
+        self.assertNotEqual(mtimes[plates[1]], median_mtime(plates[1]))
+
 if __name__ == "__main__":
     setup_logger.setup(verbose=True)
 
@@ -7,6 +7,8 @@ import davepool_data
 import numpy
 import os
 import glob
+import tempfile
+import h5py
 
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
@@ -31,17 +33,16 @@ class TestAssembleWithObjects(unittest.TestCase):
         logger.debug("cells:  {}".format(cells))
 
         davepool_data_obj = davepool_data.DavepoolData()
-        davepool_data_obj.median_headers = ["Location", "10", "11"]
+        davepool_data_obj.median_headers = ["10", "11"]
         davepool_data_obj.median_headers.extend([str(x) for x in range(30,40)])
 
-        davepool_data_obj.median_data = {"A01": [1,2], "J13": [3,5]}
-        davepool_data_obj.median_data['A01'].extend([x for x in range(40,50)])
-        davepool_data_obj.median_data['J13'].extend([x for x in range(50,60)])
+        davepool_data_obj.well_list = ["A01", "J13"]
+        davepool_data_obj.median_data = numpy.array([[1,2] + list(range(40,50)), [3,5] + list(range(50,60))],
+                                                    dtype=numpy.float32)
 
         davepool_data_obj.count_headers = davepool_data_obj.median_headers
-        davepool_data_obj.count_data = {"B03": [7,11], "L17": [13,17]}
-        davepool_data_obj.count_data["B03"].extend([x for x in range(60,70)])
-        davepool_data_obj.count_data["L17"].extend([x for x in range(70,80)])
+        davepool_data_obj.count_data = numpy.array([[7,11] + list(range(60,70)), [13,17] + list(range(70,80))],
+                                                   dtype=numpy.int32)
         logger.debug("davepool_data_obj:  {}".format(davepool_data_obj))
 
         rep = assemble_core.build_data_by_cell(cells, davepool_data_obj)
@@ -53,20 +54,34 @@ class TestAssembleWithObjects(unittest.TestCase):
         assert len(r_med.well_list) == 2, len(r_med.well_list)
         assert "A01" in r_med.well_list, r_med.well_list
         assert "J13" in r_med.well_list, r_med.well_list
-        assert len(r_med.cell_data_map) == len(cells), (len(r_med.cell_data_map), len(cells))
+        assert r_med.data.shape == (len(cells), 2), r_med.data.shape
+        assert r_med.cell_list == cells, r_med.cell_list
+        assert list(r_med.data[1]) == [2, 5], r_med.data
 
 
         r_count = rep[1]
         assert len(r_count.well_list) == 2, len(r_count.well_list)
         logger.debug("r_count.well_list:  {}".format(r_count.well_list))
-        assert "B03" in r_count.well_list, r_count.well_list
-        assert "L17" in r_count.well_list, r_count.well_list
+        assert r_count.well_list == r_med.well_list, r_count.well_list
+        assert list(r_count.data[1]) == [11, 17], r_count.data
 
-        assert len(r_count.cell_data_map) == len(cells), (len(r_count.cell_data_map), len(cells))
-        logger.debug("r_count.cell_data_map:  {}".format(r_count.cell_data_map))
+        assert r_count.data.shape == (len(cells), 2), r_count.data.shape
+        logger.debug("r_count.data:  {}".format(r_count.data))
+
+        #ignored cells get NaN data
+        cells[0].ignore = True
+        rep = assemble_core.build_data_by_cell(cells, davepool_data_obj)
+        assert numpy.all(numpy.isnan(rep[0].data[0])), rep[0].data
+        assert list(rep[0].data[1]) == [2, 5], rep[0].data
+
+        #missing counts become NaN
+        cells[0].ignore = False
+        davepool_data_obj.count_data[1, 0] = davepool_data.count_null
+        rep = assemble_core.build_data_by_cell(cells, davepool_data_obj)
+        assert numpy.isnan(rep[1].data[0, 1]), rep[1].data
 
     def test_process_data(self):
-        cells = [prism_metadata.PrismCell(pool_id=str(x + 20), analyte_id=str(x + 10), davepool_id=str(x / 2)) for x in range(4)]
+        cells = [prism_metadata.PrismCell(pool_id=str(x + 20), analyte_id=str(x + 10), davepool_id=str(x // 2)) for x in range(4)]
         logger.debug("cells:  {}".format(cells))
         cells_map = assemble_core.build_davepool_id_to_cells_map(cells)
         logger.debug("cells_map:  {}".format(cells_map))
@@ -77,15 +92,13 @@ class TestAssembleWithObjects(unittest.TestCase):
 
         davepool_data_obj.davepool_id = "0"
         davepool_data_obj.median_headers = [str(x) for x in range(10,22)]
-        davepool_data_obj.median_headers.insert(0, "Location")
-        davepool_data_obj.median_data = {"A01": [1,2], "J13": [3,5]}
-        davepool_data_obj.median_data["A01"].extend([x for x in range(40,50)])
-        davepool_data_obj.median_data["J13"].extend([x for x in range(50,60)])
+        davepool_data_obj.well_list = ["A01", "J13"]
+        davepool_data_obj.median_data = numpy.array([[1,2] + list(range(40,50)), [3,5] + list(range(50,60))],
+                                                    dtype=numpy.float32)
 
         davepool_data_obj.count_headers = davepool_data_obj.median_headers
-        davepool_data_obj.count_data = {"A01": [7,11], "J13": [13,17]}
-        davepool_data_obj.count_data["A01"].extend([x for x in range(60,70)])
-        davepool_data_obj.count_data["J13"].extend([x for x in range(70,80)])
+        davepool_data_obj.count_data = numpy.array([[7,11] + list(range(60,70)), [13,17] + list(range(70,80))],
+                                                   dtype=numpy.int32)
         logger.debug("davepool_data_obj:  {}".format(davepool_data_obj))
 
         davepool_data_obj = davepool_data.DavepoolData()
@@ -93,15 +106,13 @@ class TestAssembleWithObjects(unittest.TestCase):
 
         davepool_data_obj.davepool_id = "1"
         davepool_data_obj.median_headers = [str(x) for x in range(10,22)]
-        davepool_data_obj.median_headers.insert(0, "Location")
-        davepool_data_obj.median_data = {"A01": [-1,-2,19,23], "J13": [-3,-5,29,31]}
-        davepool_data_obj.median_data["A01"].extend([x for x in range(80,88)])
-        davepool_data_obj.median_data["J13"].extend([x for x in range(90,98)])
+        davepool_data_obj.well_list = ["A01", "J13"]
+        davepool_data_obj.median_data = numpy.array([[-1,-2,19,23] + list(range(80,88)),
+                                                     [-3,-5,29,31] + list(range(90,98))], dtype=numpy.float32)
 
         davepool_data_obj.count_headers = davepool_data_obj.median_headers
-        davepool_data_obj.count_data = {"A01": [-7,-11,37,41], "J13": [-13,-17,43,47]}
-        davepool_data_obj.count_data["A01"].extend([x for x in range(100,108)])
-        davepool_data_obj.count_data["J13"].extend([x for x in range(110,118)])
+        davepool_data_obj.count_data = numpy.array([[-7,-11,37,41] + list(range(100,108)),
+                                                    [-13,-17,43,47] + list(range(110,118))], dtype=numpy.int32)
         logger.debug("davepool_data_obj:  {}".format(davepool_data_obj))
 
         r = assemble_core.process_data(davepool_list, cells_map)
@@ -110,14 +121,14 @@ class TestAssembleWithObjects(unittest.TestCase):
         median_data_by_cell = r[0]
         assert median_data_by_cell is not None
         logger.debug("median_data_by_cell:  {}".format(median_data_by_cell))
-        assert 2 == median_data_by_cell.cell_data_map[cells[1]][0]
-        assert 3 == median_data_by_cell.cell_data_map[cells[0]][1]
+        assert 2 == median_data_by_cell.data[1, 0]
+        assert 3 == median_data_by_cell.data[0, 1]
         t_wells = median_data_by_cell.well_list
         logger.debug("t_wells:  {}".format(t_wells))
         assert "J13" in t_wells
 
-        assert 23 == median_data_by_cell.cell_data_map[cells[3]][0]
-        assert 29 == median_data_by_cell.cell_data_map[cells[2]][1]
+        assert 23 == median_data_by_cell.data[3, 0]
+        assert 29 == median_data_by_cell.data[2, 1]
 
     def test_build_gctoo(self):
         filepath = "functional_tests/test_assemble/test_write_output_gct.txt"
@@ -157,44 +168,101 @@ class TestAssembleWithObjects(unittest.TestCase):
                                      davepool_id="fake davepool 2", feature_id='c-7')
         cell_list.append(c)
 
-        data_by_cell = assemble_core.DataByCell({cell_list[1]:[1, 2, 11], cell_list[2]:[13, 17, 19], cell_list[0]:[23, 29, 31]},
+        data_by_cell = assemble_core.DataByCell([cell_list[1], cell_list[2], cell_list[0]],
+                                                numpy.array([[1, 2, 11], [13, 17, 19], [23, 29, 31]], dtype=float),
                                                 ["J01", "M03", "B02"])
 
-        r = assemble_core.build_gctoo(prn, pert_list, data_by_cell)
+        col_metadata_df = assemble_core.build_col_metadata_df(prn, pert_list)
+        row_metadata_df = assemble_core.build_row_metadata_df(data_by_cell.cell_list)
+        r = assemble_core.build_gctoo(prn, col_metadata_df, row_metadata_df, data_by_cell)
         self.assertIsNotNone(r)
+        self.assertEqual(["c-3", "c-5", "c-7"], list(r.data_df.index))
+        self.assertEqual(["my_prism_replicate:B02", "my_prism_replicate:J01", "my_prism_replicate:M03"],
+                         list(r.data_df.columns))
+        self.assertEqual(31, r.data_df.loc["c-3", "my_prism_replicate:B02"])
+        self.assertEqual(2, r.data_df.loc["c-5", "my_prism_replicate:M03"])
         logger.debug("r:  {}".format(r))
         logger.debug("r.col_metadata_df:  {}".format(r.col_metadata_df))
         logger.debug("r.row_metadata_df:  {}".format(r.row_metadata_df))
         logger.debug("r.data_df:  {}".format(r.data_df))
 
+    def test_process_extra_data(self):
+        cells = [prism_metadata.PrismCell(pool_id="1", analyte_id=str(x), davepool_id=str(x // 2)) for x in range(10, 14)]
+        cells_map = assemble_core.build_davepool_id_to_cells_map(cells)
+
+        davepool_list = []
+        for (davepool_id, headers, values) in [("5", ["11", "10"], [[1, 2], [3, 4]]), ("6", ["12", "13"], [[5, 6], [7, 8]])]:
+            dd = davepool_data.DavepoolData(davepool_id=davepool_id, well_list=["A01", "B01"])
+            dd.extra_headers["Net MFI"] = headers
+            dd.extra_data["Net MFI"] = numpy.array(values, dtype=numpy.float32)
+            davepool_list.append(dd)
+
+        r = assemble_core.process_extra_data(davepool_list, cells_map)
+        self.assertEqual(["Net MFI"], list(r.keys()))
+
+        net_mfi = r["Net MFI"]
+        logger.debug("net_mfi:  {}".format(net_mfi))
+        self.assertEqual(cells, net_mfi.cell_list)
+        self.assertEqual(["A01", "B01"], net_mfi.well_list)
+        self.assertEqual([[2, 4], [1, 3], [5, 7], [6, 8]], net_mfi.data.tolist())
+
+        self.assertEqual({}, assemble_core.process_extra_data([davepool_data.DavepoolData()], cells_map))
+        self.assertEqual(["_MEDIAN.gct", "_COUNT.gct", "_inst_info.txt", "_NET_MFI.gct"],
+                         assemble_core.output_suffixes("gct", ["Net MFI"]))
+
+    def test_write_plate_container(self):
+        prn = "my_prism_replicate"
+        pert_list = [prism_metadata.Perturbagen(pert_well=w) for w in ["A01", "B01"]]
+        cell_list = [prism_metadata.PrismCell(pool_id="fake pool", analyte_id="fake analyte {}".format(i),
+                                              davepool_id="fake davepool", feature_id="c-{}".format(i)) for i in [1, 2]]
+
+        col_metadata_df = assemble_core.build_col_metadata_df(prn, pert_list)
+        row_metadata_df = assemble_core.build_row_metadata_df(cell_list)
+        median = assemble_core.DataByCell(cell_list, numpy.array([[1.5, 2.5], [3.5, numpy.nan]]), ["A01", "B01"])
+        count = assemble_core.DataByCell(cell_list, numpy.array([[10, 20], [30, numpy.nan]]), ["A01", "B01"])
+        median_gctoo = assemble_core.build_gctoo(prn, col_metadata_df, row_metadata_df, median)
+        count_gctoo = assemble_core.build_gctoo(prn, col_metadata_df, row_metadata_df, count)
+
+        outfile = os.path.join(tempfile.mkdtemp(), prn + assemble_core._container_suffix)
+        assemble_core.write_plate_container(median_gctoo, count_gctoo, outfile)
+
+        with h5py.File(outfile, "r") as f:
+            #matrices are stored columns x rows, as in any gctx
+            median_matrix = f["/0/DATA/0/matrix"][()]
+            self.assertEqual(numpy.float32, median_matrix.dtype)
+            self.assertEqual(1.5, median_matrix[0, 0])
+
+            count_dataset = f[assemble_core._container_count_node]
+            self.assertEqual(numpy.int32, count_dataset.dtype)
+            self.assertEqual([[10, 30], [20, -666]], count_dataset[()].tolist())
+            self.assertEqual(-666, count_dataset.attrs["null_value"])
+
+            self.assertEqual([b"c-1", b"c-2"], list(f["/0/META/ROW/id"][()]))
+
+        self.assertEqual([assemble_core._container_suffix], assemble_core.output_suffixes("gctx"))
+        self.assertEqual(3, len(assemble_core.output_suffixes("gct")))
+
     def test_build_gctoo_data_df(self):
         #happy path - all numbers
-        cell_id_data_map = {"cell1":[0,1,2,3], "cell2":[5,7,11,13]}
+        data = numpy.array([[0,1,2,3], [5,7,11,13]], dtype=float)
         data_df_column_ids = ["s1", "s2", "s3", "s5"]
-        r = assemble_core.build_gctoo_data_df(cell_id_data_map, data_df_column_ids)
+        r = assemble_core.build_gctoo_data_df(data, ["cell1", "cell2"], data_df_column_ids)
         self.assertIsNotNone(r)
         logger.debug("r:  {}".format(r))
-        self.assertEquals(True, all(data_df_column_ids == r.columns),
+        self.assertEqual(True, all(data_df_column_ids == r.columns),
                           "columns of result do not match provided columns - data_df_column_ids:  {}  r.columns:  {}".format(
                               data_df_column_ids, r.columns))
         #check that index entries are present and sorted
-        self.assertEquals("cell1", r.index[0])
-        self.assertEquals("cell2", r.index[1])
+        self.assertEqual("cell1", r.index[0])
+        self.assertEqual("cell2", r.index[1])
 
-        #2nd happy path - blank entry present in data
-        cell_id_data_map["cell1"][1] = ""
-        cell_id_data_map["cell2"][2] = ""
-        r = assemble_core.build_gctoo_data_df(cell_id_data_map, data_df_column_ids)
-        self.assertIsNotNone(r)
+        #2nd happy path - rows and columns provided out of order are sorted along with the data
+        r = assemble_core.build_gctoo_data_df(data, ["cell2", "cell1"], ["s5", "s3", "s2", "s1"])
         logger.debug("r:  {}".format(r))
-        s = r["s2"].loc["cell1"]
-        logger.debug("s:  {}".format(s))
-        self.assertEquals(assemble_core._NaN, s, "expected blank empty string to be replaced with _NaN, was not")
-
-        s = r["s3"].loc["cell2"]
-        logger.debug("s:  {}".format(s))
-        self.assertEquals(assemble_core._NaN, s, "expected blank empty string to be replaced with _NaN, was not")
-
+        self.assertEqual(["cell1", "cell2"], list(r.index))
+        self.assertEqual(["s1", "s2", "s3", "s5"], list(r.columns))
+        self.assertEqual(13, r["s1"].loc["cell1"])
+        self.assertEqual(0, r["s5"].loc["cell2"])
 
 
 
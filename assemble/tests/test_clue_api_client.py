@@ -0,0 +1,88 @@
+import logging
+import setup_logger as setup_logger
+import unittest
+import tempfile
+import mock
+import clue_api_client
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+url = "https://api.clue.io/api/cell_set_definition_files?filter={%22where%22:{%22davepool_id%22:%22PR500%22}}"
+
+
+def build_response(status_code, data=None, etag=None):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.json.return_value = data
+    response.headers = {"ETag": etag} if etag else {}
+    return response
+
+
+class TestClueApiClient(unittest.TestCase):
+    def test_get_json(self):
+        client = clue_api_client.ClueApiClient(cache_dir=tempfile.mkdtemp(), ttl=3600, offline=False)
+        client.session.get = mock.Mock(return_value=build_response(200, [{"analyte_id": "Analyte 1"}], etag='"abc"'))
+
+        #first call goes to the API
+        r = client.get_json(url, headers={"user_key": "fake"})
+        self.assertEqual([{"analyte_id": "Analyte 1"}], r)
+        self.assertEqual(1, client.session.get.call_count)
+        self.assertEqual(1, client.stats["miss"])
+
+        #second call is served from the cache, also by a new client using the same directory
+        r = client.get_json(url, headers={"user_key": "fake"})
+        self.assertEqual([{"analyte_id": "Analyte 1"}], r)
+        self.assertEqual(1, client.session.get.call_count)
+        self.assertEqual(1, client.stats["hit"])
+
+        other_client = clue_api_client.ClueApiClient(cache_dir=client.cache_dir, ttl=3600, offline=False)
+        other_client.session.get = mock.Mock()
+        r = other_client.get_json(url)
+        self.assertEqual([{"analyte_id": "Analyte 1"}], r)
+        other_client.session.get.assert_not_called()
+
+    def test_get_json_revalidate(self):
+        client = clue_api_client.ClueApiClient(cache_dir=tempfile.mkdtemp(), ttl=0, offline=False)
+        client.session.get = mock.Mock(return_value=build_response(200, {"assay_variant": "PR500"}, etag='"abc"'))
+        client.get_json(url)
+
+        #expired entry is revalidated with its etag
+        client.session.get = mock.Mock(return_value=build_response(304))
+        r = client.get_json(url)
+        self.assertEqual({"assay_variant": "PR500"}, r)
+        self.assertEqual('"abc"', client.session.get.call_args[1]["headers"]["If-None-Match"])
+        self.assertEqual(1, client.stats["revalidated"])
+
+    def test_default_ttl_revalidates(self):
+        client = clue_api_client.ClueApiClient(cache_dir=tempfile.mkdtemp(), offline=False, logger=logger)
+        self.assertIs(logger, client.logger)
+        client.session.get = mock.Mock(return_value=build_response(200, {"map_src": "old"}, etag='"abc"'))
+        client.get_json(url)
+
+        #without a ttl a cached response is always checked with the server, a changed map is picked up
+        client.session.get = mock.Mock(return_value=build_response(200, {"map_src": "fixed"}, etag='"def"'))
+        r = client.get_json(url)
+        self.assertEqual({"map_src": "fixed"}, r)
+        self.assertEqual('"abc"', client.session.get.call_args[1]["headers"]["If-None-Match"])
+
+    def test_get_json_offline(self):
+        client = clue_api_client.ClueApiClient(cache_dir=tempfile.mkdtemp(), ttl=0, offline=True)
+        client.session.get = mock.Mock()
+
+        with self.assertRaises(clue_api_client.OfflineCacheMiss):
+            client.get_json(url)
+
+        online_client = clue_api_client.ClueApiClient(cache_dir=client.cache_dir, ttl=0, offline=False)
+        online_client.session.get = mock.Mock(return_value=build_response(200, {"assay_variant": "PR500"}))
+        online_client.get_json(url)
+
+        #offline mode serves expired entries without calling the API
+        r = client.get_json(url)
+        self.assertEqual({"assay_variant": "PR500"}, r)
+        client.session.get.assert_not_called()
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
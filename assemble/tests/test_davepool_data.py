@@ -1,6 +1,9 @@
 import logging
 import merino.setup_logger as setup_logger
 import unittest
+import os
+import tempfile
+import numpy
 import davepool_data
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
@@ -30,36 +33,96 @@ class TestDavepoolData(unittest.TestCase):
 
         assert len(r.count_data) == 384, len(r.count_data)
 
-    def test_get_datatype_range(self):
-        data = [["a"], range(3), ["DataType:","my type"], range(4), range(5)]
+    def test_read_sections(self):
+        csv_filepath = os.path.join(tempfile.mkdtemp(), "fake.csv")
+        with open(csv_filepath, "w") as f:
+            f.write("Program,xPonent\n")
+            f.write("Date,10/18/2016,10:01 AM\n")
+            f.write("\n")
+            f.write("DataType:,Median\n")
+            f.write("Location,10,11\n")
+            f.write("\"1(1,A1)\",1.5,2\n")
+            f.write("\"2(1,B1)\",3\n")
+            f.write("\n")
+            f.write("DataType:,Net MFI\n")
+            f.write("Location,10,11\n")
+            f.write("\"1(1,A1)\",0.5,1\n")
+            f.write("\n")
+            f.write("DataType:,Count\n")
+            f.write("Location,10,11\n")
+            f.write("\"1(1,A1)\",7,11\n")
+            f.write("\"2(1,B1)\",13,\n")
+
+        (header_rows, sections) = davepool_data.read_sections(csv_filepath, ["Median", "Count"])
+        logger.debug("sections:  {}".format(sections))
+        assert len(header_rows) == 3, header_rows
+        assert set(sections.keys()) == {"Median", "Count"}, sections.keys()
+        (headers, rows) = sections["Median"]
+        assert headers == ["Location", "10", "11"], headers
+        assert len(rows) == 2, rows
 
-        r = davepool_data.get_datatype_range(data, ["my type"])
+        r = davepool_data.read_data(csv_filepath)
+        assert r.csv_datetime == "10/18/2016 10:01 AM", r.csv_datetime
+        assert r.well_list == ["A01", "B01"], r.well_list
+        assert r.median_headers == ["10", "11"], r.median_headers
+        assert r.median_data.dtype == numpy.float32, r.median_data.dtype
+        assert r.median_data[0, 0] == 1.5, r.median_data
+        assert numpy.isnan(r.median_data[1, 1]), r.median_data
+        assert numpy.issubdtype(r.count_data.dtype, numpy.integer), r.count_data.dtype
+        assert r.count_data[1, 0] == 13, r.count_data
+        assert r.count_data[1, 1] == davepool_data.count_null, r.count_data
+
+    def test_read_data_extra_datatypes(self):
+        csv_filepath = os.path.join(tempfile.mkdtemp(), "fake.csv")
+        with open(csv_filepath, "w") as f:
+            f.write("Date,10/18/2016,10:01 AM\n")
+            f.write("\n")
+            f.write("DataType:,Median\n")
+            f.write("Location,10,11\n")
+            f.write("\"1(1,A1)\",1.5,2\n")
+            f.write("\"2(1,B1)\",3,4\n")
+            f.write("\n")
+            f.write("DataType:,Net MFI\n")
+            f.write("Location,11,10\n")
+            f.write("\"2(1,B1)\",2.5,\n")
+            f.write("\"1(1,A1)\",1,0.5\n")
+            f.write("\n")
+            f.write("DataType:,Count\n")
+            f.write("Location,10,11\n")
+            f.write("\"1(1,A1)\",7,11\n")
+            f.write("\"2(1,B1)\",13,17\n")
+
+        r = davepool_data.read_data(csv_filepath, extra_datatype_names=["Net MFI", "Median"])
+        assert list(r.extra_data.keys()) == ["Net MFI"], r.extra_data.keys()
+        assert r.extra_headers["Net MFI"] == ["11", "10"], r.extra_headers
+        net_mfi = r.extra_data["Net MFI"]
+        assert net_mfi.dtype == numpy.float32, net_mfi.dtype
+        #rows follow the wells of the Median section
+        assert list(net_mfi[0]) == [1, 0.5], net_mfi
+        assert net_mfi[1, 0] == 2.5 and numpy.isnan(net_mfi[1, 1]), net_mfi
+
+        r.subset_wells({"B01"})
+        assert r.extra_data["Net MFI"].shape == (1, 2), r.extra_data
 
-        assert r is not None
-        logger.debug("r:  {}".format(r))
-        assert "my type" in r
-        r = r["my type"]
-        assert r[0] == 2, r[0]
-        assert r[1] == 6, r[1]
+        with self.assertRaises(Exception) as context:
+            davepool_data.read_data(csv_filepath, extra_datatype_names=["Trimmed Mean"])
+        assert "did not find expected DataType" in str(context.exception), str(context.exception)
 
-        r = davepool_data.get_datatype_range(data, ["unfounded"])
-        assert r is not None
-        logger.debug("r:  {}".format(r))
-        assert "unfounded" in r
-        r = r["unfounded"]
-        assert r[0] is None, r[0]
-        assert r[1] is None, r[1]
+        assert davepool_data.datatype_suffix("Net MFI") == "NET_MFI"
 
-        data.append(["DataType:", "another type"])
-        data.append(range(6))
-        r = davepool_data.get_datatype_range(data, ["my type"])
+    def test_build_data_matrix(self):
+        headers = ["Location", "10", "11", "12"]
+        rows = [["1(1,A1)", "1", "2", "3"], ["2(1,A2)", "4", "", "6"], ["3(1,A3)", "7"]]
 
-        assert r is not None
-        logger.debug("r:  {}".format(r))
-        assert "my type" in r
-        r = r["my type"]
-        assert r[0] == 2, r[0]
-        assert r[1] == 5, r[1]
+        (locations, r) = davepool_data.build_data_matrix(headers, rows, numpy.float32)
+        assert locations == ["1(1,A1)", "2(1,A2)", "3(1,A3)"], locations
+        assert r.shape == (3, 3), r.shape
+        assert numpy.isnan(r[1, 1]), r
+        assert numpy.isnan(r[2, 2]), r
+
+        (_, r) = davepool_data.build_data_matrix(headers, rows, numpy.int32)
+        assert r[0, 2] == 3, r
+        assert r[1, 1] == davepool_data.count_null, r
 
     def test_get_datetime_from_header_rows(self):
         header_rows = [[],["a","b","c"], range(5), [davepool_data.date_header, "first", "second"], [], range(7)]
@@ -77,17 +140,29 @@ class TestDavepoolData(unittest.TestCase):
         dd = davepool_data.DavepoolData()
 
         #happy path
-        dd.median_data = [[0], [1]]
-        dd.count_data = [[2], [3]]
+        dd.well_list = ["A01", "A02"]
+        dd.median_headers = ["10"]
+        dd.count_headers = ["10"]
+        dd.median_data = numpy.array([[0], [1]], dtype=numpy.float32)
+        dd.count_data = numpy.array([[2], [3]], dtype=numpy.int32)
         dd.validate_data()
 
         #invalid data path
-        dd.median_data[1].pop(0)
+        dd.median_data = dd.median_data[:1]
         with self.assertRaises(Exception) as context:
             dd.validate_data()
         assert context.exception is not None
         logger.debug("context.exception:  {}".format(context.exception))
-        assert "data row is empty" in str(context.exception)
+        assert "data shape does not match wells x headers" in str(context.exception)
+
+    def test_subset_wells(self):
+        dd = davepool_data.DavepoolData(well_list=["A01", "A02", "A03"],
+                                        median_data=numpy.array([[0], [1], [2]], dtype=numpy.float32),
+                                        count_data=numpy.array([[3], [4], [5]], dtype=numpy.int32))
+        dd.subset_wells({"A03", "A01"})
+        assert dd.well_list == ["A01", "A03"], dd.well_list
+        assert list(dd.median_data[:, 0]) == [0, 2], dd.median_data
+        assert list(dd.count_data[:, 0]) == [3, 5], dd.count_data
 
 
 if __name__ == "__main__":
@@ -0,0 +1,50 @@
+import logging
+import setup_logger as setup_logger
+import unittest
+import numpy as np
+import pandas as pd
+import dose_codec
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestDoseCodec(unittest.TestCase):
+    def test_format_numbers(self):
+        r = dose_codec.format_numbers([0.0123456, 2.5e-05, 10.0, 0, 1234567.0, float("nan")])
+        logger.debug("r:  {}".format(r))
+        self.assertEqual(["0.01235", "0.000025", "10.0", "0", "1235000.0", "nan"], r)
+
+    def test_encode_doses(self):
+        doses = pd.Series([0.0123456, 2.5e-05, np.nan, 0.0123456, "1.5|0.0123456", "nan"], index=list("abcdef"))
+        r = dose_codec.encode_doses(doses)
+        logger.debug("r:  {}".format(r))
+
+        self.assertEqual(list("abcdef"), list(r.index))
+        self.assertEqual(["0.01235", "0.000025"], list(r[["a", "b"]]))
+        self.assertTrue(np.isnan(r["c"]))
+        self.assertEqual("0.01235", r["d"])
+        self.assertEqual("1.5|0.01235", r["e"])
+        self.assertEqual("nan", r["f"])
+
+    def test_encode_idoses(self):
+        idoses = pd.Series(["10 uM", "2.5e-05 uM|3.33333333 nM", None])
+        r = dose_codec.encode_idoses(idoses)
+        logger.debug("r:  {}".format(r))
+
+        self.assertEqual("10.0 uM", r[0])
+        self.assertEqual("0.000025 uM|3.333 nM", r[1])
+        self.assertTrue(pd.isna(r[2]))
+
+        with self.assertRaises(ValueError):
+            dose_codec.encode_idoses(pd.Series(["ten uM"]))
+
+    def test_canonicalize_dose_columns(self):
+        df = pd.DataFrame({"pert_dose": ["0.0123456"], "pert_idose": ["0.0123456 uM"], "pert_id": ["BRD-K1"]})
+        r = dose_codec.canonicalize_dose_columns(df)
+        self.assertEqual(["0.01235", "0.01235 uM", "BRD-K1"], r.iloc[0].tolist())
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -0,0 +1,63 @@
+import logging
+import setup_logger as setup_logger
+import unittest
+import os
+import tempfile
+import mock
+import metadata_bundle
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestMetadataBundle(unittest.TestCase):
+    def test_parse_plate_requests(self):
+        plates = ["PCAL001_PR500_120H_X1_B1", "PCAL001_PR500_120H_X1.A_B1", "PCAL001_PR300_120H_X2_B2"]
+        (map_src_names, beadsets) = metadata_bundle.parse_plate_requests(plates)
+        self.assertEqual({"PCAL001.X1", "PCAL001.X2"}, map_src_names)
+        self.assertEqual({"B1", "B2"}, beadsets)
+
+        (_, beadsets) = metadata_bundle.parse_plate_requests(plates, beadset="B9")
+        self.assertEqual({"B9"}, beadsets)
+
+    def test_prefetch(self):
+        plates = ["PCAL001_PR500_120H_X1_B1", "PCAL001_PR500_120H_X2_B1", "PCAL002_PR300_120H_X1_B2"]
+
+        def fetch_perturbagen_rows(map_src_name, api_url):
+            return [{"pert_well": "A01", "pert_id": map_src_name, "pert_dose": "1.5"}]
+
+        def fetch_prism_cell_rows(cell_set_name, beadset, api_url):
+            return [{"analyte_id": "Analyte 1", "davepool_id": cell_set_name, "feature_id": "c-1"}]
+
+        with mock.patch("prism_metadata.get_assay_type_from_db", side_effect=lambda bs, api_url: {"B1": "PR500", "B2": "PR300"}[bs]) as assay_mock, \
+                mock.patch("prism_metadata.fetch_perturbagen_rows", side_effect=fetch_perturbagen_rows) as perts_mock, \
+                mock.patch("prism_metadata.fetch_prism_cell_rows", side_effect=fetch_prism_cell_rows) as cells_mock:
+            bundle = metadata_bundle.prefetch(plates, "https://fake/api/", n_threads=4)
+
+        self.assertEqual(3, perts_mock.call_count)
+        self.assertEqual({"https://fake/api/"}, set(c[0][1] for c in assay_mock.call_args_list))
+        self.assertEqual(2, cells_mock.call_count)
+        logger.debug("bundle:  {}".format(bundle))
+
+        path = os.path.join(tempfile.mkdtemp(), "bundle.json.gz")
+        metadata_bundle.write_bundle(bundle, path)
+        r = metadata_bundle.read_bundle(path)
+
+        self.assertEqual("PR300", r.get_assay_type("B2"))
+
+        perts = r.build_perturbagens("PCAL002.X1", "120")
+        self.assertEqual(1, len(perts))
+        self.assertEqual("PCAL002.X1", perts[0].pert_id)
+        self.assertEqual(1.5, perts[0].pert_dose)
+        self.assertEqual("120 h", perts[0].pert_itime)
+
+        cells = r.build_prism_cell_list("PR500", "B1")
+        self.assertEqual("PR500", cells[0].davepool_id)
+
+        with self.assertRaises(KeyError):
+            r.build_prism_cell_list("PR500", "B2")
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
@@ -2,6 +2,10 @@ import merino.setup_logger as setup_logger
 import logging
 import unittest
 import configparser
+import io
+import os
+import tempfile
+import mock
 import parse_data as pd
 
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
@@ -94,6 +98,91 @@ class TestParseData(unittest.TestCase):
         assert isinstance(r[1].compound_well_mmoles_per_liter, float)
         assert isinstance(r[1].dilution_factor, int)
 
+    def test_read_table(self):
+        content = "Pool_ID\tAnalyte_ID\tFeature_ID\textra\r\n" + \
+                  "1\tAnalyte 2\tc-1\tx\r\n" + \
+                  "#3\tAnalyte 4\tc-2\tx\r\n" + \
+                  "\n" + \
+                  "5\tAnalyte 6\r\n"
+        tsv_filepath = os.path.join(tempfile.mkdtemp(), "cells.txt")
+        with open(tsv_filepath, "w", newline="") as f:
+            f.write(content)
+
+        items = [("pool_id", "pool_id"), ("analyte_id", "analyte_id"), ("feature_id", "feature_id")]
+        table = pd.read_table(tsv_filepath, items, False, defaults=(("ignore", False),), skip_comments=True)
+        logger.debug("table:  {}".format(table))
+
+        self.assertEqual(2, table.n_rows)
+        self.assertEqual(["ignore", "pool_id", "analyte_id", "feature_id"], list(table.columns.keys()))
+        #numeric columns are float arrays, others object arrays
+        self.assertEqual("float64", table.columns["pool_id"].dtype)
+        self.assertEqual([1.0, 5.0], table.columns["pool_id"].tolist())
+        self.assertEqual(object, table.columns["analyte_id"].dtype)
+        self.assertEqual(["Analyte 2", "Analyte 6"], table.columns["analyte_id"].tolist())
+        self.assertEqual({"feature_id": ["c-1", None]}, table.take(names=["feature_id"]))
+
+        #same content served over https
+        with mock.patch("urllib.request.urlopen", return_value=io.BytesIO(content.encode("utf-8"))) as urlopen_mock:
+            table = pd.read_table("https://fake.s3.amazonaws.com/cells.txt", items, False, skip_comments=True)
+        urlopen_mock.assert_called_once_with("https://fake.s3.amazonaws.com/cells.txt")
+        self.assertEqual(["Analyte 2", "Analyte 6"], table.columns["analyte_id"].tolist())
+
+        (h, d) = pd.read_data(tsv_filepath)
+        self.assertEqual(["pool_id", "analyte_id", "feature_id", "extra"], h)
+        self.assertEqual(3, len(d))
+
+    def test_parse_json_table(self):
+        data = [{"pert_well": "A01", "pert_dose": "1.5", "pert_id": "BRD-K1"},
+                {"pert_well": "B01", "pert_dose": "", "pert_id": "7"},
+                {"pert_well": "C01", "pert_dose": 3}]
+
+        table = pd.parse_json_table(data, defaults=(("pert_well", None), ("ignore", False)))
+        self.assertEqual(3, table.n_rows)
+        self.assertEqual(["pert_well", "ignore", "pert_dose", "pert_id"], list(table.columns.keys()))
+
+        #numeric column is converted as a whole, mixed column is parsed value by value
+        self.assertEqual([1.5, None, 3.0], table.columns["pert_dose"].tolist())
+        self.assertEqual("BRD-K1", table.columns["pert_id"][0])
+        self.assertEqual(7.0, table.columns["pert_id"][1])
+
+        r = table.take(names=["pert_id"])
+        self.assertEqual({"pert_id": ["BRD-K1", 7.0, None]}, r)
+
+    def test_metadata_row(self):
+        class Row(pd.MetadataRow):
+            __slots__ = ()
+            _defaults = (("pert_well", None),)
+
+        data = [{"pert_well": "A01", "pert_type": "trt_cp"}, {"pert_well": "B01"}]
+        rows = pd.parse_json(data, Row)
+
+        self.assertEqual("B01", rows[1].pert_well)
+        self.assertTrue(hasattr(rows[0], "pert_type"))
+        self.assertFalse(hasattr(rows[1], "pert_type"))
+        with self.assertRaises(AttributeError):
+            rows[0].__dict__
+
+        #writes go to the shared table
+        rows[1].pert_type = "ctl_vehicle"
+        self.assertIs(pd.get_table(rows), rows[0]._table)
+        self.assertEqual({"pert_well": ["A01", "B01"], "pert_type": ["trt_cp", "ctl_vehicle"]}, pd.get_columns(rows))
+
+        #a subset of the rows is gathered from the same table
+        self.assertIsNone(pd.get_table(rows[1:]))
+        self.assertEqual({"pert_well": ["B01"], "pert_type": ["ctl_vehicle"]}, pd.get_columns(rows[1:]))
+
+        #float columns hold python floats per row and become object columns when given another value
+        pd.get_table(rows).set_column("pert_dose", [1.5, 2.0])
+        self.assertEqual("float64", rows[0]._table.columns["pert_dose"].dtype)
+        self.assertIs(float, type(rows[1].pert_dose))
+        rows[1].pert_dose = "2 uM"
+        self.assertEqual([1.5, "2 uM"], pd.get_columns(rows)["pert_dose"])
+
+        pd.validate_columns(rows, ["pert_well", "pert_type"])
+        del rows[0].pert_type
+        with self.assertRaises(Exception):
+            pd.validate_columns(rows, ["pert_type"])
+
     def test__parse_raw_value(self):
         r = pd.parse_raw_value("")
         assert r is None
@@ -0,0 +1,60 @@
+import logging
+import setup_logger as setup_logger
+import unittest
+import numpy as np
+import plate_geometry
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+
+class TestPlateGeometry(unittest.TestCase):
+    def test_wells_to_indexes(self):
+        (r, g) = plate_geometry.wells_to_indexes(["A01", "A1", "B12", "P24"])
+        logger.debug("r:  {}  g:  {}".format(r, g))
+        self.assertEqual(384, g.n_wells)
+        self.assertEqual([0, 0, 35, 383], r.tolist())
+        self.assertEqual(["A01", "A01", "B12", "P24"], list(plate_geometry.indexes_to_wells(r, g)))
+
+        (r, g) = plate_geometry.wells_to_indexes(["H12"])
+        self.assertEqual(96, g.n_wells)
+        self.assertEqual([95], r.tolist())
+
+        (r, g) = plate_geometry.wells_to_indexes(["Z01", "AA01", "AF48"])
+        self.assertEqual(1536, g.n_wells)
+        self.assertEqual([25 * 48, 26 * 48, 1535], r.tolist())
+        self.assertEqual(["Z01", "AA01", "AF48"], list(plate_geometry.indexes_to_wells(r, g)))
+
+        (rows, cols) = plate_geometry.indexes_to_rowcol(r, g)
+        self.assertEqual([25, 26, 31], rows.tolist())
+        self.assertEqual([0, 0, 47], cols.tolist())
+
+        with self.assertRaises(ValueError):
+            plate_geometry.wells_to_indexes(["P24"], plate_geometry.get_geometry(96))
+        with self.assertRaises(ValueError):
+            plate_geometry.wells_to_indexes(["not a well"])
+
+    def test_locations_to_wells(self):
+        r = plate_geometry.locations_to_wells(["1(1,A1)", "2(1,B10)", "384(1,P24)", "1536(1,AF48)"])
+        self.assertEqual(["A01", "B10", "P24", "AF48"], r)
+        self.assertEqual([], plate_geometry.locations_to_wells([]))
+
+    def test_valid_wells(self):
+        r = plate_geometry.valid_wells(np.array(["A01", np.nan, "B1", None, "junk", "AF48"], dtype=object))
+        self.assertEqual([True, False, True, False, False, True], r.tolist())
+        self.assertEqual([], plate_geometry.valid_wells([]).tolist())
+
+    def test_isin_wells(self):
+        r = plate_geometry.isin_wells(["A01", "A02", "AB03"], {"A1", "AB3"})
+        self.assertEqual([True, False, True], r.tolist())
+
+        ((a, b), g) = plate_geometry.common_well_indexes(["A01", "B01"], ["B1"])
+        self.assertEqual(96, g.n_wells)
+        self.assertEqual([0, 12], a.tolist())
+        self.assertEqual([12], b.tolist())
+        self.assertEqual(np.int64, b.dtype)
+
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
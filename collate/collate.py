@@ -1,24 +1,59 @@
 import argparse
+import collections
+import concurrent.futures
 import glob
+import hashlib
+import itertools
 import logging
 import os
+import shutil
 import sys
 
 import cmapPy.pandasGEXpress.GCToo as GCToo
-import cmapPy.pandasGEXpress.concat as cg
 import cmapPy.pandasGEXpress.parse as pe
 import cmapPy.pandasGEXpress.write_gct as wg
 import cmapPy.pandasGEXpress.write_gctx as wgx
 import cmapPy.pandasGEXpress.subset_gctoo as sgt
-import merino.build_summary.ssmd_analysis as ssmd
 import merino.misc_tools.cut_to_l2 as cut_to_l2
 import merino.setup_logger as setup_logger
 import pandas as pd
 import numpy as np
+import h5py
 from math import floor, log10
 
+import long_table
+import ssmd
+
 logger = logging.getLogger(setup_logger.LOGGER_NAME)
 
+# per-plate containers written by assemble -output_format gctx
+container_suffix = "_ASSEMBLE.gctx"
+container_count_node = "/0/DATA/COUNT/matrix"
+container_matrix_node = "/0/DATA/0/matrix"
+container_row_id_node = "/0/META/ROW/id"
+
+# per-plate row metadata fields that are allowed to differ between plates
+plate_row_metadata_fields = ['det_plate', 'det_plate_scan_time', 'assay_plate_barcode']
+
+# number of rows of the output matrix reordered at a time when its columns are sorted
+_sort_chunk_rows = 64
+
+# plates submitted to the process pool per worker, parsed plates wait in memory until they are copied
+_plates_in_flight_per_worker = 2
+
+# --virtual: a plate container is referenced as is when its rows map onto the shared row order in at most this many
+# contiguous runs, otherwise its rows are written to a shard in the shared order
+_max_row_runs = 32
+_shard_matrix_node = "matrix"
+
+# plates with this many columns or fewer are reported as dropout failures
+_dropout_max_columns = 349
+
+# --append: size in bytes of the column blocks in which the LEVEL2 matrices are stored
+_append_chunk_bytes = 1 << 20
+
+CollatedMetadata = collections.namedtuple("CollatedMetadata", ["row_metadata_df", "col_metadata_df"])
+
 
 def build_parser():
 
@@ -39,50 +74,422 @@ def build_parser():
                         help="Barcode Ids to include (LUAS or CTLBC) as comma-separated string"
                              "Default is none",
                         type=str, default=None, required=False)
+    parser.add_argument("--input_format", "-if",
+                        help="gct reads the MEDIAN and COUNT gcts of each plate, gctx reads the per-plate containers "
+                             "written by assemble -output_format gctx",
+                        type=str, choices=["gct", "gctx"], default="gct", required=False)
+    parser.add_argument("--virtual", "-vds",
+                        help="write the LEVEL2 gctx files as HDF5 virtual datasets over the per-plate data instead of "
+                             "copying it, shards are written to {build_dir}/{cohort_name}_shards/ where needed",
+                        action="store_true", default=False)
+    parser.add_argument("--append", "-a",
+                        help="only add the plates that are not yet in the LEVEL2 gctx files and inst_info of build_dir, "
+                             "a full build is done when there are none",
+                        action="store_true", default=False)
+    parser.add_argument("--long_table", "-lt",
+                        help="also write {cohort_name}_LEVEL2_LONG.parquet, the MFI and COUNT melted into one row per "
+                             "rid and profile_id and joined with cell_info and inst_info for normalization, needs pyarrow",
+                        action="store_true", default=False)
+    parser.add_argument("--culture", "-cu",
+                        help="suffix added to the rids of the long table, the assay passed to normalize.R e.g. PR500",
+                        type=str, default=None, required=False)
+    parser.add_argument("--n_workers", "-nw", help="number of processes used to parse the plates, default is the number of cpus",
+                        type=int, default=None, required=False)
     parser.add_argument("--verbose", '-v', help="Whether to print a bunch of output", action="store_true", default=False)
 
 
     return parser
 
-def build(search_pattern, cut=True, check_size=False):
+def parse_plate_container(path, data_type, rid=None):
+    '''
+    read the MEDIAN or COUNT data of a plate from its container.  The container is a gctx whose matrix is MEDIAN,
+    COUNT is stored as integers at container_count_node and shares the row and column metadata
+    :param path:
+    :param data_type: MEDIAN or COUNT
+    :param rid: ids of the rows to read, default is all of them
+    :return: GCToo
+    '''
+    if data_type == 'MEDIAN':
+        return pe.parse(path, rid=rid)
+
+    row_metadata_df = pe.parse(path, row_meta_only=True, rid=rid)
+    col_metadata_df = pe.parse(path, col_meta_only=True)
+    with h5py.File(path, 'r') as f:
+        file_row_ids = pd.Index(_read_ids(f[container_row_id_node]))
+        positions = file_row_ids.get_indexer(row_metadata_df.index)
+        # h5py reads increasing positions only, the rows are put back in order afterwards
+        order = np.argsort(positions)
+        dataset = f[container_count_node]
+        null_value = dataset.attrs.get('null_value', -666)
+        counts = np.empty((len(positions), dataset.shape[0]), dtype=np.float64)
+        counts[order] = dataset[:, positions[order]].transpose()
+
+    counts[counts == null_value] = np.nan
+    data_df = pd.DataFrame(counts, index=row_metadata_df.index, columns=col_metadata_df.index)
+    return GCToo.GCToo(data_df=data_df, row_metadata_df=row_metadata_df, col_metadata_df=col_metadata_df)
+
+
+def parse_plate(path, data_type=None):
+    if path.endswith(container_suffix):
+        return parse_plate_container(path, data_type)
+    return pe.parse(path)
+
+
+def kept_row_ids(row_metadata_df, bcids_to_remove):
+    '''
+    ids of the rows whose barcode_id is not in bcids_to_remove
+    '''
+    if not bcids_to_remove:
+        return row_metadata_df.index
+    return row_metadata_df.index[~row_metadata_df.barcode_id.isin(bcids_to_remove)]
+
+
+def parse_plate_rows(path, data_type=None, bcids_to_remove=None):
+    '''
+    read a plate without the rows whose barcode_id is in bcids_to_remove.  Only the kept rows are read from plate
+    containers, gcts are parsed whole and subset before they are returned
+    :return: (GCToo of the kept rows, row metadata of all the rows of the plate)
+    '''
+    if not bcids_to_remove:
+        gctoo = parse_plate(path, data_type)
+        return (gctoo, gctoo.row_metadata_df)
+
+    if path.endswith(container_suffix):
+        row_metadata_df = pe.parse(path, row_meta_only=True)
+        gctoo = parse_plate_container(path, data_type, rid=list(kept_row_ids(row_metadata_df, bcids_to_remove)))
+        return (gctoo, row_metadata_df)
+
+    gctoo = pe.parse(path)
+    row_metadata_df = gctoo.row_metadata_df
+    return (sgt.subset_gctoo(gctoo, rid=list(kept_row_ids(row_metadata_df, bcids_to_remove))), row_metadata_df)
+
+
+def find_plates(search_pattern, cut=True):
     gct_list = glob.glob(search_pattern)
     old_len = len(gct_list)
 
     if old_len == 0:
-        return None, None
+        return []
 
     if cut==True:
         gct_list = cut_to_l2.cut_l1(gct_list)
 
-    new_len = len(gct_list)
-
-    logger.info('Number of old lysate plates removed = {}'.format(old_len - new_len))
-
-    if new_len == 0:
-        return None, None
-    gcts = []
-    failure_list = []
-    for gct in gct_list:
-        temp = pe.parse(gct)
-        gcts.append(temp)
-        if temp.data_df.shape[1] <= 349 and check_size == True:
-            failure_list.append(os.path.basename(gct).replace('_NORM.gct', ''))
-
-    for ct in gcts:
-        ct.row_metadata_df = gcts[0].row_metadata_df
-
-    fields_to_remove = [x for x in gcts[0].row_metadata_df.columns if
-                        x in ['det_plate', 'det_plate_scan_time', 'assay_plate_barcode']]
-
+    logger.info('Number of old lysate plates removed = {}'.format(old_len - len(gct_list)))
 
-    concat_gct = cg.hstack(gcts, False, None, fields_to_remove=fields_to_remove)
+    return gct_list
 
-    concat_gct_wo_meta = GCToo.GCToo(data_df = concat_gct.data_df, row_metadata_df = pd.DataFrame(index=concat_gct.data_df.index),
-                                     col_metadata_df=pd.DataFrame(index=concat_gct.col_metadata_df.index))
 
-#    logger.debug(outfile + 'n{}x{}'.format(concat_gct.data_df.shape[1], concat_gct.data_df.shape[0]) + file_suffix)
+def read_plate_dims(path):
+    '''
+    (number of rows, number of columns) of a plate read from the header of its gct or the shape of its gctx matrix,
+    without parsing the data
+    '''
+    if path.endswith('.gctx'):
+        with h5py.File(path, 'r') as f:
+            (n_cols, n_rows) = f[container_matrix_node].shape
+        return (n_rows, n_cols)
+
+    with open(path) as f:
+        f.readline()
+        dims = f.readline().strip().split('\t')
+    return (int(dims[0]), int(dims[1]))
+
+
+def hash_row_metadata(row_metadata_df, fields_to_remove):
+    '''
+    hash of the row metadata of a plate, ignoring fields_to_remove and the order of the rows and columns
+    '''
+    df = row_metadata_df.drop([x for x in fields_to_remove if x in row_metadata_df.columns], axis=1)
+    df = df.sort_index().sort_index(axis=1)
+    h = hashlib.sha256()
+    h.update('\t'.join([str(x) for x in df.columns]).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
+
+def _parse_plate_task(task):
+    '''
+    parse one plate in a worker.  Only the first plate sends its row metadata back, the others send its hash
+    :return: (index, data_df, row metadata of the first plate or None, col_metadata_df, row metadata hash)
+    '''
+    (index, path, data_type, bcids_to_remove) = task
+    (gctoo, row_metadata_df) = parse_plate_rows(path, data_type, bcids_to_remove)
+    row_metadata_hash = hash_row_metadata(row_metadata_df, plate_row_metadata_fields)
+    return (index, gctoo.data_df, row_metadata_df if index == 0 else None, gctoo.col_metadata_df, row_metadata_hash)
+
+
+def completed_in_window(executor, fn, tasks, window):
+    '''
+    yield fn(task) for the tasks in the order they complete, with at most window of them submitted to executor at a
+    time
+    '''
+    tasks = iter(tasks)
+    pending = set(executor.submit(fn, task) for task in itertools.islice(tasks, window))
+    while pending:
+        future = next(concurrent.futures.as_completed(pending))
+        pending.remove(future)
+        for task in itertools.islice(tasks, 1):
+            pending.add(executor.submit(fn, task))
+        yield future.result()
+
+
+def sort_columns_in_place(matrix, order):
+    '''
+    matrix[:, :] = matrix[:, order], reordering a chunk of rows at a time so that only one chunk is copied
+    '''
+    for start in range(0, matrix.shape[0], _sort_chunk_rows):
+        chunk = matrix[start:start + _sort_chunk_rows]
+        chunk[:] = chunk[:, order]
+
+
+def build(search_pattern, cut=True, check_size=False, data_type=None, n_workers=None, bcids_to_remove=None):
+    '''
+    concatenate the plates matching search_pattern horizontally, see collate_plates
+    :param search_pattern: glob of the plates
+    :param cut: remove old lysate plates with cut_to_l2.cut_l1
+    :return: (GCToo, list of failed plates, row metadata of all the rows)
+    '''
+    gct_list = find_plates(search_pattern, cut=cut)
+    if len(gct_list) == 0:
+        return None, None, None
+
+    return collate_plates(gct_list, check_size=check_size, data_type=data_type, n_workers=n_workers,
+                          bcids_to_remove=bcids_to_remove)
+
+
+def collate_plates(gct_list, check_size=False, data_type=None, n_workers=None, bcids_to_remove=None):
+    '''
+    concatenate plates horizontally.  The plates are parsed across a process pool, at most
+    _plates_in_flight_per_worker per worker at a time, and each one is copied into its column slab of an output matrix
+    allocated once from the dimensions in the file headers as soon as it is parsed.  The row metadata of every plate
+    is compared by hash with the one of the first plate, which is used for all of them, apart from
+    plate_row_metadata_fields which are removed.  Rows whose barcode_id is in bcids_to_remove are dropped by the
+    workers as each plate is read, they never reach the output matrix
+    :param gct_list: paths of the plates
+    :param check_size: list the plates with 349 columns or less as failures
+    :param data_type: MEDIAN or COUNT, the data read from plate containers
+    :param n_workers: number of processes, default is the number of cpus
+    :param bcids_to_remove: barcode_ids of the rows to leave out
+    :return: (GCToo, list of failed plates, row metadata of the first plate as read, including the rows left out)
+    '''
+    new_len = len(gct_list)
 
-    return concat_gct, failure_list
+    dims = [read_plate_dims(gct) for gct in gct_list]
+    offsets = np.concatenate([[0], np.cumsum([d[1] for d in dims])])
+
+    failure_list = [os.path.basename(gct).replace('_NORM.gct', '') for (gct, d) in zip(gct_list, dims)
+                    if d[1] <= 349 and check_size == True]
+
+    n_rows = None
+    row_ids = None
+    row_metadata_df = None
+    all_row_metadata_df = None
+    row_metadata_hashes = [None] * new_len
+    col_metadata_dfs = [None] * new_len
+    column_ids = [None] * new_len
+    matrix = None
+
+    tasks = [(i, gct, data_type, bcids_to_remove) for (i, gct) in enumerate(gct_list)]
+    n_workers = n_workers if n_workers else os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # the plates complete in any order, each one is released once it has been copied into its slab
+        for (i, data_df, plate_row_metadata_df, plate_col_metadata_df, row_metadata_hash) in completed_in_window(
+                executor, _parse_plate_task, tasks, n_workers * _plates_in_flight_per_worker):
+            if matrix is None:
+                row_ids = data_df.index.sort_values()
+                n_rows = len(row_ids)
+                logger.info("allocating output matrix of {} rows x {} columns for {} plates".format(
+                    n_rows, offsets[-1], new_len))
+                matrix = np.empty((n_rows, offsets[-1]), dtype=data_df.values.dtype)
+
+            if data_df.shape != (n_rows, dims[i][1]) or not data_df.index.sort_values().equals(row_ids):
+                raise Exception("collate build rows or columns of {} do not match - data_df.shape:  {}  expected:  {}".format(
+                    gct_list[i], data_df.shape, (n_rows, dims[i][1])))
+
+            if i == 0:
+                all_row_metadata_df = plate_row_metadata_df
+                fields_to_remove = [x for x in all_row_metadata_df.columns if x in plate_row_metadata_fields]
+                row_metadata_df = all_row_metadata_df.drop(fields_to_remove, axis=1).sort_index(axis=1).loc[row_ids]
+                if n_rows < all_row_metadata_df.shape[0]:
+                    removed = all_row_metadata_df.index.difference(row_ids)
+                    logger.info("removing {} indexes of the excluded barcode_ids".format(len(removed)))
+                    logger.debug("removed indexes:  {}".format(','.join(removed)))
+
+            matrix[:, offsets[i]:offsets[i + 1]] = data_df.loc[row_ids].values
+            row_metadata_hashes[i] = row_metadata_hash
+            column_ids[i] = data_df.columns
+            col_metadata_dfs[i] = plate_col_metadata_df
+            logger.debug("copied {} into columns {}:{}".format(gct_list[i], offsets[i], offsets[i + 1]))
+
+    for (gct, row_metadata_hash) in zip(gct_list[1:], row_metadata_hashes[1:]):
+        if row_metadata_hash != row_metadata_hashes[0]:
+            logger.warning("row metadata of {} differs from the row metadata of the other plates, the row metadata "
+                           "of {} is used".format(gct, os.path.basename(gct_list[0])))
+
+    all_column_ids = np.concatenate([np.asarray(c, dtype=object) for c in column_ids])
+    column_order = np.argsort(all_column_ids, kind='stable')
+    sort_columns_in_place(matrix, column_order)
+
+    data_df = pd.DataFrame(matrix, index=row_ids, columns=pd.Index(all_column_ids[column_order], name=column_ids[0].name), copy=False)
+    col_metadata_df = pd.concat(col_metadata_dfs, axis=0).sort_index(axis=0).sort_index(axis=1)
+
+    concat_gct = GCToo.GCToo(data_df=data_df, row_metadata_df=row_metadata_df, col_metadata_df=col_metadata_df)
+
+    return concat_gct, failure_list, all_row_metadata_df
+
+
+def row_runs(positions):
+    '''
+    contiguous runs of a mapping from output rows to source rows
+    :param positions: source row of each output row
+    :return: list of (first output row, first source row, length)
+    '''
+    if len(positions) == 0:
+        return []
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    starts = np.concatenate([[0], breaks])
+    ends = np.concatenate([breaks, [len(positions)]])
+    return [(int(a), int(positions[a]), int(b - a)) for (a, b) in zip(starts, ends)]
+
+
+def read_row_metadata(path):
+    if path.endswith('.gctx'):
+        return pe.parse(path, row_meta_only=True)
+    return pe.parse(path).row_metadata_df
+
+
+def _prepare_shard_task(task):
+    '''
+    locate the data of one plate for the virtual dataset.  The MEDIAN or COUNT matrix of a plate container is used in
+    place when its rows map onto row_ids in few runs, HDF5 converts the integer counts to float32 as they are read;
+    otherwise (gct input, counts holding the null value, which has to be read as NaN, or rows in another order) the
+    plate is written to shard_path as float32 in the order of row_ids
+    :return: (index, source path, source node, source shape, row runs, col_metadata_df, row metadata hash)
+    '''
+    (i, path, data_type, row_ids, shard_path, fields_to_remove) = task
+
+    if path.endswith(container_suffix):
+        node = container_count_node if data_type == 'COUNT' else container_matrix_node
+        with h5py.File(path, 'r') as f:
+            source_row_ids = pd.Index([x.decode('utf-8') if isinstance(x, bytes) else x for x in f[container_row_id_node][()]])
+            dataset = f[node]
+            (shape, dtype) = (dataset.shape, dataset.dtype)
+            if data_type == 'COUNT':
+                in_place = np.issubdtype(dtype, np.integer) and \
+                    not (dataset[()] == dataset.attrs.get('null_value', -666)).any()
+            else:
+                in_place = dtype == np.float32
+        positions = source_row_ids.get_indexer(row_ids)
+        if in_place and (positions >= 0).all():
+            runs = row_runs(positions)
+            if len(runs) <= _max_row_runs:
+                row_metadata_df = pe.parse(path, row_meta_only=True)
+                col_metadata_df = pe.parse(path, col_meta_only=True)
+                return (i, path, node, shape, runs, col_metadata_df,
+                        hash_row_metadata(row_metadata_df, fields_to_remove))
+
+    gctoo = parse_plate(path, data_type)
+    missing = row_ids.difference(gctoo.data_df.index)
+    if len(missing) > 0:
+        raise Exception("collate rows of {} do not match the rows of the other plates - missing:  {}".format(path, list(missing)))
+
+    matrix = gctoo.data_df.loc[row_ids].values.transpose().astype(np.float32)
+    with h5py.File(shard_path, 'w') as f:
+        f.create_dataset(_shard_matrix_node, data=matrix)
+
+    col_metadata_df = gctoo.col_metadata_df.loc[gctoo.data_df.columns]
+    return (i, shard_path, _shard_matrix_node, matrix.shape, [(0, 0, len(row_ids))], col_metadata_df,
+            hash_row_metadata(gctoo.row_metadata_df, fields_to_remove))
+
+
+def write_virtual_gctx(outfile, sources, row_metadata_df, col_metadata_df):
+    '''
+    write a gctx whose matrix is an HDF5 virtual dataset over the plates in sources, next to its row and column
+    metadata written as usual.  Source files are referenced relative to outfile, which is where HDF5 looks for them
+    :param outfile:
+    :param sources: (path, node, shape, row runs) for each plate in column order, shapes are columns x rows as in gctx
+    :param row_metadata_df: rows of the output, in order
+    :param col_metadata_df: columns of the output, in order
+    :return:
+    '''
+    n_cols = sum([shape[0] for (_, _, shape, _) in sources])
+    layout = h5py.VirtualLayout(shape=(n_cols, row_metadata_df.shape[0]), dtype=np.float32)
+
+    out_dir = os.path.dirname(os.path.abspath(outfile))
+    col_offset = 0
+    for (path, node, shape, runs) in sources:
+        vsource = h5py.VirtualSource(os.path.relpath(os.path.abspath(path), out_dir), node, shape=shape)
+        for (out_start, src_start, length) in runs:
+            layout[col_offset:col_offset + shape[0], out_start:out_start + length] = \
+                vsource[:, src_start:src_start + length]
+        col_offset += shape[0]
+
+    with h5py.File(outfile, 'w') as f:
+        wgx.write_version(f)
+        f.attrs[wgx.src_attr] = outfile
+        f.create_virtual_dataset(wgx.data_matrix_node, layout, fillvalue=np.nan)
+        wgx.write_metadata(f, "col", col_metadata_df.copy(), True, gzip_compression=6)
+        wgx.write_metadata(f, "row", row_metadata_df.copy(), True, gzip_compression=6)
+
+    logger.info("virtual gctx of {} plates has been written to {}".format(len(sources), outfile))
+
+
+def build_virtual(search_pattern, out_path, shard_dir, cut=True, data_type=None, bcids_to_remove=None, n_workers=None):
+    '''
+    collate the plates matching search_pattern into a gctx whose matrix is an HDF5 virtual dataset over the plates, in
+    the shared row order of the first plate.  The plates are ordered by their column ids; rows whose barcode_id is in
+    bcids_to_remove are left out
+    :param search_pattern: glob of the plates
+    :param out_path: prefix of the output, the dimensions and .gctx are appended as by write_gctx_with_dims
+    :param shard_dir: directory of the shards written for plates that cannot be referenced as they are
+    :return: (CollatedMetadata with the row metadata and the column metadata, path of the gctx, row metadata of the
+    first plate as read)
+    '''
+    gct_list = find_plates(search_pattern, cut=cut)
+    if len(gct_list) == 0:
+        return None, None, None
+
+    first_row_metadata_df = read_row_metadata(gct_list[0])
+    fields_to_remove = [x for x in first_row_metadata_df.columns if x in plate_row_metadata_fields]
+    row_metadata_df = first_row_metadata_df.drop(fields_to_remove, axis=1).sort_index().sort_index(axis=1)
+
+    out_row_metadata_df = row_metadata_df
+    if bcids_to_remove:
+        out_row_metadata_df = row_metadata_df.loc[~row_metadata_df.barcode_id.isin(bcids_to_remove)]
+        removed = row_metadata_df.index.difference(out_row_metadata_df.index)
+        logger.info("removing {} indexes of the excluded barcode_ids".format(len(removed)))
+        logger.debug("removed indexes:  {}".format(','.join(removed)))
+    row_ids = out_row_metadata_df.index
+    first_row_hash = hash_row_metadata(first_row_metadata_df, fields_to_remove)
+
+    if not os.path.exists(shard_dir):
+        os.makedirs(shard_dir)
+
+    tasks = []
+    for (i, gct) in enumerate(gct_list):
+        shard_name = os.path.splitext(os.path.basename(gct))[0]
+        if not shard_name.endswith(data_type):
+            shard_name = shard_name + '_' + data_type
+        tasks.append((i, gct, data_type, row_ids, os.path.join(shard_dir, shard_name + '.h5'), fields_to_remove))
+
+    results = []
+    n_workers = n_workers if n_workers else os.cpu_count()
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        for r in executor.map(_prepare_shard_task, tasks):
+            if r[6] != first_row_hash:
+                logger.warning("row metadata of {} differs from the row metadata of the other plates, the row metadata "
+                               "of {} is used".format(gct_list[r[0]], os.path.basename(gct_list[0])))
+            results.append(r)
+
+    results.sort(key=lambda r: str(r[5].index[0]) if r[5].shape[0] > 0 else '')
+    col_metadata_df = pd.concat([r[5] for r in results], axis=0).sort_index(axis=1)
+
+    outfile = out_path.rstrip('_') + '_n{}x{}'.format(col_metadata_df.shape[0], len(row_ids)) + '.gctx'
+    # like write_gctx_with_dims, the LEVEL2 files only carry the ids, the metadata goes to inst_info and cell_info
+    write_virtual_gctx(outfile, [(r[1], r[2], r[3], r[4]) for r in results],
+                       pd.DataFrame(index=row_ids), pd.DataFrame(index=col_metadata_df.index))
+
+    return CollatedMetadata(row_metadata_df, col_metadata_df), outfile, first_row_metadata_df
 
 
 def mk_gct_list(search_pattern):
@@ -103,27 +510,52 @@ def mk_gct_list(search_pattern):
     return gct_list
 
 
-def mk_cell_metadata(args, failed_plates=None):
-    mfi_paths = glob.glob(os.path.join(args.proj_dir, args.search_pattern, 'assemble', args.search_pattern, '*MEDIAN.gct'))
+def mk_cell_metadata(args, cell_info):
+    # cell_info is the row metadata collected by build, the plates are not parsed again
+    cell_info.to_csv(os.path.join(args.build_dir, args.cohort_name + '_cell_info.txt'), sep='\t')
+
+
+def find_ssmd_gct(args):
+    paths = glob.glob(os.path.join(args.build_dir, args.cohort_name + '_ssmd_matrix_n*.gct'))
+    return paths[0] if paths else None
+
 
-    cell_temp = pe.parse(mfi_paths[0])
-    cell_temp.row_metadata_df.to_csv(os.path.join(args.build_dir, args.cohort_name + '_cell_info.txt'), sep='\t')
+def mk_qc_reports(args, data_df, row_metadata_df, col_metadata_df, append=False):
+    '''
+    write the SSMD matrix of the cell lines on each plate and failed_plates.txt, listing the plates with
+    _dropout_max_columns columns or fewer and the plates whose median SSMD is below ssmd.failure_threshold.  With
+    append, the plates of data_df are added to the reports already in build_dir
+    :param data_df: collated MFI, only its control columns are used
+    '''
+    ssmd_df = ssmd.ssmd_matrix(data_df, col_metadata_df)
+    plate_columns = col_metadata_df.prism_replicate.astype(str).value_counts()
+    fails_dict = {'dropout_failures': sorted(plate_columns[plate_columns <= _dropout_max_columns].index),
+                  'ssmd_failures': ssmd.failed_plates(ssmd_df, row_metadata_df)}
 
-    if failed_plates:
-        # Calculate SSMD matrix using paths that were just grabbed and write out
-        ssmd_mat = ssmd.ssmd_matrix(cut_to_l2.cut_l1(paths))
+    existing = find_ssmd_gct(args) if append else None
+    if existing is not None:
+        existing_df = pe.parse(existing).data_df
+        ssmd_df = pd.concat([existing_df.loc[:, ~existing_df.columns.isin(ssmd_df.columns)], ssmd_df], axis=1)
+        os.remove(existing)
 
-        ssmd_gct = GCToo.GCToo(data_df=ssmd_mat, col_metadata_df=pd.DataFrame(index=ssmd_mat.columns),
-                               row_metadata_df=pd.DataFrame(index=ssmd_mat.index))
-        wg.write(ssmd_gct, os.path.join(args.build_dir, args.cohort_name + '_ssmd_matrix_n{}_{}.gct'.format(ssmd_gct.data_df.shape[1], ssmd_gct.data_df.shape[0])))
+    fails_path = os.path.join(args.build_dir, 'failed_plates.txt')
+    if append and os.path.exists(fails_path):
+        existing_fails = pd.read_csv(fails_path, sep='\t', dtype=str)
+        for k in fails_dict:
+            previous = [x for x in existing_fails[k].dropna() if x not in plate_columns.index]
+            fails_dict[k] = sorted(set(previous + fails_dict[k]))
 
-        ssmd_failures = ssmd_gct.data_df.median()[ssmd_gct.data_df.median() < 2].index.tolist()
-        fails_dict = dict({'dropout_failures': failed_plates, 'ssmd_failures': ssmd_failures})
-        fails_df = pd.DataFrame(dict([(k, pd.Series(v)) for k, v in fails_dict.iteritems()]))
-        fails_df.to_csv(os.path.join(args.build_dir, 'failed_plates.txt'), sep='\t', index=False)
+    ssmd_gct = GCToo.GCToo(data_df=ssmd_df, col_metadata_df=pd.DataFrame(index=ssmd_df.columns),
+                           row_metadata_df=pd.DataFrame(index=ssmd_df.index))
+    wg.write(ssmd_gct, os.path.join(args.build_dir, args.cohort_name + '_ssmd_matrix_n{}_{}.gct'.format(ssmd_gct.data_df.shape[1], ssmd_gct.data_df.shape[0])))
 
+    fails_df = pd.DataFrame(dict([(k, pd.Series(v, dtype=object)) for k, v in fails_dict.items()]))
+    fails_df.to_csv(fails_path, sep='\t', index=False, columns=['dropout_failures', 'ssmd_failures'])
+    logger.info("SSMD of {} plates, dropout failures:  {}  ssmd failures:  {}".format(
+        ssmd_df.shape[1], len(fails_dict['dropout_failures']), len(fails_dict['ssmd_failures'])))
 
-def mk_inst_info(inst_data, args=None):
+
+def mk_inst_info(inst_data, args=None, append=False):
 
     inst_info = inst_data.col_metadata_df
     inst_info['profile_id'] = inst_info.index
@@ -133,14 +565,156 @@ def mk_inst_info(inst_data, args=None):
 
     inst_info.set_index('profile_id', inplace=True)
 
-    inst_info.to_csv(os.path.join(args.build_dir, args.cohort_name + '_inst_info.txt'), sep='\t')
+    inst_info_path = os.path.join(args.build_dir, args.cohort_name + '_inst_info.txt')
+    if append and os.path.exists(inst_info_path):
+        # existing rows are kept as they were written, only the new profiles are added
+        existing = pd.read_csv(inst_info_path, sep='\t', dtype=str, keep_default_na=False, index_col='profile_id')
+        inst_info = pd.concat([existing, inst_info.loc[~inst_info.index.isin(existing.index)]], axis=0, sort=False)
+
+    inst_info.to_csv(inst_info_path, sep='\t')
+    return inst_info
+
+
+def mk_long_table(args, sources, cell_info, inst_info, append=False):
+    '''
+    write the long table of the MEDIAN and COUNT data collated by this run, see long_table.write_long_table
+    :param sources: dict of MEDIAN and COUNT, each the collated data_df or the path of a collated gctx
+    :param inst_info: as returned by mk_inst_info
+    :param append: add the data to the existing table instead of replacing it
+    '''
+    path = long_table.long_table_path(args.build_dir, args.cohort_name)
+    # as normalize.R reads inst_info, every field is a string and missing values are empty
+    inst_info = inst_info.astype(object).where(inst_info.notna(), '').astype(str)
+
+    (mfi, count) = (sources['MEDIAN'], sources['COUNT'])
+    if isinstance(mfi, pd.DataFrame):
+        if not (count.index.equals(mfi.index) and count.columns.equals(mfi.columns)):
+            count = count.loc[mfi.index, mfi.columns]
+        long_table.write_long_table(path, mfi.values.transpose(), count.values.transpose(), list(mfi.index),
+                                    list(mfi.columns), cell_info, inst_info, args.culture, append=append)
+        return
+
+    ids = read_collated_ids(mfi)
+    if read_collated_ids(count) != ids:
+        raise Exception("collate long table rows or columns of {} and {} do not match".format(mfi, count))
+    # the gctx files are read a block of columns at a time
+    with h5py.File(mfi, 'r') as mfi_file, h5py.File(count, 'r') as count_file:
+        long_table.write_long_table(path, mfi_file[wgx.data_matrix_node], count_file[wgx.data_matrix_node], ids[0], ids[1],
+                                    cell_info, inst_info, args.culture, append=append)
+
+
+def gctx_path_with_dims(outfile, n_cols, n_rows):
+    return outfile.rstrip('_')+'_n{}x{}'.format(n_cols, n_rows) + '.gctx'
+
+
+def write_resizable_gctx(data, path):
+    '''
+    write a gctx like write_gctx.write, with a matrix chunked by blocks of columns that can be extended by append_gctx
+    '''
+    matrix = data.data_df.transpose().values.astype(np.float32)
+    chunks = (max(1, min(matrix.shape[0], _append_chunk_bytes // (4 * max(1, matrix.shape[1])))), max(1, matrix.shape[1]))
+
+    with h5py.File(path, 'w') as f:
+        wgx.write_version(f)
+        f.attrs[wgx.src_attr] = path
+        f.create_dataset(wgx.data_matrix_node, data=matrix, maxshape=(None, matrix.shape[1]), chunks=chunks)
+        wgx.write_metadata(f, "col", data.col_metadata_df.copy(), True, gzip_compression=6)
+        wgx.write_metadata(f, "row", data.row_metadata_df.copy(), True, gzip_compression=6)
 
 
 def write_gctx_with_dims(data, outfile):
     logger.info("gct shape: {}".format(data.data_df.shape))
-    logger.info("gct shape: {}".format(data.data_df.shape))
-    path = outfile.rstrip('_')+'_n{}x{}'.format(data.data_df.shape[1], data.data_df.shape[0]) + '.gctx'
-    wgx.write(data, path)
+    path = gctx_path_with_dims(outfile, data.data_df.shape[1], data.data_df.shape[0])
+    write_resizable_gctx(data, path)
+
+
+def find_collated_gctx(outfile):
+    '''
+    the gctx written for outfile by write_gctx_with_dims, None when there is none
+    '''
+    paths = glob.glob(gctx_path_with_dims(outfile, '*', '*'))
+    if len(paths) > 1:
+        raise Exception("collate found more than one collated gctx for {} - paths:  {}".format(outfile, paths))
+    return paths[0] if paths else None
+
+
+def _read_ids(dataset):
+    return [x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in dataset[()]]
+
+
+def read_collated_ids(path):
+    with h5py.File(path, 'r') as f:
+        return (_read_ids(f[wgx.row_meta_group_node + '/id']), _read_ids(f[wgx.col_meta_group_node + '/id']))
+
+
+def plate_name(path):
+    '''
+    prism_replicate of a plate file, e.g. PMTS001_PR500_120H_X1_B1 for .../PMTS001_PR500_120H_X1_B1_MEDIAN.gct
+    '''
+    name = os.path.basename(path)
+    for suffix in [container_suffix, '_MEDIAN.gct', '_COUNT.gct']:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return os.path.splitext(name)[0]
+
+
+def collated_replicates(column_ids):
+    # column ids are {prism_replicate}:{well}
+    return set([c.rsplit(':', 1)[0] for c in column_ids])
+
+
+def append_gctx(path, data, outfile):
+    '''
+    add the columns of data to the collated gctx at path, with the rows in the order of the file.  The matrix is
+    extended in place when it is resizable, gctx written before it was are rewritten once.  The file is then renamed
+    to its new dimensions
+    :param path: existing gctx
+    :param data: GCToo of the new plates, holding at least the rows of the gctx
+    :param outfile: prefix of the gctx, as passed to write_gctx_with_dims
+    :return: path of the gctx
+    '''
+    (row_ids, column_ids) = read_collated_ids(path)
+    missing = pd.Index(row_ids).difference(data.data_df.index)
+    if len(missing) > 0:
+        raise Exception("collate append rows of the new plates do not match the rows of {} - missing:  {}".format(
+            path, list(missing)))
+
+    new_matrix = data.data_df.loc[row_ids].transpose().values.astype(np.float32)
+    all_column_ids = column_ids + list(data.data_df.columns)
+    new_path = gctx_path_with_dims(outfile, len(all_column_ids), len(row_ids))
+
+    with h5py.File(path, 'a') as f:
+        dataset = f[wgx.data_matrix_node]
+        resizable = dataset.maxshape[0] is None and not dataset.is_virtual
+        if resizable:
+            n_cols = dataset.shape[0]
+            dataset.resize(n_cols + new_matrix.shape[0], axis=0)
+            dataset[n_cols:] = new_matrix
+
+            # ids are small, they are written again rather than resized
+            del f[wgx.col_meta_group_node]
+            wgx.write_metadata(f, "col", pd.DataFrame(index=pd.Index(all_column_ids)), True, gzip_compression=6)
+            f.attrs[wgx.src_attr] = new_path
+        else:
+            existing_matrix = dataset[()]
+
+    if resizable:
+        os.rename(path, new_path)
+    else:
+        logger.info("{} cannot be extended in place, rewriting it".format(path))
+        matrix = np.concatenate([existing_matrix, new_matrix], axis=0).transpose()
+        gctoo = GCToo.GCToo(data_df=pd.DataFrame(matrix, index=pd.Index(row_ids), columns=pd.Index(all_column_ids)),
+                            row_metadata_df=pd.DataFrame(index=pd.Index(row_ids)),
+                            col_metadata_df=pd.DataFrame(index=pd.Index(all_column_ids)))
+        tmp_path = new_path + '.tmp'
+        write_resizable_gctx(gctoo, tmp_path)
+        with h5py.File(tmp_path, 'a') as f:
+            f.attrs[wgx.src_attr] = new_path
+        os.remove(path)
+        os.rename(tmp_path, new_path)
+
+    logger.info("appended {} columns to {}".format(new_matrix.shape[0], new_path))
+    return new_path
 
 
 def remove_metadata_from_gctoo(gctoo):
@@ -150,55 +724,135 @@ def remove_metadata_from_gctoo(gctoo):
         col_metadata_df=pd.DataFrame(index=gctoo.col_metadata_df.index)
     )
 
-def remove_bcids(ds, bcids_to_remove):
-    rmeta = ds.row_metadata_df
-
-    rm_indexes = rmeta.loc[
-        rmeta.barcode_id.isin(bcids_to_remove)
-    ].index
-
-    print("removing BCIDS:" + ','.join(bcids_to_remove))
-    print("removing indexes:" + ','.join(rm_indexes))
+def find_new_plates(search_pattern, existing, args):
+    '''
+    plates matching search_pattern whose prism_replicate is not in the existing collated gctx
+    '''
+    (_, column_ids) = read_collated_ids(existing)
+    done = collated_replicates(column_ids)
 
-    return sgt.subset_gctoo(ds, exclude_rid=rm_indexes)
+    inst_info_path = os.path.join(args.build_dir, args.cohort_name + '_inst_info.txt')
+    if os.path.exists(inst_info_path):
+        inst_replicates = set(pd.read_csv(inst_info_path, sep='\t', dtype=str, usecols=['profile_id'])['profile_id']
+                              .str.rsplit(':', n=1).str[0])
+        if inst_replicates != done:
+            logger.warning("replicates of {} and of {} differ, the gctx is used - only in gctx:  {}  only in inst_info:  {}".format(
+                existing, inst_info_path, sorted(done - inst_replicates), sorted(inst_replicates - done)))
 
+    plates = find_plates(search_pattern, cut=True)
+    new_plates = [p for p in plates if plate_name(p) not in done]
+    logger.info("{} of {} plates are already in {}, {} new plates".format(
+        len(plates) - len(new_plates), len(plates), existing, len(new_plates)))
+    return new_plates
 
 
 def main(args):
     search_pattern_dict = {
-        '*MEDIAN.gct': ['assemble', '_LEVEL2_MFI_'],
-        '*COUNT.gct': ['assemble', '_LEVEL2_COUNT_'],
+        '*MEDIAN.gct': ['assemble', '_LEVEL2_MFI_', 'MEDIAN'],
+        '*COUNT.gct': ['assemble', '_LEVEL2_COUNT_', 'COUNT'],
     }
 
     data_dict = {}
+    cell_info = None
+    qc_inputs = None
+    long_table_sources = {}
+    append_long_table = False
+
+    if args.long_table and args.culture is None:
+        raise Exception("collate --long_table needs --culture, the suffix of the rids used by normalize.R")
+
+    # normalize.R prefers the long table to the LEVEL2 gctx files, a table of an earlier run would no longer match them
+    long_table_path = long_table.long_table_path(args.build_dir, args.cohort_name)
+    long_table_exists = os.path.isdir(long_table_path)
+    if long_table_exists and not args.long_table:
+        logger.info("removing the long table of an earlier run, --long_table is not set:  {}".format(long_table_path))
+        shutil.rmtree(long_table_path)
+
+    bcids_to_remove = args.exclude_bcids.split(',') if args.exclude_bcids else None
+    if bcids_to_remove:
+        logger.info("removing following barcode_ids: " + ",".join(bcids_to_remove))
+
+    if args.append and args.virtual:
+        logger.info("virtual gctx files only reference the plates, they are built again instead of appended to")
+        args.append = False
 
     for key in search_pattern_dict:
+        # both data types are read from the same containers
+        file_pattern = '*' + container_suffix if args.input_format == 'gctx' else key
         path = os.path.join(args.proj_dir, args.search_pattern, search_pattern_dict[key][0],
-                            args.search_pattern,key)
+                            args.search_pattern, file_pattern)
 
         out_path = os.path.join(args.build_dir, args.cohort_name + search_pattern_dict[key][1])
 
         logger.info("working on {}".format(path))
 
-        data, _ = build(path, cut=True)
-        # exclude things here
-
-        if args.exclude_bcids:
-            bcids_to_remove = args.exclude_bcids.split(',')
-            logger.info("removing following barcode_ids: " + ",".join(bcids_to_remove))
-            data = remove_bcids(data, bcids_to_remove)
+        if args.virtual:
+            shard_dir = os.path.join(args.build_dir, args.cohort_name + '_shards')
+            data, outfile, all_row_metadata_df = build_virtual(path, out_path, shard_dir, cut=True,
+                                                               data_type=search_pattern_dict[key][2],
+                                                               bcids_to_remove=bcids_to_remove, n_workers=args.n_workers)
+            if search_pattern_dict[key][2] == 'MEDIAN':
+                cell_info = all_row_metadata_df
+                # only the control columns are read back through the virtual dataset
+                controls = ssmd.control_columns(data.col_metadata_df)
+                qc_data_df = pe.parse(outfile, cid=list(controls)).data_df if len(controls) > 0 else \
+                    pd.DataFrame(index=data.row_metadata_df.index, columns=controls, dtype=np.float64)
+                qc_inputs = (qc_data_df, data.row_metadata_df, data.col_metadata_df)
+            long_table_sources[search_pattern_dict[key][2]] = outfile
+            data_dict[key] = data
+            continue
+
+        existing = find_collated_gctx(out_path) if args.append else None
+        if existing is not None:
+            new_plates = find_new_plates(path, existing, args)
+            if len(new_plates) == 0:
+                logger.info("all plates are already in {}".format(existing))
+                continue
+
+            data, _, all_row_metadata_df = collate_plates(new_plates, data_type=search_pattern_dict[key][2], n_workers=args.n_workers,
+                                        bcids_to_remove=bcids_to_remove)
+            appended_path = append_gctx(existing, data, out_path)
+            if search_pattern_dict[key][2] == 'MEDIAN':
+                cell_info = all_row_metadata_df
+                qc_inputs = (data.data_df, data.row_metadata_df, data.col_metadata_df)
+            # without a table of the plates already collated, the whole table is written from the appended gctx
+            append_long_table = long_table_exists
+            long_table_sources[search_pattern_dict[key][2]] = data.data_df if long_table_exists else appended_path
+            data_dict[key] = data
+            continue
+
+        # excluded rows are dropped as the plates are read, cell_info still lists them
+        data, _, all_row_metadata_df = build(path, cut=True, data_type=search_pattern_dict[key][2],
+                                             n_workers=args.n_workers, bcids_to_remove=bcids_to_remove)
+        if search_pattern_dict[key][2] == 'MEDIAN':
+            cell_info = all_row_metadata_df
+            qc_inputs = (data.data_df, data.row_metadata_df, data.col_metadata_df)
 
         data_no_meta = remove_metadata_from_gctoo(data)
         write_gctx_with_dims(data_no_meta, out_path)
+        long_table_sources[search_pattern_dict[key][2]] = data.data_df
 
         data_dict[key] = data
 
-    mk_inst_info(data_dict['*MEDIAN.gct'], args=args)
+    if '*MEDIAN.gct' not in data_dict:
+        return
+
+    # QC is computed from the MFI collated above, before mk_inst_info takes over its column metadata
+    mk_qc_reports(args, *qc_inputs, append=args.append)
+
+    inst_info = mk_inst_info(data_dict['*MEDIAN.gct'], args=args, append=args.append)
+    cell_info = data_dict['*MEDIAN.gct'].row_metadata_df if cell_info is None else cell_info
+
+    if args.long_table:
+        if 'COUNT' in long_table_sources:
+            mk_long_table(args, long_table_sources, cell_info, inst_info, append=append_long_table)
+        else:
+            logger.warning("no COUNT data was collated, the long table is not written")
+
+    if args.append and os.path.exists(os.path.join(args.build_dir, args.cohort_name + '_cell_info.txt')):
+        return
 
-    try:
-        mk_cell_metadata(args, failure_list)
-    except Exception as e:
-        mk_cell_metadata(args)
+    mk_cell_metadata(args, cell_info)
 
 
 if __name__ == "__main__":
@@ -7,6 +7,12 @@ print_help () {
   printf -- "\t-cn, --cohort_name \t String designating the prefix to each build file (required)\n"
   printf -- "\t-sp, --search_pattern \t Search string in proj_dir, only run matching plates, default is wildcard '*' \n"
   printf -- "\t-x, --exclude_bcids \t Barcode Ids to include (LUAS or CTLBC) as comma-separated string. Default is none \n"
+  printf -- "\t-if, --input_format \t gct (default) or gctx to read the per-plate containers written by assemble \n"
+  printf -- "\t-vds, --virtual \t Write the LEVEL2 gctx files as HDF5 virtual datasets over the per-plate data \n"
+  printf -- "\t-a, --append \t\t Only add the plates that are not yet in the LEVEL2 gctx files of build_dir \n"
+  printf -- "\t-lt, --long_table \t Also write the MFI and COUNT as a Parquet long table joined with cell_info and inst_info \n"
+  printf -- "\t-cu, --culture \t\t Suffix of the rids of the long table, the assay passed to normalize e.g. PR500 \n"
+  printf -- "\t-nw, --n_workers \t Number of processes used to parse the plates, default is the number of cpus \n"
   printf -- "\t-v, --verbose \t\t Verbose flag, print additional output \n"
   printf -- "\t-h, --help \t\t Print this help text\n"
 }
@@ -43,6 +49,27 @@ while test $# -gt 0; do
       shift
       EXCLUDE_BCIDS=$1
       ;;
+    -if| --input_format)
+      shift
+      INPUT_FORMAT=$1
+      ;;
+    -a| --append)
+      APPEND=true
+      ;;
+    -lt| --long_table)
+      LONG_TABLE=true
+      ;;
+    -cu| --culture)
+      shift
+      CULTURE=$1
+      ;;
+    -vds| --virtual)
+      VIRTUAL=true
+      ;;
+    -nw| --n_workers)
+      shift
+      N_WORKERS=$1
+      ;;
     -v| --verbose)
       shift
       VERBOSE=true
@@ -85,6 +112,36 @@ then
   args+=(-x "$EXCLUDE_BCIDS")
 fi
 
+if [[ ! -z $INPUT_FORMAT ]]
+then
+  args+=(-if "$INPUT_FORMAT")
+fi
+
+if [[ ! -z $APPEND ]]
+then
+  args+=(-a)
+fi
+
+if [[ ! -z $VIRTUAL ]]
+then
+  args+=(-vds)
+fi
+
+if [[ ! -z $LONG_TABLE ]]
+then
+  args+=(-lt)
+fi
+
+if [[ ! -z $CULTURE ]]
+then
+  args+=(-cu "$CULTURE")
+fi
+
+if [[ ! -z $N_WORKERS ]]
+then
+  args+=(-nw "$N_WORKERS")
+fi
+
 if [[ ! -z $VERBOSE ]]
 then
   args+=(-v)
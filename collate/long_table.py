@@ -0,0 +1,130 @@
+"""
+Long table - the collated MFI and COUNT melted into one row per (rid, profile_id), joined with cell_info and
+inst_info as normalization/src/normalization_functions.R build_master_logMFI does, written as Parquet so that
+normalization can open it instead of melting and joining the LEVEL2 matrices itself.
+
+The table is a directory of Parquet files, one per collate run, that arrow reads as one dataset; --append adds a file
+for the new plates.  The matrices are melted a block of columns at a time and written as a row group, rid, profile_id
+and the metadata columns are dictionary encoded.
+
+pyarrow is only needed when the table is written.
+"""
+import glob
+import logging
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import merino.setup_logger as setup_logger
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+# cell_info fields kept by normalize.R
+cell_info_fields = ['ccle_name', 'pool_id', 'barcode_id']
+
+# pool_id of the control barcodes, which have an empty or -666 pool_id in cell_info
+control_barcode_pool = 'CTLBC'
+
+# number of values melted and written as one row group
+_block_values = 1 << 22
+
+
+def long_table_path(build_dir, cohort_name):
+    return os.path.join(build_dir, cohort_name + '_LEVEL2_LONG.parquet')
+
+
+def cell_table(cell_info, culture):
+    '''
+    cell_info as read by normalize.R - one row per rid, the rid suffixed with the culture and the control barcodes in
+    the CTLBC pool
+    :param cell_info: row metadata of the collated rows, indexed by rid
+    :return: DataFrame indexed by the rid of the matrices, with ccle_name, pool_id, barcode_id and culture as strings
+    '''
+    missing = [x for x in cell_info_fields if x not in cell_info.columns]
+    if len(missing) > 0:
+        raise Exception("long_table cell_info is missing fields - missing:  {}".format(missing))
+
+    table = cell_info[cell_info_fields].astype(str)
+    table = table.assign(pool_id=table.pool_id.where(~table.pool_id.isin(['', '-666', 'nan']), control_barcode_pool),
+                         culture=culture)
+    table.insert(0, 'rid', [str(x) + '_' + culture for x in cell_info.index])
+    return table
+
+
+def _dictionary_column(pa, values, codes):
+    '''
+    dictionary array of values[codes], with the distinct values as its dictionary
+    '''
+    (value_codes, uniques) = pd.factorize(np.asarray(values, dtype=object))
+    return pa.DictionaryArray.from_arrays(pa.array(value_codes[codes].astype(np.int32)), pa.array(uniques, type=pa.string()))
+
+
+def write_long_table(path, mfi, count, row_ids, column_ids, cell_info, inst_info, culture, append=False):
+    '''
+    write the long table of the collated matrices
+    :param path: directory of the table, see long_table_path
+    :param mfi: MFI, columns x rows as in gctx, sliceable by blocks of columns (numpy array or h5py dataset)
+    :param count: COUNT, same shape and order as mfi
+    :param row_ids: rids of the rows of the matrices
+    :param column_ids: profile_ids of the columns of the matrices
+    :param cell_info: row metadata, indexed by rid
+    :param inst_info: inst_info as written by collate, indexed by profile_id, strings
+    :param culture: suffix of the rids, the assay passed to normalize.R
+    :param append: add a file to the table instead of replacing it
+    :return: path of the file written
+    '''
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    if append and os.path.isdir(path):
+        part = len(glob.glob(os.path.join(path, 'part-*.parquet')))
+    else:
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        os.makedirs(path)
+        part = 0
+    part_path = os.path.join(path, 'part-{}.parquet'.format(part))
+
+    cells = cell_table(cell_info.loc[row_ids], culture)
+    insts = inst_info.loc[column_ids]
+    insts = insts.drop([x for x in insts.columns if x in cells.columns], axis=1)
+
+    n_rows = len(row_ids)
+    block_cols = max(1, _block_values // max(1, n_rows))
+    writer = None
+    n_written = 0
+    try:
+        for start in range(0, len(column_ids), block_cols):
+            stop = min(start + block_cols, len(column_ids))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                log_mfi = np.log2(np.asarray(mfi[start:stop], dtype=np.float64) + 1).reshape(-1)
+            counts = np.asarray(count[start:stop], dtype=np.float64).reshape(-1)
+
+            # as build_master_logMFI, entries without a finite logMFI are dropped, missing counts are kept as nulls
+            keep = np.flatnonzero(np.isfinite(log_mfi))
+            row_codes = (keep % n_rows).astype(np.int64)
+            col_codes = (keep // n_rows + start).astype(np.int64)
+
+            columns = [('rid', _dictionary_column(pa, cells.rid.values, row_codes)),
+                       ('profile_id', _dictionary_column(pa, insts.index.values, col_codes)),
+                       ('logMFI', pa.array(log_mfi[keep]))]
+            columns += [(c, _dictionary_column(pa, cells[c].values, row_codes)) for c in cells.columns if c != 'rid']
+            columns += [(c, _dictionary_column(pa, insts[c].values, col_codes)) for c in insts.columns]
+            columns += [('count', pa.array(counts[keep], from_pandas=True))]
+            instance_ids = np.char.add(np.char.add(insts.index.values[col_codes].astype(str), ':'),
+                                       cells.ccle_name.values[row_codes].astype(str))
+            columns += [('instance_id', pa.array(instance_ids, type=pa.string()))]
+
+            table = pa.Table.from_arrays([c for (_, c) in columns], names=[n for (n, _) in columns])
+            if writer is None:
+                writer = pq.ParquetWriter(part_path, table.schema)
+            writer.write_table(table)
+            n_written += table.num_rows
+    finally:
+        if writer is not None:
+            writer.close()
+
+    logger.info("long table of {} rows has been written to {}".format(n_written, part_path))
+    return part_path
@@ -0,0 +1,123 @@
+"""
+SSMD - strictly standardized mean difference between the vehicle and the positive control wells of each cell line on
+each plate of a cohort, computed as in qc/src/qc_functions.R:
+
+    ssmd = (median vehicle - median poscon) / sqrt(mad vehicle ^ 2 + mad poscon ^ 2)
+
+on log2 MFI.  The control columns of all the plates are gathered into one (rows x plates x wells) array padded with NaN
+so that the medians and MADs of every plate are reductions along its last axis rather than a loop over the plates.
+
+The module only depends on numpy and pandas.
+"""
+import warnings
+
+import numpy as np
+import pandas as pd
+
+negative_control = 'ctl_vehicle'
+positive_control = 'trt_poscon'
+
+# scale of the MAD used by R mad(), it makes the MAD of normally distributed values an estimate of their standard deviation
+mad_scale = 1.4826
+
+# plates whose median SSMD across cell lines is below this fail
+failure_threshold = 2
+
+# control barcodes are not cell lines, they are left out of the median SSMD of a plate
+control_barcode_pool = 'CTLBC'
+
+
+def control_columns(col_metadata_df):
+    '''
+    ids of the vehicle and positive control columns
+    '''
+    if 'pert_type' not in col_metadata_df.columns:
+        return col_metadata_df.index[:0]
+    return col_metadata_df.index[col_metadata_df.pert_type.isin([negative_control, positive_control])]
+
+
+def group_positions(groups, labels):
+    '''
+    positions of the members of each group, padded with -1
+    :param groups: group of each column
+    :param labels: groups in the order of the output, groups without members get a row of -1
+    :return: int array of shape (len(labels), size of the largest group)
+    '''
+    codes = pd.Index(labels).get_indexer(groups)
+    members = np.flatnonzero(codes >= 0)
+    codes = codes[members]
+
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes, minlength=len(labels))
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+    rank = np.arange(len(codes)) - np.repeat(starts, counts)
+
+    positions = np.full((len(labels), counts.max() if len(codes) > 0 else 0), -1, dtype=np.int64)
+    positions[codes[order], rank] = members[order]
+    return positions
+
+
+def grouped_median_mad(matrix, positions):
+    '''
+    median and scaled MAD of each row of matrix over the columns of each group, ignoring NaN
+    :param matrix: rows x columns
+    :param positions: output of group_positions
+    :return: (medians, mads), both rows x groups, NaN for groups without values
+    '''
+    if positions.shape[1] == 0:
+        empty = np.full((matrix.shape[0], positions.shape[0]), np.nan)
+        return (empty, empty.copy())
+
+    stacked = matrix[:, np.maximum(positions, 0)]
+    stacked[:, positions < 0] = np.nan
+
+    with warnings.catch_warnings():
+        # groups without values are NaN
+        warnings.simplefilter('ignore', RuntimeWarning)
+        medians = np.nanmedian(stacked, axis=2)
+        mads = mad_scale * np.nanmedian(np.abs(stacked - medians[:, :, np.newaxis]), axis=2)
+    return (medians, mads)
+
+
+def ssmd_matrix(data_df, col_metadata_df, plate_field='prism_replicate'):
+    '''
+    SSMD of each row of data_df on each plate
+    :param data_df: MFI, rows x columns, only its control columns are read so it may hold those alone
+    :param col_metadata_df: metadata of all the columns of the plates, with pert_type and plate_field
+    :param plate_field: column metadata field naming the plate of a column
+    :return: DataFrame of rows x plates, plates in sorted order, NaN where a plate lacks one of the controls
+    '''
+    plates = np.sort(col_metadata_df[plate_field].astype(str).unique())
+    if 'pert_type' not in col_metadata_df.columns:
+        return pd.DataFrame(np.nan, index=data_df.index, columns=pd.Index(plates, name=plate_field))
+
+    controls = control_columns(col_metadata_df).intersection(data_df.columns, sort=False)
+    control_metadata_df = col_metadata_df.loc[controls]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_mfi = np.log2(data_df.loc[:, controls].values.astype(np.float64))
+    log_mfi[~np.isfinite(log_mfi)] = np.nan
+
+    summaries = {}
+    for pert_type in [negative_control, positive_control]:
+        groups = control_metadata_df[plate_field].astype(str).where(control_metadata_df.pert_type == pert_type)
+        summaries[pert_type] = grouped_median_mad(log_mfi, group_positions(groups.values, plates))
+
+    ((neg_median, neg_mad), (pos_median, pos_mad)) = (summaries[negative_control], summaries[positive_control])
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ssmd = (neg_median - pos_median) / np.sqrt(neg_mad ** 2 + pos_mad ** 2)
+
+    return pd.DataFrame(ssmd, index=data_df.index, columns=pd.Index(plates, name=plate_field))
+
+
+def failed_plates(ssmd_df, row_metadata_df=None):
+    '''
+    plates whose median SSMD across cell lines is below failure_threshold, control barcodes are left out when the
+    pool_id of the rows is known
+    :return: list of plates
+    '''
+    if row_metadata_df is not None and 'pool_id' in row_metadata_df.columns:
+        pools = row_metadata_df.pool_id.reindex(ssmd_df.index)
+        ssmd_df = ssmd_df.loc[(pools != control_barcode_pool).values]
+
+    medians = ssmd_df.median(axis=0)
+    return medians[medians < failure_threshold].index.tolist()
@@ -0,0 +1,475 @@
+import os
+import glob
+import shutil
+import logging
+import tempfile
+import threading
+import unittest
+import unittest.mock as mock
+import concurrent.futures
+import h5py
+import numpy as np
+import pandas as pd
+import cmapPy.pandasGEXpress.GCToo as GCToo
+import cmapPy.pandasGEXpress.concat as cg
+import cmapPy.pandasGEXpress.parse as pe
+import cmapPy.pandasGEXpress.write_gct as wg
+import cmapPy.pandasGEXpress.write_gctx as wgx
+import merino.setup_logger as setup_logger
+import collate
+import ssmd
+
+logger = logging.getLogger(setup_logger.LOGGER_NAME)
+
+cells = ['c-{:02d}'.format(i) for i in range(30)]
+wells = ['A{:02d}'.format(i) for i in range(1, 13)] + ['B{:02d}'.format(i) for i in range(1, 13)]
+
+
+def row_metadata(plate):
+    return pd.DataFrame({'pool_id': ['CTLBC' if i < 5 else 'P{}'.format(i % 3) for i in range(30)],
+                         'det_plate': plate,
+                         'barcode_id': ['b{}'.format(i % 5) for i in range(30)],
+                         'ccle_name': ['CL{}'.format(i) for i in range(30)]},
+                        index=pd.Index(cells, name='rid'))
+
+
+def write_plate(proj_dir, plate, rng, rmeta=None, bad=False, count_nulls=True):
+    '''
+    MEDIAN and COUNT gcts and the container of a plate as assemble writes them, the rows in an order of their own: 8
+    vehicle controls, 6 poscons and 10 treatments, the poscons 64 times below the vehicle unless the plate is bad.  A
+    count is missing unless count_nulls is False
+    :return: path of the MEDIAN gct
+    '''
+    plate_dir = os.path.join(proj_dir, plate, 'assemble', plate)
+    os.makedirs(plate_dir)
+    cids = ['{}:{}'.format(plate, w) for w in wells]
+    rids = pd.Index(np.array(cells)[rng.permutation(len(cells))], name='rid')
+    rmeta = row_metadata(plate) if rmeta is None else rmeta
+    cmeta = pd.DataFrame({'pert_id': ['BRD{}'.format(i % 4) for i in range(len(wells))],
+                          'pert_type': ['ctl_vehicle'] * 8 + ['trt_poscon'] * 6 + ['trt_cp'] * 10,
+                          'prism_replicate': plate, 'data_level': 'a', 'provenance': 'b'},
+                         index=pd.Index(cids, name='cid'))
+    mfi = (2 ** rng.normal(10, 1 if bad else 0.2, (len(cells), len(wells)))).astype(np.float32)
+    if not bad:
+        mfi[:, 8:14] /= 64
+    mfi[3, 2] = np.nan
+    count = rng.randint(0, 50, (len(cells), len(wells))).astype(float)
+    if count_nulls:
+        count[0, 1] = np.nan
+    for (data_type, data) in [('MEDIAN', mfi), ('COUNT', count)]:
+        gctoo = GCToo.GCToo(data_df=pd.DataFrame(data, index=rids, columns=pd.Index(cids, name='cid')),
+                            row_metadata_df=rmeta.loc[rids], col_metadata_df=cmeta)
+        wg.write(gctoo, os.path.join(plate_dir, '{}_{}.gct'.format(plate, data_type)))
+        if data_type == 'MEDIAN':
+            container_path = os.path.join(plate_dir, plate + collate.container_suffix)
+            wgx.write(gctoo, container_path, matrix_dtype=np.float32)
+    with h5py.File(container_path, 'a') as f:
+        dataset = f.create_dataset(collate.container_count_node,
+                                   data=np.where(np.isnan(count), -666, count).transpose().astype(np.int32))
+        dataset.attrs['null_value'] = -666
+    return os.path.join(plate_dir, '{}_MEDIAN.gct'.format(plate))
+
+
+def sorted_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+class CollateTestCase(unittest.TestCase):
+    '''
+    plates under a project directory of a temporary directory, found in the order of their names
+    '''
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.proj_dir = os.path.join(self.tmp, 'proj')
+        self.rng = np.random.RandomState(0)
+        patcher = mock.patch.object(collate.cut_to_l2, 'cut_l1', side_effect=sorted)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def run_collate(self, build_dir, *extra):
+        if not os.path.exists(build_dir):
+            os.makedirs(build_dir)
+        collate.main(collate.build_parser().parse_args(
+            ['-pd', self.proj_dir, '-cn', 'C', '-bd', build_dir, '-nw', '2'] + list(extra)))
+
+    def read_level2(self, build_dir):
+        '''
+        data_df of the LEVEL2 gctx files of a build, by data type
+        '''
+        data = {}
+        for data_type in ['MFI', 'COUNT']:
+            paths = glob.glob(os.path.join(build_dir, 'C_LEVEL2_{}_n*.gctx'.format(data_type)))
+            self.assertEqual(1, len(paths))
+            data[data_type] = pe.parse(paths[0]).data_df
+        return data
+
+
+class TestCollatePlates(CollateTestCase):
+    def test_completed_in_window(self):
+        lock = threading.Lock()
+        counts = {'submitted': 0, 'yielded': 0}
+
+        class CountingExecutor(concurrent.futures.ThreadPoolExecutor):
+            def submit(self, fn, *args):
+                with lock:
+                    counts['submitted'] += 1
+                return super(CountingExecutor, self).submit(fn, *args)
+
+        with CountingExecutor(max_workers=2) as executor:
+            results = []
+            for r in collate.completed_in_window(executor, lambda x: x * x, range(20), 3):
+                # the next task is submitted as soon as one completes, before it is handed over
+                self.assertLessEqual(counts['submitted'] - counts['yielded'], 4)
+                counts['yielded'] += 1
+                results.append(r)
+        self.assertEqual([x * x for x in range(20)], sorted(results))
+        self.assertEqual([], list(collate.completed_in_window(executor, abs, [], 3)))
+
+    def test_collate_plates(self):
+        gct_list = [write_plate(self.proj_dir, 'PLT{}_X1_B1'.format(k), self.rng) for k in [1, 10, 2, 3]]
+
+        # the plates are copied as they complete, the result is the one of cmapPy's hstack
+        with mock.patch.object(collate, '_plates_in_flight_per_worker', 1):
+            (concat_gct, failures, all_row_metadata_df) = collate.collate_plates(gct_list, data_type='MEDIAN',
+                                                                                 n_workers=2)
+        expected = cg.hstack([pe.parse(x) for x in gct_list], fields_to_remove=collate.plate_row_metadata_fields)
+        pd.testing.assert_frame_equal(expected.data_df.sort_index(), concat_gct.data_df, check_names=False)
+        pd.testing.assert_frame_equal(expected.row_metadata_df.sort_index(), concat_gct.row_metadata_df,
+                                      check_names=False)
+        pd.testing.assert_frame_equal(expected.col_metadata_df.sort_index(), concat_gct.col_metadata_df,
+                                      check_names=False)
+        self.assertEqual([], failures)
+
+        # the row metadata of all the rows is the one of the first plate, as it was read
+        pd.testing.assert_frame_equal(pe.parse(gct_list[0]).row_metadata_df, all_row_metadata_df)
+
+        self.assertEqual((30, 24), collate.read_plate_dims(gct_list[0]))
+
+    def test_row_metadata_differs(self):
+        rmeta = row_metadata('PLT3_X1_B1')
+        rmeta.loc['c-07', 'pool_id'] = 'P9'
+        gct_list = [write_plate(self.proj_dir, 'PLT1_X1_B1', self.rng),
+                    write_plate(self.proj_dir, 'PLT2_X1_B1', self.rng),
+                    write_plate(self.proj_dir, 'PLT3_X1_B1', self.rng, rmeta=rmeta)]
+
+        # the plate fields and the order of the rows and columns are not part of the hash
+        hashes = [collate.hash_row_metadata(pe.parse(x).row_metadata_df, collate.plate_row_metadata_fields)
+                  for x in gct_list]
+        self.assertEqual(hashes[0], hashes[1])
+        self.assertNotEqual(hashes[0], hashes[2])
+        reordered = pe.parse(gct_list[1]).row_metadata_df
+        reordered = reordered[reordered.columns[::-1]].sort_index()
+        self.assertEqual(hashes[0], collate.hash_row_metadata(reordered, collate.plate_row_metadata_fields))
+
+        # whatever order the plates complete in, the first one is the reference
+        for (order, differs) in [([0, 1, 2], [2]), ([2, 0, 1], [0, 1])]:
+            with self.assertLogs(logger, level='WARNING') as logs:
+                (_, _, all_row_metadata_df) = collate.collate_plates([gct_list[i] for i in order],
+                                                                     data_type='MEDIAN', n_workers=2)
+            logger.debug("logs:  {}".format(logs.output))
+            self.assertEqual(len(differs), len(logs.output))
+            for (i, output) in zip(differs, logs.output):
+                self.assertIn(gct_list[i], output)
+                self.assertIn(os.path.basename(gct_list[order[0]]), output)
+            pd.testing.assert_frame_equal(pe.parse(gct_list[order[0]]).row_metadata_df, all_row_metadata_df)
+
+    def test_cell_info(self):
+        gct_list = [write_plate(self.proj_dir, 'PLT{}_X1_B1'.format(k), self.rng) for k in [1, 2]]
+        build_dir = os.path.join(self.tmp, 'build')
+        self.run_collate(build_dir)
+
+        # cell_info is the row metadata of the first MEDIAN plate, with its plate fields and columns as they are
+        expected_path = os.path.join(self.tmp, 'expected_cell_info.txt')
+        pe.parse(sorted(gct_list)[0]).row_metadata_df.to_csv(expected_path, sep='\t')
+        cell_info = pd.read_csv(os.path.join(build_dir, 'C_cell_info.txt'), sep='\t')
+        self.assertEqual(['rid', 'pool_id', 'det_plate', 'barcode_id', 'ccle_name'], list(cell_info.columns))
+        pd.testing.assert_frame_equal(pd.read_csv(expected_path, sep='\t'), cell_info)
+
+        data = self.read_level2(build_dir)
+        self.assertEqual((30, 48), data['MFI'].shape)
+        self.assertEqual(sorted(cells), list(data['COUNT'].index))
+
+
+class TestVirtual(CollateTestCase):
+    def test_virtual(self):
+        for k in [3, 1, 2, 10]:
+            write_plate(self.proj_dir, 'PLT{}_X1_B1'.format(k), self.rng, count_nulls=(k in [2, 3]))
+
+        for input_format in ['gct', 'gctx']:
+            build_dir = os.path.join(self.tmp, input_format)
+            virtual_dir = os.path.join(self.tmp, input_format + '_virtual')
+            self.run_collate(build_dir, '-if', input_format)
+            self.run_collate(virtual_dir, '-if', input_format, '-vds')
+
+            expected = self.read_level2(build_dir)
+            actual = self.read_level2(virtual_dir)
+            for data_type in expected:
+                pd.testing.assert_frame_equal(expected[data_type], actual[data_type], check_names=False)
+            for name in ['C_inst_info.txt', 'C_cell_info.txt']:
+                pd.testing.assert_frame_equal(pd.read_csv(os.path.join(build_dir, name), sep='\t'),
+                                              pd.read_csv(os.path.join(virtual_dir, name), sep='\t'))
+
+            # the matrices of the containers are referenced in place, counts holding nulls and gct plates are
+            # written to a shard
+            for data_type in expected:
+                path = glob.glob(os.path.join(virtual_dir, 'C_LEVEL2_{}_n*.gctx'.format(data_type)))[0]
+                with h5py.File(path, 'r') as f:
+                    self.assertTrue(f['/0/DATA/0/matrix'].is_virtual)
+            shards = sorted(os.listdir(os.path.join(virtual_dir, 'C_shards')))
+            logger.debug("shards:  {}".format(shards))
+            if input_format == 'gct':
+                self.assertEqual(8, len(shards))
+            else:
+                self.assertEqual(['PLT{}_X1_B1_ASSEMBLE_COUNT.h5'.format(k) for k in [2, 3]], shards)
+
+    def test_row_runs(self):
+        self.assertEqual([(0, 0, 3), (3, 5, 2)], [tuple(x) for x in collate.row_runs(np.array([0, 1, 2, 5, 6]))])
+
+
+class TestAppend(CollateTestCase):
+    def test_append(self):
+        plates = ['PLT{}_X1_B1'.format(k) for k in [3, 1, 2, 10, 7]]
+        build_dir = os.path.join(self.tmp, 'append')
+        # LEVEL2 files written by cmapPy, which cannot be resized in place
+        rewritten_dir = os.path.join(self.tmp, 'rewritten')
+        for plate in plates[:2]:
+            write_plate(self.proj_dir, plate, self.rng)
+        self.run_collate(build_dir)
+        self.run_collate(rewritten_dir)
+        for path in glob.glob(os.path.join(rewritten_dir, '*.gctx')):
+            data_df = pe.parse(path).data_df
+            os.remove(path)
+            wgx.write(GCToo.GCToo(data_df=data_df, row_metadata_df=pd.DataFrame(index=data_df.index),
+                                  col_metadata_df=pd.DataFrame(index=data_df.columns)), path)
+
+        for new_plates in [plates[2:4], plates[4:], []]:
+            for plate in new_plates:
+                write_plate(self.proj_dir, plate, self.rng)
+            self.run_collate(build_dir, '-a')
+            self.run_collate(rewritten_dir, '-a')
+
+        full_dir = os.path.join(self.tmp, 'full')
+        self.run_collate(full_dir)
+        expected = self.read_level2(full_dir)
+        expected_inst = pd.read_csv(os.path.join(full_dir, 'C_inst_info.txt'), sep='\t', dtype=str)
+        for appended_dir in [build_dir, rewritten_dir]:
+            actual = self.read_level2(appended_dir)
+            for data_type in expected:
+                self.assertEqual((30, 5 * 24), actual[data_type].shape)
+                pd.testing.assert_frame_equal(expected[data_type], actual[data_type].sort_index(axis=1),
+                                              check_names=False)
+            inst = pd.read_csv(os.path.join(appended_dir, 'C_inst_info.txt'), sep='\t', dtype=str)
+            pd.testing.assert_frame_equal(sorted_rows(expected_inst[inst.columns]), sorted_rows(inst))
+            # cell_info is the one of the first build, it comes from another plate than the one of the full build
+            (expected_cells, cell_info) = [
+                sorted_rows(pd.read_csv(os.path.join(x, 'C_cell_info.txt'), sep='\t').drop('det_plate', axis=1))
+                for x in [full_dir, appended_dir]]
+            pd.testing.assert_frame_equal(expected_cells, cell_info)
+        with h5py.File(glob.glob(os.path.join(build_dir, 'C_LEVEL2_MFI_n*.gctx'))[0], 'r') as f:
+            self.assertEqual(None, f['/0/DATA/0/matrix'].maxshape[0])
+
+
+class TestExcludeBcids(CollateTestCase):
+    def test_exclude_bcids(self):
+        for k in [3, 1, 2]:
+            write_plate(self.proj_dir, 'PLT{}_X1_B1'.format(k), self.rng)
+        rmeta = row_metadata('PLT1_X1_B1')
+        kept = sorted(rmeta.index[~rmeta.barcode_id.isin(['b1', 'b3'])])
+        self.assertEqual(18, len(kept))
+
+        full_dir = os.path.join(self.tmp, 'full')
+        self.run_collate(full_dir)
+        expected = self.read_level2(full_dir)
+        for input_format in ['gct', 'gctx']:
+            for extra in [[], ['-vds']]:
+                build_dir = os.path.join(self.tmp, '_'.join([input_format] + extra))
+                self.run_collate(build_dir, '-if', input_format, '-x', 'b1,b3', *extra)
+                actual = self.read_level2(build_dir)
+                for data_type in expected:
+                    pd.testing.assert_frame_equal(expected[data_type].loc[kept], actual[data_type], check_names=False)
+                # cell_info still lists the excluded rows
+                cell_info = pd.read_csv(os.path.join(build_dir, 'C_cell_info.txt'), sep='\t')
+                self.assertEqual(sorted(cells), sorted(cell_info.rid))
+
+    def test_parse_plate_rows(self):
+        path = write_plate(self.proj_dir, 'PLT1_X1_B1', self.rng)
+        container_path = path.replace('_MEDIAN.gct', collate.container_suffix)
+        rmeta = row_metadata('PLT1_X1_B1')
+        self.assertEqual(list(rmeta.index), list(collate.kept_row_ids(rmeta, None)))
+        kept = rmeta.index[rmeta.barcode_id != 'b0']
+        self.assertEqual(list(kept), list(collate.kept_row_ids(rmeta, ['b0'])))
+
+        for (plate_path, data_type) in [(path, 'MEDIAN'), (container_path, 'MEDIAN'), (container_path, 'COUNT')]:
+            (gctoo, plate_row_metadata_df) = collate.parse_plate_rows(plate_path, data_type, ['b0'])
+            self.assertEqual(sorted(kept), sorted(gctoo.data_df.index))
+            self.assertEqual(sorted(cells), sorted(plate_row_metadata_df.index))
+
+        expected = pe.parse(path.replace('_MEDIAN.gct', '_COUNT.gct')).data_df.loc[kept]
+        (gctoo, _) = collate.parse_plate_rows(container_path, 'COUNT', ['b0'])
+        pd.testing.assert_frame_equal(expected, gctoo.data_df.loc[kept], check_names=False, check_dtype=False)
+
+
+def reference_ssmd(data_df, col_metadata_df):
+    # SSMD of each cell line on each plate as qc_functions.R computes it, a plate at a time
+    log_mfi = np.log2(data_df.where(data_df > 0))
+    ssmds = {}
+    for (plate, plate_metadata_df) in col_metadata_df.groupby('prism_replicate'):
+        summaries = []
+        for pert_type in ['ctl_vehicle', 'trt_poscon']:
+            values = log_mfi[plate_metadata_df.index[plate_metadata_df.pert_type == pert_type]]
+            median = values.median(axis=1)
+            summaries.append((median, 1.4826 * values.sub(median, axis=0).abs().median(axis=1)))
+        ((neg_median, neg_mad), (pos_median, pos_mad)) = summaries
+        ssmds[plate] = (neg_median - pos_median) / np.sqrt(neg_mad ** 2 + pos_mad ** 2)
+    return pd.DataFrame(ssmds).sort_index(axis=1)
+
+
+class TestSsmd(CollateTestCase):
+    def test_ssmd_matrix(self):
+        paths = [write_plate(self.proj_dir, 'PLT{}_X1_B1'.format(k), self.rng, bad=(k == 2)) for k in [1, 2, 3]]
+        gctoo = collate.collate_plates(paths, n_workers=2)[0]
+        col_metadata_df = gctoo.col_metadata_df.copy()
+        # a plate without controls has no SSMD
+        col_metadata_df.loc[col_metadata_df.prism_replicate == 'PLT3_X1_B1', 'pert_type'] = 'trt_cp'
+
+        ssmd_df = ssmd.ssmd_matrix(gctoo.data_df, col_metadata_df)
+        expected = reference_ssmd(gctoo.data_df, col_metadata_df)
+        self.assertEqual(['PLT1_X1_B1', 'PLT2_X1_B1', 'PLT3_X1_B1'], list(ssmd_df.columns))
+        self.assertTrue(ssmd_df['PLT3_X1_B1'].isnull().all())
+        np.testing.assert_allclose(expected.values, ssmd_df.values, rtol=1e-4)
+
+        # only the control columns are needed
+        controls = ssmd.control_columns(col_metadata_df)
+        self.assertEqual(14 * 2, len(controls))
+        pd.testing.assert_frame_equal(ssmd_df, ssmd.ssmd_matrix(gctoo.data_df[controls], col_metadata_df))
+
+        self.assertEqual(['PLT2_X1_B1'], ssmd.failed_plates(ssmd_df, gctoo.row_metadata_df))
+
+    def test_qc_reports(self):
+        plates = ['PLT{}_X1_B1'.format(k) for k in [3, 1, 2, 10]]
+        paths = [write_plate(self.proj_dir, plate, self.rng, bad=(plate == 'PLT1_X1_B1')) for plate in plates[:2]]
+        append_dir = os.path.join(self.tmp, 'append')
+        self.run_collate(append_dir)
+        paths += [write_plate(self.proj_dir, plate, self.rng) for plate in plates[2:]]
+        self.run_collate(append_dir, '-a')
+        full_dir = os.path.join(self.tmp, 'full')
+        self.run_collate(full_dir)
+        virtual_dir = os.path.join(self.tmp, 'virtual')
+        self.run_collate(virtual_dir, '-vds')
+
+        gctoos = [pe.parse(x) for x in paths]
+        expected = reference_ssmd(pd.concat([x.data_df for x in gctoos], axis=1),
+                                  pd.concat([x.col_metadata_df for x in gctoos], axis=0))
+        for build_dir in [full_dir, append_dir, virtual_dir]:
+            ssmd_paths = glob.glob(os.path.join(build_dir, 'C_ssmd_matrix_n*.gct'))
+            self.assertEqual([os.path.join(build_dir, 'C_ssmd_matrix_n4_30.gct')], ssmd_paths)
+            ssmd_df = pe.parse(ssmd_paths[0]).data_df.sort_index(axis=1)
+            # the gct holds 4 significant digits
+            np.testing.assert_allclose(expected.loc[ssmd_df.index].values, ssmd_df.values, rtol=1e-3)
+
+            # every plate has fewer than 350 columns
+            fails = pd.read_csv(os.path.join(build_dir, 'failed_plates.txt'), sep='\t', dtype=str)
+            self.assertEqual(sorted(plates), list(fails.dropout_failures))
+            self.assertEqual(['PLT1_X1_B1'], list(fails.ssmd_failures.dropna()))
+
+
+class TestLongTable(CollateTestCase):
+    def setUp(self):
+        super(TestLongTable, self).setUp()
+        try:
+            import pyarrow.dataset
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+    def reference_long_table(self, build_dir):
+        '''
+        long table of a build as normalize.R builds it from the LEVEL2 gctx files, cell_info and inst_info
+        '''
+        level2 = self.read_level2(build_dir)
+        cell_info = pd.read_csv(os.path.join(build_dir, 'C_cell_info.txt'), sep='\t', dtype=str, keep_default_na=False)
+        cell_info = cell_info[['rid', 'ccle_name', 'pool_id', 'barcode_id']].drop_duplicates()
+        cell_info['rid'] = cell_info.rid + '_PR500'
+        cell_info['culture'] = 'PR500'
+        cell_info.loc[cell_info.pool_id.isin(['', '-666']), 'pool_id'] = 'CTLBC'
+        inst_info = pd.read_csv(os.path.join(build_dir, 'C_inst_info.txt'), sep='\t', dtype=str, keep_default_na=False)
+
+        (mfi, count) = [level2[x].rename(index=lambda r: r + '_PR500').rename_axis('rid')
+                        .rename_axis('profile_id', axis=1) for x in ['MFI', 'COUNT']]
+        log_mfi = np.log2(mfi + 1).reset_index().melt(id_vars='rid', value_name='logMFI')
+        log_mfi = log_mfi[np.isfinite(log_mfi.logMFI)]
+        count = count.reset_index().melt(id_vars='rid', value_name='count')
+        expected = log_mfi.merge(cell_info).merge(inst_info).merge(count)
+        expected['instance_id'] = expected.profile_id + ':' + expected.ccle_name
+        return expected
+
+    def read_long_table(self, build_dir):
+        import pyarrow.dataset as ds
+        path = os.path.join(build_dir, 'C_LEVEL2_LONG.parquet')
+        self.assertEqual(path, collate.long_table.long_table_path(build_dir, 'C'))
+        table = ds.dataset(path, format='parquet').to_table().to_pandas()
+        for column in table.columns:
+            if isinstance(table[column].dtype, pd.CategoricalDtype):
+                table[column] = table[column].astype(str)
+        return table
+
+    def test_long_table(self):
+        plates = ['PLT{}_X1_B1'.format(k) for k in [3, 1, 2, 10]]
+        # control barcodes without a pool
+        rmeta = row_metadata(plates[0])
+        rmeta.loc[rmeta.pool_id == 'CTLBC', 'pool_id'] = ''
+        for plate in plates[:2]:
+            write_plate(self.proj_dir, plate, self.rng, rmeta=rmeta.assign(det_plate=plate))
+        append_dir = os.path.join(self.tmp, 'append')
+        self.run_collate(append_dir, '-lt', '-cu', 'PR500', '-x', 'b2')
+        for plate in plates[2:]:
+            write_plate(self.proj_dir, plate, self.rng, rmeta=rmeta.assign(det_plate=plate))
+        self.run_collate(append_dir, '-a', '-lt', '-cu', 'PR500', '-x', 'b2')
+        full_dir = os.path.join(self.tmp, 'full')
+        self.run_collate(full_dir, '-lt', '-cu', 'PR500', '-x', 'b2')
+        virtual_dir = os.path.join(self.tmp, 'virtual')
+        self.run_collate(virtual_dir, '-vds', '-lt', '-cu', 'PR500', '-x', 'b2')
+
+        keys = ['profile_id', 'rid']
+        for build_dir in [full_dir, append_dir, virtual_dir]:
+            logger.debug("build_dir:  {}".format(build_dir))
+            expected = self.reference_long_table(build_dir).sort_values(keys).reset_index(drop=True)
+            table = self.read_long_table(build_dir)
+            self.assertEqual(sorted(expected.columns), sorted(table.columns))
+            table = table[expected.columns].sort_values(keys).reset_index(drop=True)
+            # 24 kept rows of 4 plates of 24 columns, less the NaN of each plate
+            self.assertEqual(24 * 24 * 4 - 4, len(table))
+            self.assertEqual(['CTLBC'], list(table.pool_id[table.ccle_name == 'CL0'].unique()))
+            for column in expected.columns:
+                if column in ['logMFI', 'count']:
+                    np.testing.assert_allclose(expected[column].astype(float), table[column].astype(float), rtol=1e-6)
+                else:
+                    self.assertEqual(list(expected[column].astype(str)), list(table[column].astype(str)), column)
+
+
+    def test_long_table_runs(self):
+        plates = ['PLT{}_X1_B1'.format(k) for k in [3, 1, 2]]
+        for plate in plates[:2]:
+            write_plate(self.proj_dir, plate, self.rng)
+        build_dir = os.path.join(self.tmp, 'build')
+        path = os.path.join(build_dir, 'C_LEVEL2_LONG.parquet')
+
+        # the build was collated without a table, appending with one writes the table of every plate
+        self.run_collate(build_dir)
+        write_plate(self.proj_dir, plates[2], self.rng)
+        self.run_collate(build_dir, '-a', '-lt', '-cu', 'PR500')
+        self.assertEqual(['part-0.parquet'], os.listdir(path))
+        table = self.read_long_table(build_dir)
+        self.assertEqual(sorted(plates), sorted(set(table.prism_replicate)))
+        self.assertEqual(len(self.reference_long_table(build_dir)), len(table))
+
+        # a run without --long_table removes the table, which would be left behind by the gctx files
+        self.run_collate(build_dir)
+        self.assertFalse(os.path.exists(path))
+
+if __name__ == "__main__":
+    setup_logger.setup(verbose=True)
+
+    unittest.main()
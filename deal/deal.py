@@ -9,11 +9,30 @@ import sys
 import glob
 import logging
 import argparse
+import json
+import h5py
+import numpy as np
 import pandas as pd
+import id_codec
 # from cmapPy.pandasGEXpress.parse import parse
 
 logger = logging.getLogger('deal')
 CTL_TYPES = ['ctl_vehicle']
+
+# rows of a data level read at a time when every project is dealt in one pass
+_csv_chunk_rows = 100000
+
+# directory of the build holding the project partitioned data levels, and its index
+partition_dir = 'deal_partitions'
+partition_index_file = 'index.json'
+
+gctx_matrix_node = '/0/DATA/0/matrix'
+gctx_row_id_node = '/0/META/ROW/id'
+gctx_col_id_node = '/0/META/COL/id'
+
+# number of LEVEL2 values read from a gctx and written at a time
+_block_values = 1 << 22
+
 build_contents_dict = {
     'inst_info': {
         'search_pattern': '*_inst_info.txt',
@@ -37,12 +56,14 @@ build_contents_dict = {
     },
     'LEVEL2_COUNT': {
         'search_pattern': '*_LEVEL2_COUNT*.csv',
+        'gctx_search_pattern': '*_LEVEL2_COUNT*.gctx',
         'type': 'data',
         'annotated': False,
         'format': 'csv',
     },
     'LEVEL2_MFI': {
         'search_pattern': '*_LEVEL2_MFI*.csv',
+        'gctx_search_pattern': '*_LEVEL2_MFI*.gctx',
         'type': 'data',
         'annotated': False,
         'format': 'csv'
@@ -97,6 +118,11 @@ def build_parser():
                         default='pert_plate,culture,pert_id,pert_idose,pert_time',
                         )
     parser.add_argument('--ignore_missing', action="store_true", default=False)
+    parser.add_argument('--partition', action="store_true", default=False,
+                        help='Write the data levels of the build partitioned by project for the array jobs and exit')
+    parser.add_argument('--gctx_build_paths', '-g',
+                        help='Comma separated list of the builds holding the LEVEL2 gctx files, in the order they are '
+                             'stacked. LEVEL2 is then read from the gctx files instead of the LEVEL2 csvs')
     parser.add_argument('--out', '-o', help='Output for collated build')
     parser.add_argument("--verbose", '-v', help="Whether to print a bunch of output", action="store_true",
                         default=False)
@@ -110,8 +136,7 @@ Make sig_ids based on id_cols.
 
 
 def make_sig_id(level5_table, id_cols):
-    col_hds = id_cols.split(',')
-    level5_table['sig_id'] = level5_table.apply(lambda row: '_'.join([str(row[col]) for col in col_hds]), axis=1)
+    level5_table['sig_id'] = id_codec.make_ids(level5_table, id_cols, sep='_')
     return level5_table
 
 def get_data_plus_controls(data, project):
@@ -128,6 +153,129 @@ def get_data_plus_controls(data, project):
 
     return pd.concat([proj_inst, proj_ctls])
 
+class ProjectWriter(object):
+    '''
+    csv of one project for a data level, appended to a chunk of rows at a time.  The distinct profiles and cell lines are
+    counted as the rows are written and the file is renamed with them once closed
+    '''
+
+    def __init__(self, outpath, project, data_level, columns, col_id, row_id):
+        self.proj_dir = os.path.join(outpath, project, 'data')
+        if not os.path.exists(self.proj_dir):
+            os.makedirs(self.proj_dir)
+        self.project = project
+        self.data_level = data_level
+        (self.col_id, self.row_id) = (col_id, row_id)
+        self.col_ids = set()
+        self.row_ids = set()
+        self.tmp_path = os.path.join(self.proj_dir, '{}_{}.csv.tmp'.format(project, data_level))
+        self.f = open(self.tmp_path, 'w')
+        pd.DataFrame(columns=columns).to_csv(self.f, index=False)
+
+    def write(self, rows):
+        for (ids, col) in [(self.col_ids, self.col_id), (self.row_ids, self.row_id)]:
+            ids.update(rows[col].astype(object).where(rows[col].notna(), None))
+        rows.to_csv(self.f, index=False, header=False)
+
+    def close(self):
+        self.f.close()
+        out_path = os.path.join(self.proj_dir, '{}_{}_n{}x{}.csv'.format(
+            self.project, self.data_level, len(self.col_ids), len(self.row_ids)))
+        os.rename(self.tmp_path, out_path)
+        return out_path
+
+
+def write_routed(chunk, rows, codes, writers):
+    '''
+    write rows of chunk to the writers of their projects, in the order of chunk
+    :param rows: positions in chunk
+    :param codes: position in writers of the project of each of rows, a row may be routed to several projects
+    '''
+    pairs = pd.DataFrame({'row': np.asarray(rows, dtype=np.int64), 'code': np.asarray(codes, dtype=np.int64)})
+    for (code, group) in pairs.sort_values(['code', 'row']).groupby('code', sort=False):
+        writers[code].write(chunk.iloc[group.row.values])
+
+
+def level2_members(inst, projects):
+    '''
+    profile_ids of each project as get_data_plus_controls selects them from inst_info - the project's profiles and the
+    vehicle controls of its plates
+    :return: DataFrame of profile_id and code, the position of the project in projects
+    '''
+    inst = inst.assign(code=pd.Index(projects).get_indexer(inst['x_project_id']))
+    proj_inst = inst.loc[inst.code >= 0, ['profile_id', 'pert_plate', 'code']]
+    proj_plates = proj_inst[['pert_plate', 'code']].drop_duplicates()
+    ctls = inst.loc[inst['pert_type'].isin(CTL_TYPES), ['profile_id', 'pert_plate']].merge(proj_plates, on='pert_plate')
+    members = pd.concat([proj_inst[['profile_id', 'code']], ctls[['profile_id', 'code']]])
+    return members.drop_duplicates()
+
+
+def deal_data_level(data_path, data_level, projects, inst, outpath, sig_id_cols):
+    '''
+    write the slices of every project of a data level reading its file once, a chunk of rows at a time.  Slices hold
+    the same rows in the same order as slice_and_write_project writes them, values are copied as the text of the file.
+    Annotated levels route each row to the writer of its x_project_id; their vehicle controls are kept and indexed by
+    plate, and written to the projects with rows on the plate at the end.  LEVEL2 rows are routed by cid to the projects
+    whose inst_info profiles include it
+    :param data_path: csv of the data level
+    :param projects: project ids
+    :param inst: inst_info of the build
+    :return: list of the paths written
+    '''
+    annotated = build_contents_dict[data_level]['annotated']
+    columns = list(pd.read_csv(data_path, nrows=0).columns)
+    make_sig_ids = ("LEVEL5" in data_level) and ('sig_id' not in columns)
+    if make_sig_ids:
+        logger.debug("Generating sig_ids from sig_id_cols arg: {}".format(sig_id_cols))
+        columns.append('sig_id')
+
+    if annotated:
+        (col_id, row_id) = ('profile_id' if 'profile_id' in columns else 'sig_id', 'ccle_name')
+        with_controls = 'pert_type' in columns
+    else:
+        (col_id, row_id) = ('cid', 'rid')
+        members = level2_members(inst, projects)
+
+    project_index = pd.Index(projects)
+    writers = [ProjectWriter(outpath, project, data_level, columns, col_id, row_id) for project in projects]
+    project_plates = [set() for _ in projects]
+    control_chunks = []
+    try:
+        for chunk in pd.read_csv(data_path, dtype=str, chunksize=_csv_chunk_rows):
+            chunk = chunk.reset_index(drop=True)
+            if make_sig_ids:
+                chunk = make_sig_id(chunk, sig_id_cols)
+
+            if not annotated:
+                routed = pd.DataFrame({'profile_id': chunk['cid'].values, 'row': np.arange(len(chunk))}).merge(
+                    members, on='profile_id')
+                write_routed(chunk, routed.row.values, routed.code.values, writers)
+                continue
+
+            codes = project_index.get_indexer(chunk['x_project_id'])
+            rows = np.flatnonzero(codes >= 0)
+            write_routed(chunk, rows, codes[rows], writers)
+            if with_controls:
+                seen = pd.DataFrame({'code': codes[rows], 'plate': chunk['pert_plate'].values[rows]}).drop_duplicates()
+                for (code, plate) in zip(seen.code, seen.plate):
+                    project_plates[code].add(plate)
+                control_chunks.append(chunk.loc[chunk['pert_type'].isin(CTL_TYPES)])
+
+        if len(control_chunks) > 0:
+            controls = pd.concat(control_chunks, ignore_index=True)
+            plate_rows = controls.groupby('pert_plate').indices
+            for (code, plates) in enumerate(project_plates):
+                rows = [plate_rows[plate] for plate in plates if plate in plate_rows]
+                if len(rows) > 0:
+                    writers[code].write(controls.iloc[np.sort(np.concatenate(rows))])
+    except Exception:
+        for writer in writers:
+            writer.f.close()
+        raise
+
+    return [writer.close() for writer in writers]
+
+
 """
     Extract project data and write to file
 """
@@ -157,8 +305,7 @@ def slice_and_write_project(data, data_level, project, outpath, args):
             data['cid'].isin(proj_inst['profile_id'].unique())
         ]
 
-        nc = len(proj_data['cid'].unique())
-        nr = len(proj_data['rid'].unique())
+        (col_id, row_id) = ('cid', 'rid')
     else:
         if 'pert_type' in data.columns:
             proj_data = get_data_plus_controls(data, project)
@@ -170,20 +317,294 @@ def slice_and_write_project(data, data_level, project, outpath, args):
         col_id = ('profile_id' if 'profile_id' in data.columns else 'sig_id')
         row_id = 'ccle_name'
 
-        nc = len(proj_data[col_id].unique())
-        nr = len(proj_data[row_id].unique())
+    write_project_data(proj_data, project, data_level, outpath, col_id, row_id)
+
+
+def write_project_data(proj_data, project, data_level, outpath, col_id, row_id):
+    nc = len(proj_data[col_id].unique())
+    nr = len(proj_data[row_id].unique())
 
     proj_data.to_csv(
-        os.path.join(proj_dir, '{}_{}_n{}x{}.csv'.format(project, data_level, nc, nr)),
+        os.path.join(outpath, project, 'data', '{}_{}_n{}x{}.csv'.format(project, data_level, nc, nr)),
         index=False,
     )
 
 
+def read_gctx_ids(path):
+    '''
+    (row ids, column ids) of a gctx, read without its matrix
+    '''
+    with h5py.File(path, 'r') as f:
+        return tuple([np.array([x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in f[node][()]], dtype=object)
+                      for node in [gctx_row_id_node, gctx_col_id_node]])
+
+
+def level2_gctx_paths(gctx_build_paths, data_level):
+    '''
+    gctx of data_level in each build of gctx_build_paths, a comma separated list
+    '''
+    fps = []
+    for build in gctx_build_paths.split(','):
+        found = glob.glob(os.path.join(build, build_contents_dict[data_level]['gctx_search_pattern']))
+        assert len(found) == 1, "Incorrect number of {} gctx files found in {}".format(data_level, build)
+        fps += found
+    return fps
+
+
+def column_runs(positions, max_length):
+    '''
+    sorted positions as (start, stop) slices of consecutive positions, at most max_length long
+    '''
+    runs = []
+    if len(positions) == 0:
+        return runs
+    breaks = np.flatnonzero(np.diff(positions) != 1) + 1
+    for (first, last) in zip(np.concatenate([[0], breaks]), np.concatenate([breaks, [len(positions)]])):
+        for start in range(positions[first], positions[last - 1] + 1, max_length):
+            runs.append((start, min(start + max_length, positions[last - 1] + 1)))
+    return runs
+
+
+def write_level2_from_gctx(gctx_paths, inst, data_level, project, outpath):
+    '''
+    write the LEVEL2 long table of a project, rid, cid and value, from the columns of its profiles and of the vehicle
+    controls of its plates in the gctx files.  Only those columns are read, as hyperslabs of consecutive columns, and
+    the rows are written in the order of the long table written by stack
+    :param gctx_paths: gctx of data_level of each build, in the order they are stacked
+    :param inst: inst_info of the build
+    :return: path of the output
+    '''
+    proj_dir = os.path.join(outpath, project, 'data')
+    if not os.path.exists(proj_dir):
+        os.makedirs(proj_dir)
+    profile_ids = level2_members(inst, [project])['profile_id'].unique()
+
+    selections = []
+    (cids, rids) = (set(), set())
+    for fp in gctx_paths:
+        (row_ids, col_ids) = read_gctx_ids(fp)
+        positions = np.flatnonzero(pd.Series(col_ids).isin(profile_ids).values)
+        if len(positions) > 0:
+            selections.append((fp, row_ids, col_ids, positions))
+            cids.update(col_ids[positions])
+            rids.update(row_ids)
+
+    out_path = os.path.join(proj_dir, '{}_{}_n{}x{}.csv'.format(project, data_level, len(cids), len(rids)))
+    with open(out_path, 'w') as out:
+        pd.DataFrame(columns=['rid', 'cid', 'value']).to_csv(out, index=False)
+        for (fp, row_ids, col_ids, positions) in selections:
+            with h5py.File(fp, 'r') as f:
+                matrix = f[gctx_matrix_node]
+                for (start, stop) in column_runs(positions, max(1, _block_values // max(1, len(row_ids)))):
+                    values = matrix[start:stop]
+                    pd.DataFrame({'rid': np.tile(row_ids, stop - start),
+                                  'cid': np.repeat(col_ids[start:stop], len(row_ids)),
+                                  'value': values.reshape(-1)}, columns=['rid', 'cid', 'value']).to_csv(
+                        out, index=False, header=False)
+    return out_path
+
+
+class PartitionWriter(object):
+    '''
+    csv partitions of a data level, each appended to a chunk of rows at a time
+    '''
+
+    def __init__(self, level_path, columns):
+        self.level_path = level_path
+        self.columns = columns
+        self.files = {}
+
+    def write(self, name, rows):
+        if name not in self.files:
+            path = os.path.join(self.level_path, name)
+            if not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            self.files[name] = open(path, 'w')
+            pd.DataFrame(columns=self.columns).to_csv(self.files[name], index=False)
+        rows.to_csv(self.files[name], index=False, header=False)
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+
+
+def project_partition(project):
+    return os.path.join('projects', '{}.csv'.format(project))
+
+
+def plate_partition(plate):
+    return os.path.join('plates', '{}.csv'.format(plate))
+
+
+def partition_data_level(data_path, data_level, projects, inst, level_path):
+    '''
+    write a data level as one csv per project, with the project's rows, and one csv per plate, with the vehicle controls
+    of the plate, reading the level file once.  As get_data_plus_controls, the plates of a project are those of its
+    rows in the level file, or in inst_info for LEVEL2 whose rows are matched to inst_info by cid
+    :return: dict of the partitions of each project - {'rows': project partition or None, 'plates': [plate partitions]}
+    '''
+    annotated = build_contents_dict[data_level]['annotated']
+    columns = list(pd.read_csv(data_path, nrows=0).columns)
+    project_index = pd.Index(projects)
+    project_plates = [set() for _ in projects]
+    if not annotated:
+        inst_codes = project_index.get_indexer(inst['x_project_id'])
+        for (code, plate) in set(zip(inst_codes[inst_codes >= 0], inst['pert_plate'].values[inst_codes >= 0])):
+            project_plates[code].add(plate)
+        ctls = inst['pert_type'].isin(CTL_TYPES).values
+        # LEVEL2 rows of control profiles are only written to their plate, the projects read them from there
+        profile_codes = pd.Series(np.where(ctls, -1, inst_codes), index=inst['profile_id'].values)
+        control_plates = pd.Series(inst['pert_plate'].values[ctls], index=inst['profile_id'].values[ctls])
+
+    writer = PartitionWriter(level_path, columns)
+    try:
+        for chunk in pd.read_csv(data_path, dtype=str, chunksize=_csv_chunk_rows):
+            if annotated:
+                codes = project_index.get_indexer(chunk['x_project_id'])
+                plates = chunk['pert_plate'] if 'pert_type' in chunk.columns else None
+                controls = chunk.loc[chunk['pert_type'].isin(CTL_TYPES)] if plates is not None else chunk.iloc[:0]
+            else:
+                codes = profile_codes.reindex(chunk['cid'].values).fillna(-1).values.astype(np.int64)
+                plates = control_plates.reindex(chunk['cid'].values)
+                plates.index = chunk.index
+                controls = chunk.loc[plates.notna()]
+
+            rows = chunk.loc[codes >= 0]
+            for (code, group) in rows.groupby(codes[codes >= 0], sort=False):
+                writer.write(project_partition(projects[code]), group)
+                if annotated and plates is not None:
+                    project_plates[code].update(plates.loc[group.index].dropna())
+            if len(controls) > 0:
+                for (plate, group) in controls.groupby(plates.loc[controls.index], sort=False):
+                    writer.write(plate_partition(plate), group)
+    finally:
+        writer.close()
+
+    partitions = {}
+    for (project, plates) in zip(projects, project_plates):
+        plate_files = sorted(plate_partition(plate) for plate in plates)
+        partitions[project] = {
+            'rows': project_partition(project) if project_partition(project) in writer.files else None,
+            'plates': [x for x in plate_files if x in writer.files]
+        }
+    return partitions
+
+
+def source_stat(path):
+    '''
+    name, size and mtime of a build file, recorded in the partition index
+    '''
+    st = os.stat(path)
+    return {'name': os.path.basename(path), 'size': st.st_size, 'mtime': st.st_mtime}
+
+
+def write_partitions(build_path, inst, inst_path):
+    '''
+    write the data levels of the build partitioned by project under build_path/deal_partitions, with an index of the
+    partitions and the prism_replicates of each project, so that the array jobs of deal read their project's rows only.
+    The index records the name, size and mtime of the files the partitions were written from
+    :param inst_path: path of the inst_info inst was read from
+    :return: path of the index
+    '''
+    partition_path = os.path.join(build_path, partition_dir)
+    if os.path.exists(partition_path):
+        shutil.rmtree(partition_path)
+    os.makedirs(partition_path)
+
+    projects = [project for project in inst['x_project_id'].unique() if not pd.isna(project)]
+    index = {'prism_replicates': {project: sorted(inst.loc[inst['x_project_id'] == project, 'prism_replicate']
+                                                  .dropna().astype(str).unique().tolist())
+                                  for project in projects},
+             'levels': {},
+             'sources': {'inst_info': source_stat(inst_path)}}
+
+    for (data_level, dl_dict) in build_contents_dict.items():
+        if dl_dict['type'] != 'data':
+            continue
+        file_paths = glob.glob(os.path.join(build_path, dl_dict['search_pattern']))
+        if len(file_paths) != 1:
+            logger.info("Not partitioning {}, {} files found".format(data_level, len(file_paths)))
+            continue
+        print(data_level)
+        index['sources'][data_level] = source_stat(file_paths[0])
+        index['levels'][data_level] = partition_data_level(file_paths[0], data_level, projects, inst,
+                                                           os.path.join(partition_path, data_level))
+
+    index_path = os.path.join(partition_path, partition_index_file)
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=1)
+    logger.info("Partitions written to {}".format(partition_path))
+    return index_path
+
+
+def read_partition_index(build_path):
+    index_path = os.path.join(build_path, partition_dir, partition_index_file)
+    if not os.path.exists(index_path):
+        return None
+    with open(index_path) as f:
+        return json.load(f)
+
+
+def partitions_match(build_path, index, key):
+    '''
+    whether the build file of key is still the one the partitions were written from, by name, size and mtime
+    '''
+    source = index.get('sources', {}).get(key)
+    file_paths = glob.glob(os.path.join(build_path, build_contents_dict[key]['search_pattern']))
+    if source is None or len(file_paths) != 1:
+        return False
+    if source_stat(file_paths[0]) != source:
+        logger.warning("{} has changed since the partitions were written, reading it instead - partitioned:  {}  "
+                       "now:  {}".format(key, source, source_stat(file_paths[0])))
+        return False
+    return True
+
+
+def write_project_from_partitions(build_path, index, data_level, project, outpath, sig_id_cols):
+    '''
+    write the data of a project for data_level from the partitions of the project - its rows followed by the vehicle
+    controls of its plates, plate by plate.  Values are copied as the text of the partitions
+    '''
+    proj_dir = os.path.join(outpath, project, 'data')
+    if not os.path.exists(proj_dir):
+        os.makedirs(proj_dir)
+
+    partitions = index['levels'][data_level].get(project, {'rows': None, 'plates': []})
+    level_path = os.path.join(build_path, partition_dir, data_level)
+    paths = [os.path.join(level_path, x) for x in [partitions['rows']] + partitions['plates'] if x is not None]
+    if len(paths) > 0:
+        proj_data = pd.concat([pd.read_csv(x, dtype=str) for x in paths])
+    else:
+        proj_data = pd.DataFrame(columns=pd.read_csv(glob.glob(os.path.join(
+            build_path, build_contents_dict[data_level]['search_pattern']))[0], nrows=0).columns)
+
+    if ("LEVEL5" in data_level) & ('sig_id' not in proj_data.columns):
+        logger.debug("Generating sig_ids from sig_id_cols arg: {}".format(sig_id_cols))
+        proj_data = make_sig_id(proj_data, sig_id_cols)
+
+    if build_contents_dict[data_level]['annotated']:
+        (col_id, row_id) = ('profile_id' if 'profile_id' in proj_data.columns else 'sig_id', 'ccle_name')
+    else:
+        (col_id, row_id) = ('cid', 'rid')
+    write_project_data(proj_data, project, data_level, outpath, col_id, row_id)
+
+
 def main(args):
     build_path = args.build_path
     outpath = args.out
 
+    if args.partition:
+        inst_path = glob.glob(os.path.join(build_path, build_contents_dict['inst_info']['search_pattern']))[0]
+        inst = pd.read_csv(
+            inst_path,
+            sep='\t',
+            dtype={'pert_dose': 'str', 'pert_idose': 'str'},
+        )
+        write_partitions(build_path, inst, inst_path)
+        return
+
     if args.only_key and args.project:
+        partition_index = read_partition_index(build_path)
         key = args.only_key
         project = args.project
         dl_dict = build_contents_dict[key]
@@ -215,13 +636,16 @@ def main(args):
             file_paths = glob.glob(os.path.join(build_path, dl_dict['search_pattern']))
             if args.ignore_missing and len(file_paths) < 1:
                 return
-            inst = pd.read_csv(
-                glob.glob(os.path.join(build_path, build_contents_dict['inst_info']['search_pattern']))[0],
-                sep='\t',
-                dtype={'pert_dose': 'str', 'pert_idose': 'str'},
-            )
-            proj_inst = inst.loc[inst['x_project_id'] == project]
-            preps = proj_inst.prism_replicate.unique()
+            if partition_index is not None and partitions_match(build_path, partition_index, 'inst_info'):
+                preps = partition_index['prism_replicates'].get(project, [])
+            else:
+                inst = pd.read_csv(
+                    glob.glob(os.path.join(build_path, build_contents_dict['inst_info']['search_pattern']))[0],
+                    sep='\t',
+                    dtype={'pert_dose': 'str', 'pert_idose': 'str'},
+                )
+                proj_inst = inst.loc[inst['x_project_id'] == project]
+                preps = proj_inst.prism_replicate.unique()
 
             qc = pd.read_csv(glob.glob(os.path.join(build_path, dl_dict['search_pattern']))[0],
                              dtype={'pert_dose': 'str', 'pert_idose': 'str'}
@@ -230,10 +654,22 @@ def main(args):
                 os.path.join(proj_dir, '{}_{}.csv'.format(project, key)),
                 index=False
             )
+        elif args.gctx_build_paths and 'gctx_search_pattern' in dl_dict:
+            inst = pd.read_csv(
+                glob.glob(os.path.join(build_path, build_contents_dict['inst_info']['search_pattern']))[0],
+                sep='\t',
+                dtype={'pert_dose': 'str', 'pert_idose': 'str'},
+            )
+            write_level2_from_gctx(level2_gctx_paths(args.gctx_build_paths, key), inst, key, project, outpath)
         else:
             file_paths = glob.glob(os.path.join(build_path, dl_dict['search_pattern']))
             if args.ignore_missing and len(file_paths) < 1:
                 return
+            if partition_index is not None and key in partition_index['levels'] and \
+                    partitions_match(build_path, partition_index, key):
+                logger.debug("Reading {} of {} from the partitions of the build".format(key, project))
+                write_project_from_partitions(build_path, partition_index, key, project, outpath, args.sig_id_cols)
+                return
             data = pd.read_csv(glob.glob(os.path.join(build_path, dl_dict['search_pattern']))[0])
             slice_and_write_project(data, key, project, outpath, args)
 
@@ -280,22 +716,19 @@ def main(args):
 
         for data_level, dl_dict in data_files.items():
             print(data_level)
+            projects = [project for project in inst['x_project_id'].unique() if not pd.isna(project)]
+            if args.gctx_build_paths and 'gctx_search_pattern' in dl_dict:
+                gctx_paths = level2_gctx_paths(args.gctx_build_paths, data_level)
+                for project in projects:
+                    write_level2_from_gctx(gctx_paths, inst, data_level, project, outpath)
+                continue
+
             assert len(glob.glob(os.path.join(build_path, dl_dict[
                 'search_pattern']))) == 1, "Incorrect number of files for data level: {}".format(data_level)
 
-            print(glob.glob(os.path.join(build_path, dl_dict['search_pattern']))[0])
-            data = pd.read_csv(
-                glob.glob(os.path.join(build_path, dl_dict['search_pattern']))[0],
-                dtype={'pert_dose': 'str', 'pert_idose': 'str'}
-            )
-            for project in inst['x_project_id'].unique():
-                if pd.isna(project):
-                    continue
-
-                if dl_dict['annotated']:
-                    slice_and_write_project(data, data_level, project, outpath, args)
-                else:
-                    slice_and_write_project(data, data_level, project, outpath, args)
+            data_path = glob.glob(os.path.join(build_path, dl_dict['search_pattern']))[0]
+            print(data_path)
+            deal_data_level(data_path, data_level, projects, inst, outpath, args.sig_id_cols)
 
 
 if __name__ == "__main__":
@@ -44,18 +44,23 @@ while test $# -gt 0; do
       shift
       SIG_ID_COLS=$1
       ;;
+    -g|--gctx_build_paths)
+      shift
+      GCTX_BUILD_PATHS=$1
+      ;;
     -o|--out)
       shift
       OUT_DIR=$1
       ;;
     -v| --verbose)
-      shift
       VERBOSE=true
       ;;
     --ignore_missing)
-      shift
       IGNORE_MISSING=true
       ;;
+    --partition)
+      PARTITION=true
+      ;;
     *)
       printf "Unknown parameter: %s \n" "$1"
       shift
@@ -67,7 +72,8 @@ done
 
 
 ##Run Collate
-if [[ -z $BUILD_PATH || -z $OUT_DIR ]]
+# --partition only writes under the build path, the other runs need an output folder
+if [[ -z $BUILD_PATH || ( -z $OUT_DIR && -z $PARTITION ) ]]
 then
   printf "Required arguments missing\n"
   exit -1
@@ -104,11 +110,14 @@ then
     args+=(-k "$KEY")
 fi
 
-if [ ! -d $OUT_DIR ]
+if [[ ! -z $OUT_DIR ]]
 then
-  mkdir -p $OUT_DIR
+  if [ ! -d $OUT_DIR ]
+  then
+    mkdir -p $OUT_DIR
+  fi
+  args+=(-o "$OUT_DIR")
 fi
-args+=(-o "$OUT_DIR")
 
 if [[ ! -z $VERBOSE ]]
 then
@@ -120,6 +129,16 @@ then
   args+=(--ignore_missing)
 fi
 
+if [[ ! -z $PARTITION ]]
+then
+  args+=(--partition)
+fi
+
+if [[ ! -z $GCTX_BUILD_PATHS ]]
+then
+  args+=(-g "$GCTX_BUILD_PATHS")
+fi
+
 echo python /clue/bin/deal.py "${args[@]}"
 
 python /clue/bin/deal.py "${args[@]}"
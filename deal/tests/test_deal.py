@@ -0,0 +1,277 @@
+import os
+import glob
+import shutil
+import logging
+import tempfile
+import unittest
+import unittest.mock as mock
+import h5py
+import numpy as np
+import pandas as pd
+import deal
+
+logger = logging.getLogger('deal')
+
+plates = ['PL{}'.format(i) for i in range(4)]
+projects = ['PA', 'PB', 'PC']
+cells = ['c{}'.format(i) for i in range(5)]
+data_levels = [k for (k, v) in deal.build_contents_dict.items() if v['type'] == 'data']
+
+
+def write_build(build_path, rng):
+    '''
+    a small stacked build: 4 plates of 10 profiles, 3 vehicle controls and a poscon on each plate, the treatments dealt
+    to 3 projects, one control of PL0 assigned to PA, and the rows of the data levels shuffled
+    '''
+    os.makedirs(build_path)
+    rows = []
+    for plate in plates:
+        for w in range(10):
+            pert_type = 'ctl_vehicle' if w < 3 else ('trt_poscon' if w == 3 else 'trt_cp')
+            if pert_type == 'trt_cp':
+                project = 'PC' if plate == 'PL3' else rng.choice(projects)
+            else:
+                project = 'PA' if (w == 0 and plate == 'PL0') else np.nan
+            rows.append({'profile_id': '{}:{}'.format(plate, w), 'pert_plate': plate,
+                         'prism_replicate': plate + '_X1', 'pert_type': pert_type, 'x_project_id': project,
+                         'pert_id': 'BRD{}'.format(w % 4), 'pert_idose': '{} uM'.format(w % 3), 'pert_time': 24,
+                         'culture': 'PR300'})
+    inst = pd.DataFrame(rows)
+    inst.to_csv(os.path.join(build_path, 'T_inst_info.txt'), sep='\t', index=False)
+    pd.DataFrame({'ccle_name': cells}).to_csv(os.path.join(build_path, 'T_cell_info.txt'), sep='\t', index=False)
+    pd.DataFrame({'prism_replicate': [plate + '_X1' for plate in plates], 'ssmd': 1.5}).to_csv(
+        os.path.join(build_path, 'T_QC_TABLE.csv'), index=False)
+
+    for data_level in ['LEVEL2_COUNT', 'LEVEL2_MFI']:
+        data = pd.DataFrame([{'rid': 'r{}'.format(c), 'cid': profile_id, 'value': '{:.3f}'.format(rng.random_sample())}
+                             for profile_id in inst.profile_id for c in range(len(cells))])
+        data.sample(frac=1, random_state=1).to_csv(
+            os.path.join(build_path, 'T_{}_n40x5.csv'.format(data_level)), index=False)
+
+    annotated = pd.DataFrame([dict(row, ccle_name=c, LFC='{:.3f}'.format(rng.random_sample()))
+                              for row in rows for c in cells]).sample(frac=1, random_state=2)
+    for data_level in ['LEVEL3_LMFI', 'LEVEL3_NORMALIZED_COUNTS', 'LEVEL4_LFC', 'LEVEL4_LFC_COMBAT']:
+        annotated.to_csv(os.path.join(build_path, 'T_{}_n40x5.csv'.format(data_level)), index=False)
+    level5 = annotated.loc[annotated.pert_type == 'trt_cp'].drop(['profile_id', 'pert_type'], axis=1)
+    for data_level in ['LEVEL5_LFC', 'LEVEL5_LFC_COMBAT']:
+        level5.to_csv(os.path.join(build_path, 'T_{}_n1x5.csv'.format(data_level)), index=False)
+    return inst
+
+
+def write_gctx_builds(tmp, build_path, inst, rng):
+    '''
+    LEVEL2 gctx files of two collate builds holding the profiles of inst, and a profile of no project, and the LEVEL2
+    csvs of build_path replaced by their long tables as stack writes them
+    :return: paths of the collate builds
+    '''
+    profile_ids = list(inst.profile_id)
+    builds = [(profile_ids[:23], ['r{}'.format(j) for j in range(5)]),
+              (profile_ids[23:] + ['OTHER:1'], ['r{}'.format(j) for j in range(2, 8)])]
+    gctx_build_paths = []
+    long_tables = []
+    for (i, (col_ids, row_ids)) in enumerate(builds):
+        gctx_build_path = os.path.join(tmp, 'collate{}'.format(i))
+        os.makedirs(gctx_build_path)
+        matrix = rng.random_sample((len(col_ids), len(row_ids))).astype(np.float32)
+        matrix[0, 0] = -666
+        for data_type in ['MFI', 'COUNT']:
+            path = os.path.join(gctx_build_path, 'C{}_LEVEL2_{}_n{}x{}.gctx'.format(
+                i, data_type, len(col_ids), len(row_ids)))
+            with h5py.File(path, 'w') as f:
+                f.create_dataset(deal.gctx_matrix_node, data=matrix)
+                f.create_dataset(deal.gctx_row_id_node, data=np.array([x.encode('utf-8') for x in row_ids]))
+                f.create_dataset(deal.gctx_col_id_node, data=np.array([x.encode('utf-8') for x in col_ids]))
+        gctx_build_paths.append(gctx_build_path)
+        long_tables.append(pd.DataFrame({'rid': np.tile(row_ids, len(col_ids)), 'cid': np.repeat(col_ids, len(row_ids)),
+                                         'value': matrix.reshape(-1)}, columns=['rid', 'cid', 'value']))
+
+    for data_level in ['LEVEL2_COUNT', 'LEVEL2_MFI']:
+        for path in glob.glob(os.path.join(build_path, 'T_{}_*.csv'.format(data_level))):
+            os.remove(path)
+        with open(os.path.join(build_path, 'T_{}_n41x8.csv'.format(data_level)), 'w') as f:
+            for (i, long_table) in enumerate(long_tables):
+                long_table.to_csv(f, index=False, header=(i == 0))
+    return gctx_build_paths
+
+
+def run_deal(arguments):
+    deal.main(deal.build_parser().parse_args(arguments))
+
+
+def read_outputs(outpath, pattern='*'):
+    '''
+    the files written for the projects, by path relative to outpath
+    '''
+    return {os.path.relpath(path, outpath): pd.read_csv(path, sep=None, engine='python')
+            for path in sorted(glob.glob(os.path.join(outpath, '*', 'data', pattern)))}
+
+
+def sorted_rows(df):
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+class TestDeal(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.build_path = os.path.join(self.tmp, 'build')
+        self.inst = write_build(self.build_path, np.random.RandomState(0))
+        self.csv_chunk_rows = deal._csv_chunk_rows
+        deal._csv_chunk_rows = 7
+
+    def tearDown(self):
+        deal._csv_chunk_rows = self.csv_chunk_rows
+        shutil.rmtree(self.tmp)
+
+    def run_array_jobs(self, outpath, extra=None):
+        for project in projects:
+            for data_level in data_levels:
+                run_deal(['-b', self.build_path, '-o', outpath, '-p', project, '-k', data_level] + (extra or []))
+
+    def test_level2_members(self):
+        members = deal.level2_members(self.inst, projects)
+        for (code, project) in enumerate(projects):
+            expected = deal.get_data_plus_controls(self.inst, project)['profile_id'].unique()
+            self.assertEqual(sorted(expected), sorted(members.loc[members.code == code, 'profile_id']))
+
+    def test_write_routed(self):
+        outpath = os.path.join(self.tmp, 'routed')
+        chunk = pd.DataFrame({'cid': ['a', 'b', 'c', 'd'], 'rid': ['r0', 'r0', 'r1', 'r1']})
+        writers = [deal.ProjectWriter(outpath, project, 'LEVEL2_MFI', ['cid', 'rid'], 'cid', 'rid')
+                   for project in projects[:2]]
+        deal.write_routed(chunk, [3, 0, 1, 3, 2], [0, 1, 0, 1, 1], writers)
+        paths = [writer.close() for writer in writers]
+        self.assertEqual(['PA_LEVEL2_MFI_n2x2.csv', 'PB_LEVEL2_MFI_n3x2.csv'], [os.path.basename(x) for x in paths])
+        self.assertEqual(['b', 'd'], list(pd.read_csv(paths[0]).cid))
+        self.assertEqual(['a', 'c', 'd'], list(pd.read_csv(paths[1]).cid))
+
+    def test_deal_all_projects(self):
+        # every project dealt in one pass holds the same rows, in the same order, as the array jobs of one project
+        full_path = os.path.join(self.tmp, 'full')
+        array_path = os.path.join(self.tmp, 'array')
+        run_deal(['-b', self.build_path, '-o', full_path])
+        self.run_array_jobs(array_path)
+
+        expected = read_outputs(array_path)
+        actual = read_outputs(full_path, '*LEVEL*')
+        logger.debug("files:  {}".format(list(actual.keys())))
+        self.assertEqual(len(projects) * len(data_levels), len(actual))
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for (name, df) in expected.items():
+            pd.testing.assert_frame_equal(df, actual[name], check_dtype=False)
+        self.assertEqual([], glob.glob(os.path.join(full_path, '*', 'data', '*.tmp')))
+
+    def test_write_partitions(self):
+        run_deal(['-b', self.build_path, '--partition'])
+        index = deal.read_partition_index(self.build_path)
+
+        self.assertEqual(sorted(data_levels), sorted(index['levels'].keys()))
+        self.assertEqual(sorted(data_levels + ['inst_info']), sorted(index['sources'].keys()))
+        inst_path = os.path.join(self.build_path, 'T_inst_info.txt')
+        stat = os.stat(inst_path)
+        self.assertEqual({'name': 'T_inst_info.txt', 'size': stat.st_size, 'mtime': stat.st_mtime},
+                         index['sources']['inst_info'])
+        for project in projects:
+            expected = self.inst.loc[self.inst.x_project_id == project, 'prism_replicate'].unique()
+            self.assertEqual(sorted(expected), index['prism_replicates'][project])
+
+        # the project partitions and the plate partitions together hold every row of the level dealt to a project,
+        # a vehicle control assigned to a project is in both
+        level_path = os.path.join(self.build_path, deal.partition_dir, 'LEVEL4_LFC')
+        partitions = [pd.read_csv(os.path.join(level_path, x)) for x in set(
+            [p['rows'] for p in index['levels']['LEVEL4_LFC'].values() if p['rows'] is not None] +
+            sum([p['plates'] for p in index['levels']['LEVEL4_LFC'].values()], []))]
+        level = pd.read_csv(os.path.join(self.build_path, 'T_LEVEL4_LFC_n40x5.csv'))
+        level = level.loc[level.x_project_id.notna() | level.pert_type.isin(deal.CTL_TYPES)]
+        pd.testing.assert_frame_equal(sorted_rows(level), sorted_rows(pd.concat(partitions).drop_duplicates()),
+                                      check_dtype=False)
+
+        self.assertIsNone(deal.read_partition_index(self.tmp))
+
+    def test_partitioned_array_jobs(self):
+        # the array jobs read the partitions of their project, rows first and then the controls plate by plate
+        expected_path = os.path.join(self.tmp, 'expected')
+        partitioned_path = os.path.join(self.tmp, 'partitioned')
+        self.run_array_jobs(expected_path)
+        run_deal(['-b', self.build_path, '--partition'])
+        with mock.patch.object(deal.pd, 'read_csv', wraps=pd.read_csv) as read_csv:
+            self.run_array_jobs(partitioned_path)
+            read_paths = set([x[0][0] for x in read_csv.call_args_list if isinstance(x[0][0], str)])
+        self.assertFalse(any(['T_LEVEL4_LFC' in x for x in read_paths]))
+        self.assertTrue(any([deal.partition_dir in x for x in read_paths]))
+
+        expected = read_outputs(expected_path)
+        actual = read_outputs(partitioned_path)
+        self.assertEqual(sorted(expected.keys()), sorted(actual.keys()))
+        for (name, df) in expected.items():
+            pd.testing.assert_frame_equal(sorted_rows(df), sorted_rows(actual[name]), check_dtype=False)
+
+        run_deal(['-b', self.build_path, '-o', partitioned_path, '-p', 'PB', '-k', 'QC_TABLE'])
+        qc = pd.read_csv(os.path.join(partitioned_path, 'PB', 'data', 'PB_QC_TABLE.csv'))
+        self.assertEqual(sorted(self.inst.loc[self.inst.x_project_id == 'PB', 'prism_replicate'].unique()),
+                         sorted(qc.prism_replicate))
+
+    def test_stale_partitions(self):
+        run_deal(['-b', self.build_path, '--partition'])
+        level_path = os.path.join(self.build_path, 'T_LEVEL4_LFC_n40x5.csv')
+        level = pd.read_csv(level_path)
+        level.iloc[:len(level) // 2].to_csv(level_path, index=False)
+        index = deal.read_partition_index(self.build_path)
+        self.assertFalse(deal.partitions_match(self.build_path, index, 'LEVEL4_LFC'))
+        self.assertTrue(deal.partitions_match(self.build_path, index, 'LEVEL3_LMFI'))
+
+        # a level file changed after --partition is read in place of its partitions
+        expected_path = os.path.join(self.tmp, 'expected')
+        actual_path = os.path.join(self.tmp, 'actual')
+        with mock.patch.object(deal, 'read_partition_index', return_value=None):
+            run_deal(['-b', self.build_path, '-o', expected_path, '-p', 'PA', '-k', 'LEVEL4_LFC'])
+        run_deal(['-b', self.build_path, '-o', actual_path, '-p', 'PA', '-k', 'LEVEL4_LFC'])
+        expected = read_outputs(expected_path)
+        self.assertEqual(expected.keys(), read_outputs(actual_path).keys())
+        for (name, df) in expected.items():
+            pd.testing.assert_frame_equal(df, read_outputs(actual_path)[name])
+
+    def test_column_runs(self):
+        self.assertEqual([], deal.column_runs(np.array([], dtype=np.int64), 4))
+        self.assertEqual([(0, 3), (5, 7), (9, 10)], deal.column_runs(np.array([0, 1, 2, 5, 6, 9]), 4))
+        self.assertEqual([(0, 2), (2, 3), (5, 7), (9, 10)], deal.column_runs(np.array([0, 1, 2, 5, 6, 9]), 2))
+
+    def test_level2_from_gctx(self):
+        gctx_build_paths = write_gctx_builds(self.tmp, self.build_path, self.inst, np.random.RandomState(3))
+        self.assertEqual([os.path.join(gctx_build_paths[0], 'C0_LEVEL2_MFI_n23x5.gctx'),
+                          os.path.join(gctx_build_paths[1], 'C1_LEVEL2_MFI_n18x6.gctx')],
+                         deal.level2_gctx_paths(','.join(gctx_build_paths), 'LEVEL2_MFI'))
+
+        block_values = deal._block_values
+        deal._block_values = 9
+        try:
+            # the array jobs read hyperslabs of the gctx files and write the rows of the csv, as its text
+            expected_path = os.path.join(self.tmp, 'expected')
+            actual_path = os.path.join(self.tmp, 'actual')
+            for project in projects + ['PZ']:
+                for data_level in ['LEVEL2_COUNT', 'LEVEL2_MFI']:
+                    run_deal(['-b', self.build_path, '-o', expected_path, '-p', project, '-k', data_level])
+                    run_deal(['-b', self.build_path, '-o', actual_path, '-p', project, '-k', data_level,
+                              '-g', ','.join(gctx_build_paths)])
+            names = sorted(os.path.relpath(x, expected_path)
+                           for x in glob.glob(os.path.join(expected_path, '*', 'data', '*')))
+            self.assertEqual(8, len(names))
+            self.assertEqual(names, sorted(os.path.relpath(x, actual_path)
+                                           for x in glob.glob(os.path.join(actual_path, '*', 'data', '*'))))
+            for name in names:
+                with open(os.path.join(expected_path, name)) as f, open(os.path.join(actual_path, name)) as g:
+                    self.assertEqual(f.read(), g.read(), name)
+
+            full_path = os.path.join(self.tmp, 'full')
+            run_deal(['-b', self.build_path, '-o', full_path, '-g', ','.join(gctx_build_paths)])
+            actual = read_outputs(full_path, '*LEVEL2*')
+            for (name, df) in read_outputs(expected_path).items():
+                if not name.startswith('PZ'):
+                    pd.testing.assert_frame_equal(df, actual[name])
+        finally:
+            deal._block_values = block_values
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    unittest.main()
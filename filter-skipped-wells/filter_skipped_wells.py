@@ -8,6 +8,12 @@ import os
 import gzip
 import io
 
+import clue_api_client
+import plate_geometry
+
+#integer well index added to both sides of the skipped well join
+_well_index_column = 'pert_well_index'
+
 def make_request_url_filter(endpoint_url, where=None, fields=None):
     clauses = []
     if where:
@@ -45,11 +51,7 @@ def make_request_url_filter(endpoint_url, where=None, fields=None):
 def get_data_from_db(endpoint_url, user_key, where=None, fields=None):
     request_url = make_request_url_filter(endpoint_url, where=where, fields=fields)
     print(request_url)
-    response = requests.get(request_url, headers={'user_key': user_key, 'prism_key': 'prism_mts'})
-    if response.ok:
-        return response.json()
-    else:
-        response.raise_for_status()
+    return clue_api_client.get_client().get_json(request_url, headers={'user_key': user_key, 'prism_key': 'prism_mts'})
 
 
 def load_df_from_s3(partial_filename, prefix, bucket_name='macchiato.clue.io'):
@@ -100,17 +102,29 @@ def process_data(data, plates):
         print(f"Warning: Not all columns to match are present in the sw_data. No merge performed.")
         return data, pd.DataFrame()
 
+    # Join on integer well indexes rather than well names, "A1" and "A01" are the same well.  Missing or unparseable
+    # wells get index -1 in data and are dropped from sw_data, so they never match
+    data_valid = plate_geometry.valid_wells(data['pert_well'].values)
+    sw_valid = plate_geometry.valid_wells(sw_data['pert_well'].values)
+    ((valid_data_indexes, sw_well_indexes), _) = plate_geometry.common_well_indexes(
+        data['pert_well'].values[data_valid].astype(str), sw_data['pert_well'].values[sw_valid].astype(str))
+    data_well_indexes = np.full(len(data), -1, dtype=np.int64)
+    data_well_indexes[data_valid] = valid_data_indexes
+    join_cols = [_well_index_column if c == 'pert_well' else c for c in cols_to_match]
+    sw_keys = sw_data.loc[sw_valid, [c for c in cols_to_match if c != 'pert_well']].assign(
+        **{_well_index_column: sw_well_indexes})
+
     # Merge the two dataframes on the specified columns with the indicator argument
-    merged = data.merge(sw_data[cols_to_match],
-                        on=cols_to_match,
-                        how='left',
-                        indicator=True)
+    merged = data.assign(**{_well_index_column: data_well_indexes}).merge(sw_keys[join_cols],
+                                                                          on=join_cols,
+                                                                          how='left',
+                                                                          indicator=True)
 
     # Filter out the rows that are present in both dataframes
-    level3_data_filtered = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge'])
+    level3_data_filtered = merged[merged['_merge'] == 'left_only'].drop(columns=['_merge', _well_index_column])
 
     # Filter the rows that are present in both dataframes to get the values that are filtered out
-    filtered_out_values = merged[merged['_merge'] == 'both'].drop(columns=['_merge'])
+    filtered_out_values = merged[merged['_merge'] == 'both'].drop(columns=['_merge', _well_index_column])
 
     return level3_data_filtered, filtered_out_values
 
@@ -143,6 +157,7 @@ if __name__ == "__main__":
         API_URL = API_URL.rstrip("/") + "/api/"
 
     SW_URL = API_URL.rstrip("/") + '/v_assay_plate_skipped_well/'
+
     # BUCKET_NAME = 'macchiato.clue.io'
 
     search_pattern = "*LEVEL3_LMFI.csv"
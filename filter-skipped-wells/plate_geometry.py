@@ -0,0 +1,186 @@
+"""
+Plate geometry - conversion between Luminex location strings, well names, (row, column) and integer well indexes for
+96, 384 and 1536 well plates.
+
+Rows are lettered A..Z then AA..AF (1536 well plates) and columns are numbered from 1.  The index of a well is
+row * n_cols + col, counted from 0 in the geometry of the plate, so wells can be compared, sorted and joined as
+integers.  Conversions from strings work on the distinct values of their input, a plate of any size only parses each
+well name once and the results are mapped back with numpy.
+
+The module only depends on numpy so that it can be copied as is next to the other scripts that handle wells.
+"""
+import re
+import functools
+import collections
+
+import numpy as np
+
+PlateGeometry = collections.namedtuple("PlateGeometry", ["n_wells", "n_rows", "n_cols"])
+
+geometries = collections.OrderedDict([
+    (96, PlateGeometry(96, 8, 12)),
+    (384, PlateGeometry(384, 16, 24)),
+    (1536, PlateGeometry(1536, 32, 48))
+])
+
+_well_re = re.compile(r"^\s*([A-Za-z]{1,2})0*(\d+)\s*$")
+
+
+def get_geometry(n_wells):
+    if n_wells not in geometries:
+        raise ValueError("plate_geometry unsupported number of wells - n_wells:  {}  supported:  {}".format(
+            n_wells, list(geometries.keys())))
+    return geometries[n_wells]
+
+
+def row_label(row):
+    '''
+    letters of a row counted from 0 - 0 is "A", 25 is "Z", 26 is "AA"
+    '''
+    return chr(ord("A") + row) if row < 26 else "A" + chr(ord("A") + row - 26)
+
+
+def parse_row_label(label):
+    label = label.upper()
+    if len(label) == 1:
+        return ord(label) - ord("A")
+    return 26 + ord(label[1]) - ord("A")
+
+
+@functools.lru_cache(maxsize=None)
+def well_names(geometry):
+    '''
+    names of all the wells of a plate in index order, e.g. "A01", "A02" ... "P24"
+    '''
+    return np.array(["{}{:02d}".format(row_label(r), c + 1) for r in range(geometry.n_rows) for c in range(geometry.n_cols)],
+                    dtype=object)
+
+
+def _parse_unique(values, parse):
+    '''
+    apply parse to each distinct value only
+    :return: (list of parsed distinct values, inverse array mapping each value to its distinct value)
+    '''
+    values = np.asarray(values, dtype=object)
+    if len(values) == 0:
+        return ([], np.zeros(0, dtype=np.int64))
+    (uniques, inverse) = np.unique(values.astype(str), return_inverse=True)
+    return ([parse(u) for u in uniques], inverse.reshape(-1))
+
+
+def _parse_well(well):
+    m = _well_re.match(well)
+    if m is None:
+        raise ValueError("plate_geometry could not parse well:  {}".format(well))
+    return (parse_row_label(m.group(1)), int(m.group(2)) - 1)
+
+
+def valid_wells(wells):
+    '''
+    which wells are well names that can be parsed - missing values (None, NaN) and other strings are not
+    :return: bool array, one entry per well
+    '''
+    (parsed, inverse) = _parse_unique(wells, lambda w: _well_re.match(w) is not None)
+    return np.array(parsed, dtype=bool)[inverse] if len(parsed) > 0 else np.zeros(0, dtype=bool)
+
+
+def wells_to_rowcol(wells):
+    '''
+    :param wells: list / array of well names, with or without zero padding ("A1" and "A01" are the same well)
+    :return: (rows, cols) int arrays, both counted from 0
+    '''
+    (parsed, inverse) = _parse_unique(wells, _parse_well)
+    rowcol = np.array(parsed, dtype=np.int64).reshape(-1, 2)
+    return (rowcol[inverse, 0], rowcol[inverse, 1])
+
+
+def infer_geometry(rows, cols):
+    '''
+    smallest of the supported plates that holds all the (rows, cols)
+    '''
+    n_rows = int(np.max(rows)) + 1 if len(rows) > 0 else 0
+    n_cols = int(np.max(cols)) + 1 if len(cols) > 0 else 0
+    for g in geometries.values():
+        if n_rows <= g.n_rows and n_cols <= g.n_cols:
+            return g
+    raise ValueError("plate_geometry wells do not fit on any supported plate - n_rows:  {}  n_cols:  {}".format(
+        n_rows, n_cols))
+
+
+def rowcol_to_indexes(rows, cols, geometry):
+    rows = np.asarray(rows, dtype=np.int64)
+    cols = np.asarray(cols, dtype=np.int64)
+    if np.any((rows < 0) | (rows >= geometry.n_rows) | (cols < 0) | (cols >= geometry.n_cols)):
+        raise ValueError("plate_geometry wells outside of a {} well plate".format(geometry.n_wells))
+    return rows * geometry.n_cols + cols
+
+
+def indexes_to_rowcol(indexes, geometry):
+    return np.divmod(np.asarray(indexes, dtype=np.int64), geometry.n_cols)
+
+
+def wells_to_indexes(wells, geometry=None):
+    '''
+    integer indexes of wells
+    :param wells: list / array of well names
+    :param geometry: PlateGeometry, when None the smallest plate holding all the wells is used
+    :return: (int array of indexes, geometry)
+    '''
+    (rows, cols) = wells_to_rowcol(wells)
+    geometry = geometry if geometry is not None else infer_geometry(rows, cols)
+    return (rowcol_to_indexes(rows, cols, geometry), geometry)
+
+
+def indexes_to_wells(indexes, geometry):
+    '''
+    zero padded well names of indexes, e.g. "A01"
+    '''
+    return well_names(geometry)[np.asarray(indexes, dtype=np.int64)]
+
+
+def _parse_location(location):
+    # locations are "<sample number>(<plate>,<well>)", e.g. "1(1,A1)"
+    split = location.split(",")
+    right_paren_index = split[1].index(")")
+    return _parse_well(split[1][0:right_paren_index])
+
+
+def locations_to_rowcol(locations):
+    (parsed, inverse) = _parse_unique(locations, _parse_location)
+    rowcol = np.array(parsed, dtype=np.int64).reshape(-1, 2)
+    return (rowcol[inverse, 0], rowcol[inverse, 1])
+
+
+def locations_to_wells(locations):
+    '''
+    zero padded well names of Luminex locations, e.g. "1(1,A1)" becomes "A01"
+    :param locations: list / array of location strings
+    :return: list of well names
+    '''
+    (rows, cols) = locations_to_rowcol(locations)
+    if len(rows) == 0:
+        return []
+    #names do not depend on the plate size, the largest plate holds every well
+    return list(indexes_to_wells(rowcol_to_indexes(rows, cols, geometries[1536]), geometries[1536]))
+
+
+def common_well_indexes(*well_lists):
+    '''
+    integer indexes of several lists of wells in one geometry, the smallest plate holding all of them, so that the
+    indexes can be compared or joined across the lists
+    :return: (list of int arrays, one per well list, geometry)
+    '''
+    lengths = [len(wl) for wl in well_lists]
+    (rows, cols) = wells_to_rowcol([w for wl in well_lists for w in wl])
+    geometry = infer_geometry(rows, cols)
+    indexes = rowcol_to_indexes(rows, cols, geometry)
+    return (np.split(indexes, np.cumsum(lengths)[:-1]), geometry)
+
+
+def isin_wells(wells, keep_wells):
+    '''
+    vectorized membership of wells in keep_wells, comparing integer indexes so that "A1" matches "A01"
+    :return: bool array, one entry per well of wells
+    '''
+    ((indexes, keep_indexes), _) = common_well_indexes(list(wells), list(keep_wells))
+    return np.isin(indexes, keep_indexes)
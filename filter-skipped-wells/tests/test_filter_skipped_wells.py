@@ -0,0 +1,56 @@
+import logging
+import unittest
+import unittest.mock as mock
+import numpy as np
+import pandas as pd
+import filter_skipped_wells
+
+logger = logging.getLogger('filter_skipped_wells')
+
+
+def level3(wells, replicates):
+    return pd.DataFrame({'screen': 'MTS001', 'pert_plate': 'PMTS001', 'pert_well': wells, 'pool_id': 'P1',
+                         'replicate': replicates, 'LMFI': np.arange(len(wells), dtype=float)})
+
+
+class TestProcessData(unittest.TestCase):
+    def process_data(self, data, sw_records):
+        # SW_URL and API_KEY are set when the script is run
+        with mock.patch.object(filter_skipped_wells, 'SW_URL', 'https://api.clue.io/api/skipped/', create=True), \
+                mock.patch.object(filter_skipped_wells, 'API_KEY', 'key', create=True), \
+                mock.patch.object(filter_skipped_wells, 'get_data_from_db', return_value=sw_records) as get_data:
+            result = filter_skipped_wells.process_data(data, ['PMTS001'])
+        get_data.assert_called_once_with(endpoint_url='https://api.clue.io/api/skipped/', user_key='key',
+                                         where={'pert_plate': ['PMTS001']})
+        return result
+
+    def test_process_data(self):
+        data = level3(['A01', 'A02', np.nan, 'bad', 'B03', 'B03', 'A1'], ['X1', 'X1', 'X1', 'X1', 'X2', 'X1', 'X2'])
+        # A1 is the well A01, missing or unparseable wells never match, not even each other
+        skipped = level3(['A1', 'bad', np.nan, 'B03', 'C05'], 'X1').drop(columns='LMFI') \
+            .rename(columns={'pert_well': 'assay_well_position'})
+        skipped['id'] = range(len(skipped))
+
+        (kept, removed) = self.process_data(data, skipped.to_dict('records'))
+        logger.debug("kept:  {}  removed:  {}".format(kept.shape, removed.shape))
+        pd.testing.assert_frame_equal(data.iloc[[1, 2, 3, 4, 6]].reset_index(drop=True), kept.reset_index(drop=True))
+        pd.testing.assert_frame_equal(data.iloc[[0, 5]].reset_index(drop=True), removed.reset_index(drop=True))
+
+    def test_process_data_unmatched(self):
+        data = level3(['A01', 'A02'], 'X1')
+
+        # no skipped wells on the plates
+        (kept, removed) = self.process_data(data, [])
+        self.assertIs(data, kept)
+        self.assertTrue(removed.empty)
+
+        # skipped wells without the columns to match on
+        (kept, removed) = self.process_data(data, [{'pert_plate': 'PMTS001', 'assay_well_position': 'A1'}])
+        self.assertIs(data, kept)
+        self.assertTrue(removed.empty)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    unittest.main()
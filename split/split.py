@@ -90,7 +90,7 @@ def read_build_file_in_chunks(search_pattern, build_path, chunksize=1000):
     fstr = os.path.join(build_path, "*" + search_pattern + "*")
     fmatch = glob.glob(fstr)
     assert len(fmatch) == 1, "Incorrect number of files found: {}".format(fmatch)
-    return pd.read_csv(fmatch[0], chunksize=chunksize)
+    return pd.read_csv(fmatch[0], chunksize=chunksize, dtype={'pert_dose': 'str', 'pert_idose': 'str'})
 
 
 def main(args):
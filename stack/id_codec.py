@@ -0,0 +1,60 @@
+"""
+Composite identifiers (sig_id, feature_id, ...) built from a list of columns of a table.
+
+The columns are factorized together so that each distinct combination of their values is formatted only once - a
+LEVEL5 table has millions of rows but only as many distinct sig_ids as signatures - and the ids are mapped back to the
+rows with numpy.  Every value is written as str() writes it and missing values as "nan", as
+'_'.join([str(row[col]) for col in cols]) does row by row.
+
+The module only depends on numpy and pandas so that it can be copied as is next to the other scripts that build ids.
+"""
+import numpy as np
+import pandas as pd
+
+
+def _column_strings(values):
+    values = pd.Series(values).astype(object)
+    return values.where(values.notna(), 'nan').astype(str).values
+
+
+def _surrogate_keys(table, columns):
+    '''
+    integer key of each row of table, the same for rows with the same values in columns.  Keys are numbered in order
+    of first appearance and missing values are a value of their own
+    :param table: DataFrame
+    :param columns: list of column names
+    :return: (int64 array of keys, DataFrame of the distinct combinations of columns, one row per key)
+    '''
+    keys = np.zeros(len(table), dtype=np.int64)
+    for col in columns:
+        (codes, uniques) = pd.factorize(table[col])
+        codes = np.where(codes < 0, len(uniques), codes)
+        (keys, _) = pd.factorize(keys * (len(uniques) + 1) + codes)
+
+    (_, first_rows) = np.unique(keys, return_index=True)
+    return (keys.astype(np.int64), table[columns].iloc[first_rows].reset_index(drop=True))
+
+
+def join_columns(table, columns, sep='_'):
+    '''
+    the values of columns joined with sep, row by row, with vectorized string concatenation
+    :return: numpy array of strings
+    '''
+    ids = _column_strings(table[columns[0]])
+    for col in columns[1:]:
+        ids = np.char.add(np.char.add(ids.astype(str), sep), _column_strings(table[col]))
+    return ids.astype(object)
+
+
+def make_ids(table, columns, sep='_'):
+    '''
+    composite id of each row of table.  The distinct combinations of columns are joined once and mapped back to the rows
+    :param table: DataFrame
+    :param columns: list of column names, or a comma separated string of them
+    :param sep: separator of the values
+    :return: numpy array of ids, one per row
+    '''
+    if isinstance(columns, str):
+        columns = columns.split(',')
+    (keys, combinations) = _surrogate_keys(table, columns)
+    return join_columns(combinations, columns, sep=sep)[keys]
@@ -1,14 +1,32 @@
 import os
-import re
 import sys
 import glob
 import logging
 import argparse
+import concurrent.futures
+import h5py
+import numpy as np
 import pandas as pd
-from cmapPy.pandasGEXpress.parse import parse
+import id_codec
 
 logger = logging.getLogger('stack')
 
+gctx_matrix_node = '/0/DATA/0/matrix'
+gctx_row_id_node = '/0/META/ROW/id'
+gctx_col_id_node = '/0/META/COL/id'
+
+# number of matrix values unpivoted at a time when a gctx is written as a long table
+_block_values = 1 << 22
+
+# number of rows of the csvs of the csv_data keys read at a time
+_csv_chunk_rows = 100000
+
+# --memory_budget: estimated bytes of memory per byte of input file, by type of key, and for any process
+_memory_per_file_byte = {'metadata': 10, 'report': 10, 'key': 10, 'csv_data': 10, 'gctx': 4}
+_memory_overhead_bytes = 200 * 2 ** 20
+# streamed keys only hold a chunk of their input, about this many bytes of file
+_streamed_key_bytes = {'csv_data': 64 * 2 ** 20, 'gctx': 4 * _block_values}
+
 
 def build_parser():
     parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.ArgumentDefaultsHelpFormatter)
@@ -22,30 +40,87 @@ def build_parser():
                         )
     # parser.add_argument('--ignore_missing', action="store_true", default=False)
     parser.add_argument('--out', '-o', help='Output for collated build')
+    parser.add_argument('--output_format', '-f', help='Format of the long tables written for the gctx keys, parquet needs pyarrow',
+                        choices=['csv', 'parquet'], default='csv')
+    parser.add_argument('--n_workers', '-w', help='Number of processes stacking keys in parallel, by default the keys are '
+                                                  'stacked one after the other, or across the number of cpus when '
+                                                  '--memory_budget is given', type=int, default=None)
+    parser.add_argument('--memory_budget', '-m', help='MB of memory the keys stacked at the same time may use, '
+                                                      'estimated from the size of their files, default is no limit',
+                        type=int, default=None)
     parser.add_argument("--verbose", '-v', help="Whether to print a bunch of output", action="store_true",
                         default=False)
 
     return parser
 
 
-def melt_and_concat_gcts(gct_paths):
-    gct_data = []
-    for gct_path in gct_paths:
-        gct_data.append(parse(gct_path).data_df.reset_index().melt(id_vars='rid'))
-
-    melted_gcts = pd.concat(gct_data)
-    return melted_gcts
-
-
-# Get dimensions from list of file_paths
-def sum_dims_from_paths(file_paths):
-    nc, nr = 0, 0
-    for fp in file_paths:
-        match = re.search('n([0-9]+)x([0-9]+).*', fp)
-        nc += int(match.group(1))
-        nr += int(match.group(2))
-
-    return nc, nr
+def read_gctx_ids(path):
+    '''
+    (row ids, column ids) of a gctx, read without its matrix
+    '''
+    with h5py.File(path, 'r') as f:
+        return tuple([np.array([x.decode('utf-8') if isinstance(x, bytes) else str(x) for x in f[node][()]], dtype=object)
+                      for node in [gctx_row_id_node, gctx_col_id_node]])
+
+
+def long_blocks(gctx_path, block_values=_block_values):
+    '''
+    the matrix of a gctx unpivoted into rid, cid and value, a block of columns at a time, in the order of
+    data_df.reset_index().melt(id_vars='rid').  Only one block of the matrix is held in memory
+    :param gctx_path:
+    :param block_values: number of values read at a time
+    :return: generator of DataFrames
+    '''
+    (row_ids, col_ids) = read_gctx_ids(gctx_path)
+    block_cols = max(1, block_values // max(1, len(row_ids)))
+    with h5py.File(gctx_path, 'r') as f:
+        matrix = f[gctx_matrix_node]
+        for start in range(0, len(col_ids), block_cols):
+            stop = min(start + block_cols, len(col_ids))
+            values = matrix[start:stop]
+            yield pd.DataFrame({'rid': np.tile(row_ids, stop - start),
+                                'cid': np.repeat(col_ids[start:stop], len(row_ids)),
+                                'value': values.reshape(-1)}, columns=['rid', 'cid', 'value'])
+
+
+def stack_gctx_long(gctx_paths, out, build_name, key, output_format='csv'):
+    '''
+    write the matrices of gctx_paths one after the other as a long table of rid, cid and value.  The blocks of
+    long_blocks are appended to the output as they are read, the dimensions in the file name are the numbers of distinct
+    columns and rows of the files
+    :param output_format: csv or parquet
+    :return: path of the output
+    '''
+    ids = [read_gctx_ids(fp) for fp in gctx_paths]
+    nr = len(set().union(*[set(r) for (r, _) in ids]))
+    nc = len(set().union(*[set(c) for (_, c) in ids]))
+    out_path = os.path.join(out, '{}_{}_n{}x{}.{}'.format(build_name, key, nc, nr, output_format))
+    print("Writing file to: \n\t{}".format(out_path))
+
+    if output_format == 'parquet':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        writer = None
+        try:
+            for fp in gctx_paths:
+                for block in long_blocks(fp):
+                    table = pa.Table.from_pandas(block, preserve_index=False)
+                    if writer is None:
+                        writer = pq.ParquetWriter(out_path, table.schema)
+                    writer.write_table(table.cast(writer.schema))
+        finally:
+            if writer is not None:
+                writer.close()
+        return out_path
+
+    header = True
+    with open(out_path, 'w') as f:
+        for fp in gctx_paths:
+            for block in long_blocks(fp):
+                block.to_csv(f, index=False, header=header)
+                header = False
+    return out_path
 
 
 """
@@ -54,11 +129,160 @@ Make sig_ids based on id_cols.
 
 
 def make_sig_id(level5_table, id_cols):
-    col_hds = id_cols.split(',')
-    level5_table['sig_id'] = level5_table.apply(lambda row: '_'.join([str(row[col]) for col in col_hds]), axis=1)
+    level5_table['sig_id'] = id_codec.make_ids(level5_table, id_cols, sep='_')
     return level5_table
 
 
+def make_feature_id(table):
+    table['feature_id'] = id_codec.make_ids(table, ['culture', 'ccle_name'], sep=':')
+    return table
+
+
+def read_csv_header(fp):
+    return list(pd.read_csv(fp, nrows=0).columns)
+
+
+def stack_csv_data(fps, out, build_name, key, sig_id_cols=None):
+    '''
+    concatenate the csvs of a csv_data key, a chunk of rows at a time.  Values are read and written as the text of the
+    files, so that every chunk is written the same way whatever its content.  feature_id (and sig_id for LEVEL5_LFC,
+    when the files have none) are added to each chunk, the distinct profiles and features are counted as the chunks
+    go by and the output is renamed with its dimensions once complete
+    :return: path of the output
+    '''
+    headers = [read_csv_header(fp) for fp in fps]
+    # columns in order of appearance, as pd.concat of the files
+    columns = []
+    for header in headers:
+        columns += [c for c in header if c not in columns]
+    make_sig_ids = key == 'LEVEL5_LFC' and 'sig_id' not in columns
+    if make_sig_ids:
+        logger.info('Sig ids not found in file, creating from sig_id_cols param')
+    out_columns = columns + [c for c in ['feature_id'] + (['sig_id'] if make_sig_ids else []) if c not in columns]
+    prof_key = 'sig_id' if key == 'LEVEL5_LFC' else 'profile_id'
+
+    profiles = set()
+    features = set()
+    tmp_path = os.path.join(out, '{}_{}.csv.tmp'.format(build_name, key))
+    with open(tmp_path, 'w') as f:
+        pd.DataFrame(columns=out_columns).to_csv(f, index=False)
+        for fp in fps:
+            for chunk in pd.read_csv(fp, dtype=str, chunksize=_csv_chunk_rows):
+                chunk = make_feature_id(chunk)
+                if make_sig_ids:
+                    chunk = make_sig_id(chunk, id_cols=sig_id_cols)
+                profiles.update(chunk[prof_key].astype(object).where(chunk[prof_key].notna(), None))
+                features.update(chunk['feature_id'])
+                chunk.reindex(columns=out_columns).to_csv(f, index=False, header=False)
+
+    out_path = os.path.join(out, '{}_{}_n{}x{}.csv'.format(build_name, key, len(profiles), len(features)))
+    print("Writing file to: \n\t{}".format(out_path))
+    os.rename(tmp_path, out_path)
+    return out_path
+
+
+def stack_keys(fps):
+    '''
+    distinct rows of the compound keys of the builds, sorted by all their columns
+    '''
+    df = pd.concat([pd.read_csv(fp, dtype={'pert_dose': 'str', 'pert_idose': 'str'}) for fp in fps], sort=False)
+    df = df.drop_duplicates()
+    return df.sort_values(list(df.columns)).reset_index(drop=True)
+
+
+def stack_key(task):
+    '''
+    stack the files of one key of the builds
+    :param task: (key, type of the key, files of the key, one per build, out, build_name, output_format, sig_id_cols)
+    :return: key
+    '''
+    (key, key_type, fps, out, build_name, output_format, sig_id_cols) = task
+    if key_type == 'gctx':
+        print('Melting and Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
+        stack_gctx_long(fps, out, build_name, key, output_format=output_format)
+    elif key_type == 'csv_data':
+        print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
+        stack_csv_data(fps, out, build_name, key, sig_id_cols=sig_id_cols)
+
+    elif key_type == 'metadata':
+        print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
+        combined_data = pd.concat(
+            [
+                pd.read_csv(fp,
+                            sep='\t',
+                            dtype={'pert_dose': 'str', 'pert_idose': 'str'}
+                            ) for fp in fps
+            ]).reset_index(drop=True)
+
+        out_path = os.path.join(out, '{}_{}.txt'.format(build_name, key))
+        print("Writing file to: \n\t{}".format(out_path))
+        combined_data.to_csv(out_path, sep='\t', index=False)
+
+    elif key_type == 'report':
+        print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
+        combined_data = pd.concat([pd.read_csv(
+            fp,
+            dtype={'pert_dose': 'str', 'pert_idose': 'str'}
+        ) for fp in fps]).reset_index(drop=True)
+
+        out_path = os.path.join(out, '{}_{}.csv'.format(build_name, key))
+        print("Writing file to: \n\t{}".format(out_path))
+        combined_data.to_csv(out_path, index=False)
+
+    elif key_type == 'key':
+        print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
+        df = stack_keys(fps)
+
+        out_path = os.path.join(out, '{}_{}.csv'.format(build_name, key))
+        print("Writing file to: \n\t{}".format(out_path))
+        df.to_csv(out_path, index=False)
+
+    return key
+
+
+def estimate_memory(key_type, fps):
+    '''
+    bytes of memory needed to stack fps, from their size on disk.  The gctx and csv_data keys are streamed, only a
+    block of them is held at a time, the other keys are read whole
+    '''
+    total = sum([os.path.getsize(fp) for fp in fps])
+    if key_type in _streamed_key_bytes:
+        total = min(total, _streamed_key_bytes[key_type])
+    return _memory_overhead_bytes + _memory_per_file_byte.get(key_type, 10) * total
+
+
+def schedule_keys(tasks, estimates, memory_budget, n_workers):
+    '''
+    run stack_key on tasks across a process pool.  The tasks are started largest first whenever a worker is free and
+    their estimate fits in what is left of memory_budget; a task larger than the budget runs alone
+    :param tasks: list of stack_key tasks
+    :param estimates: bytes of memory of each task, see estimate_memory
+    :param memory_budget: bytes, None for no limit
+    :param n_workers: number of processes
+    '''
+    pending = sorted(range(len(tasks)), key=lambda i: -estimates[i])
+    running = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=n_workers) as executor:
+        while pending or running:
+            in_use = sum([estimates[i] for i in running.values()])
+            for i in list(pending):
+                if len(running) >= n_workers:
+                    break
+                if memory_budget is not None and running and in_use + estimates[i] > memory_budget:
+                    continue
+                logger.info("starting {} - estimated memory:  {:.0f} MB  in use:  {:.0f} MB".format(
+                    tasks[i][0], estimates[i] / 2.0 ** 20, in_use / 2.0 ** 20))
+                running[executor.submit(stack_key, tasks[i])] = i
+                pending.remove(i)
+                in_use += estimates[i]
+
+            (done, _) = concurrent.futures.wait(list(running), return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                i = running.pop(future)
+                future.result()
+                logger.info("done {}".format(tasks[i][0]))
+
+
 def main(args):
     build_contents_dict = {
         'inst_info': {
@@ -127,6 +351,7 @@ def main(args):
 
     build_name = args.build_name
 
+    tasks = []
     for key in build_contents_dict:
         print(key)
         result = map(lambda x: os.path.join(x, build_contents_dict[key]['search_pattern']), build_paths)
@@ -135,74 +360,18 @@ def main(args):
         # print(fps)
         assert len(fps) >= nbuilds, 'Files not found in build_paths'
         assert len(fps) == nbuilds, 'Too many files found for key: {}'.format(key)
-
-        if build_contents_dict[key]['type'] == 'gctx':
-            print('Melting and Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
-            combined_data = melt_and_concat_gcts(fps)
-            nc, nr = nc, nr = sum_dims_from_paths(fps)
-            out_path = os.path.join(out, '{}_{}_n{}x{}.csv'.format(build_name, key, nc, nr))
-            print("Writing file to: \n\t{}".format(out_path))
-            combined_data.to_csv(out_path, index=False)
-        elif build_contents_dict[key]['type'] == 'csv_data':
-            print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
-            combined_data = pd.concat(
-                [pd.read_csv(fp,
-                             dtype={'pert_dose': 'str', 'pert_idose': 'str'}
-                             ) for fp in fps
-                ]).reset_index(drop=True)
-            combined_data['feature_id'] = combined_data.apply(
-                lambda row: '{}:{}'.format(row['culture'], row['ccle_name']), axis=1)
-            if key == 'LEVEL5_LFC':
-                if not 'sig_id' in combined_data.columns:
-                    logger.info('Sig ids not found in file, creating from sig_id_cols param')
-                    combined_data = make_sig_id(combined_data, id_cols=args.sig_id_cols)
-                prof_key = 'sig_id'
-            else:
-                prof_key = 'profile_id'
-            nc = len(combined_data[prof_key].unique())
-            nr = len(combined_data['feature_id'].unique())
-
-            out_path = os.path.join(out, '{}_{}_n{}x{}.csv'.format(build_name, key, nc, nr))
-            print("Writing file to: \n\t{}".format(out_path))
-            combined_data.to_csv(out_path, index=False)
-
-        elif build_contents_dict[key]['type'] == 'metadata':
-            print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
-            combined_data = pd.concat(
-                [
-                    pd.read_csv(fp,
-                                sep='\t',
-                                dtype={'pert_dose': 'str', 'pert_idose': 'str'}
-                                ) for fp in fps
-                ]).reset_index(drop=True)
-
-            out_path = os.path.join(out, '{}_{}.txt'.format(build_name, key))
-            print("Writing file to: \n\t{}".format(out_path))
-            combined_data.to_csv(out_path, sep='\t', index=False)
-
-        elif build_contents_dict[key]['type'] == 'report':
-            print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
-            combined_data = pd.concat([pd.read_csv(
-                fp,
-                dtype={'pert_dose': 'str', 'pert_idose': 'str'}
-            ) for fp in fps]).reset_index(drop=True)
-
-            out_path = os.path.join(out, '{}_{}.csv'.format(build_name, key))
-            print("Writing file to: \n\t{}".format(out_path))
-            combined_data.to_csv(out_path, index=False)
-
-        elif build_contents_dict[key]['type'] == 'key':
-            print('Merging the following files:\n\t{}'.format('\n\t'.join(fps)))
-            key_list = [pd.read_csv(fp,
-                                    dtype={'pert_dose': 'str', 'pert_idose': 'str'}
-                                    ) for fp in fps]
-            df = key_list.pop()
-            for other_df in key_list:
-                df = df.merge(other_df, how='outer', on=list(other_df.columns))  # this avoids duplicate rows
-
-            out_path = os.path.join(out, '{}_{}.csv'.format(build_name, key))
-            print("Writing file to: \n\t{}".format(out_path))
-            df.to_csv(out_path, index=False)
+        tasks.append((key, build_contents_dict[key]['type'], fps, out, build_name, args.output_format,
+                      args.sig_id_cols))
+
+    # without -w or -m the keys are stacked one after the other, as they were before the process pool
+    if args.n_workers == 1 or (args.n_workers is None and args.memory_budget is None):
+        for task in tasks:
+            stack_key(task)
+        return
+
+    estimates = [estimate_memory(task[1], task[2]) for task in tasks]
+    memory_budget = args.memory_budget * 2 ** 20 if args.memory_budget else None
+    schedule_keys(tasks, estimates, memory_budget, args.n_workers if args.n_workers else os.cpu_count())
 
 
 if __name__ == "__main__":
@@ -7,6 +7,9 @@ print_help () {
   printf -- "\t-k, --only_stack_keys \t Comma separated list of keys. Useful if parallelizing, only listed keys will be concatenated \n"
   printf -- "\t-s, --sig_id_cols \t Comma separated list of col names to create sig_ids if not present \n"
   printf -- "\t-o, --out \t Output folder for build files (required) \n"
+  printf -- "\t-f, --output_format \t csv (default) or parquet, format of the long tables of the gctx keys \n"
+  printf -- "\t-w, --n_workers \t Number of processes stacking keys in parallel, default stacks the keys one after the other \n"
+  printf -- "\t-m, --memory_budget \t MB of memory the keys stacked at the same time may use, default is no limit \n"
   printf -- "\t-v, --verbose \t\t Verbose flag, print additional output \n"
   printf -- "\t-h, --help \t\t Print this help text\n"
 }
@@ -39,6 +42,18 @@ while test $# -gt 0; do
       shift
       BUILD_DIR=$1
       ;;
+    -f| --output_format)
+      shift
+      OUTPUT_FORMAT=$1
+      ;;
+    -w| --n_workers)
+      shift
+      N_WORKERS=$1
+      ;;
+    -m| --memory_budget)
+      shift
+      MEMORY_BUDGET=$1
+      ;;
     -n| --build_name)
       shift
       BUILD_NAME=$1
@@ -73,6 +88,21 @@ args=(
   -o "$BUILD_DIR"
 )
 
+if [[ ! -z $OUTPUT_FORMAT ]]
+then
+  args+=(-f "$OUTPUT_FORMAT")
+fi
+
+if [[ ! -z $N_WORKERS ]]
+then
+  args+=(-w "$N_WORKERS")
+fi
+
+if [[ ! -z $MEMORY_BUDGET ]]
+then
+  args+=(-m "$MEMORY_BUDGET")
+fi
+
 if [[ ! -z $VERBOSE ]]
 then
   args+=(-v)
@@ -0,0 +1,63 @@
+import io
+import logging
+import unittest
+import numpy as np
+import pandas as pd
+import id_codec
+
+logger = logging.getLogger('stack')
+
+
+def reference_ids(table, columns, sep='_'):
+    return table.apply(lambda row: sep.join([str(row[col]) for col in columns]), axis=1).values
+
+
+class TestIdCodec(unittest.TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        n = 500
+        self.columns = ['pert_plate', 'culture', 'pert_id', 'pert_idose', 'pert_time', 'pert_dose']
+        self.table = pd.DataFrame({
+            'pert_plate': rng.choice(['PMTS001', 'PMTS002', None], n),
+            'culture': rng.choice(['PR300', 'PR500'], n),
+            'pert_id': rng.choice(['BRD-K{:08d}'.format(i) for i in range(20)], n),
+            'pert_idose': rng.choice(['1 uM', '0.1 uM', np.nan], n),
+            'pert_time': rng.choice([24, 120], n),
+            'pert_dose': rng.choice([1.5, np.nan, 2.0], n),
+        })
+
+    def test_make_ids(self):
+        ids = id_codec.make_ids(self.table, self.columns)
+        logger.debug("ids[:3]:  {}".format(ids[:3]))
+        self.assertEqual(list(reference_ids(self.table, self.columns)), list(ids))
+
+        ids = id_codec.make_ids(self.table, 'culture,pert_id', sep=':')
+        self.assertEqual(list(reference_ids(self.table, ['culture', 'pert_id'], sep=':')), list(ids))
+
+        self.assertEqual(0, len(id_codec.make_ids(self.table.iloc[:0], self.columns)))
+
+    def test_make_ids_csv(self):
+        # the tables of stack and deal are read back from csvs, as text or with the dose columns as strings
+        table = pd.read_csv(io.StringIO(self.table.to_csv(index=False)), dtype={'pert_idose': str})
+        self.assertEqual(list(reference_ids(table, self.columns)), list(id_codec.make_ids(table, self.columns)))
+
+        table = pd.read_csv(io.StringIO(self.table.to_csv(index=False)), dtype=str)
+        self.assertEqual(list(reference_ids(table, self.columns)), list(id_codec.make_ids(table, self.columns)))
+
+    def test_surrogate_keys(self):
+        (keys, combinations) = id_codec._surrogate_keys(self.table, self.columns)
+        distinct = self.table[self.columns].astype(str).drop_duplicates()
+        self.assertEqual(len(distinct), len(combinations))
+        self.assertEqual(list(range(len(combinations))), list(pd.unique(keys)))
+
+        # rows with the same key have the same values, missing values included
+        rows = self.table[self.columns].astype(str)
+        for key in range(len(combinations)):
+            self.assertEqual(1, len(rows.loc[keys == key].drop_duplicates()))
+        self.assertEqual(list(rows.iloc[0]), list(combinations[self.columns].astype(str).iloc[keys[0]]))
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    unittest.main()
@@ -0,0 +1,246 @@
+import os
+import shutil
+import logging
+import tempfile
+import concurrent.futures
+import unittest
+import unittest.mock as mock
+import h5py
+import numpy as np
+import pandas as pd
+import stack
+
+logger = logging.getLogger('stack')
+
+
+def write_gctx(path, data_df):
+    '''
+    the nodes of a gctx read by stack, the matrix stored one column of data_df per row as cmapPy writes it
+    '''
+    with h5py.File(path, 'w') as f:
+        f.create_dataset(stack.gctx_matrix_node, data=data_df.values.transpose())
+        f.create_dataset(stack.gctx_row_id_node, data=np.array([x.encode('utf-8') for x in data_df.index]))
+        f.create_dataset(stack.gctx_col_id_node, data=np.array([x.encode('utf-8') for x in data_df.columns]))
+
+
+def reference_long(data_dfs):
+    # how stack melted the gctx keys before long_blocks, data_df.reset_index().melt(id_vars='rid')
+    return pd.concat([df.rename_axis('rid').reset_index().melt(id_vars='rid', var_name='cid') for df in data_dfs])
+
+
+def reference_csv_data(fps, key, sig_id_cols):
+    # how stack concatenated the csv_data keys before stack_csv_data, with the values kept as text
+    combined_data = pd.concat([pd.read_csv(fp, dtype=str) for fp in fps], sort=False).reset_index(drop=True)
+    combined_data['feature_id'] = combined_data.apply(
+        lambda row: '{}:{}'.format(row['culture'], row['ccle_name']), axis=1)
+    if key == 'LEVEL5_LFC' and 'sig_id' not in combined_data.columns:
+        combined_data['sig_id'] = combined_data.apply(
+            lambda row: '_'.join([str(row[col]) for col in sig_id_cols.split(',')]), axis=1)
+    return combined_data
+
+
+def write_csv_build(build_path, culture, k, rng):
+    n = 60
+    df = pd.DataFrame({'profile_id': ['P{}:{}'.format(i % 17, culture) for i in range(n)],
+                       'ccle_name': ['CL{}'.format(i % 23) for i in range(n)],
+                       'culture': culture,
+                       'LFC': np.round(rng.normal(size=n), 6),
+                       'pert_dose': ['{:g}'.format(10 ** -(i % 5)) for i in range(n)],
+                       'pert_idose': ['{:g} uM'.format(10 ** -(i % 5)) for i in range(n)],
+                       'pert_plate': 'PMTS00{}'.format(k),
+                       'pert_id': ['BRD-{}'.format(i % 4) for i in range(n)],
+                       'pert_time': 120})
+    if k == 1:
+        # columns missing from the first build come last, a missing ccle_name makes a feature_id of its own
+        df['extra'] = 'x'
+        df.loc[3, 'ccle_name'] = np.nan
+    os.makedirs(build_path)
+    for key in ['LEVEL3_LMFI', 'LEVEL4_LFC', 'LEVEL5_LFC']:
+        df.to_csv(os.path.join(build_path, 'B_{}.csv'.format(key)), index=False)
+    df[['pert_id', 'pert_plate', 'pert_dose']].drop_duplicates().to_csv(
+        os.path.join(build_path, 'B_compound_key.csv'), index=False)
+
+
+class TestStack(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        rng = np.random.RandomState(5)
+        self.data_dfs = []
+        self.gctx_paths = []
+        for (k, (n_rows, n_cols)) in enumerate([(7, 13), (5, 9)]):
+            data = rng.random_sample((n_rows, n_cols)).astype(np.float32)
+            data[0, 1] = np.nan
+            data[2, 3] = -666
+            data_df = pd.DataFrame(data, index=['r{}_{}'.format(k, i) for i in range(n_rows)],
+                                   columns=['c{}_{}'.format(k, j) for j in range(n_cols)])
+            path = os.path.join(self.tmp, 'B{}_LEVEL2_MFI_n{}x{}.gctx'.format(k, n_cols, n_rows))
+            write_gctx(path, data_df)
+            self.data_dfs.append(data_df)
+            self.gctx_paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_long_blocks(self):
+        expected = reference_long(self.data_dfs[:1])
+        # a block holds whole columns of 7 rows, at least one
+        for (block_values, n_blocks) in [(1, 13), (10, 13), (14, 7), (7 * 13, 1), (1000, 1)]:
+            blocks = list(stack.long_blocks(self.gctx_paths[0], block_values=block_values))
+            logger.debug("block_values:  {}  blocks:  {}".format(block_values, len(blocks)))
+            self.assertEqual(n_blocks, len(blocks))
+            long_df = pd.concat(blocks)
+            self.assertEqual(['rid', 'cid', 'value'], list(long_df.columns))
+            self.assertEqual(list(expected.rid), list(long_df.rid))
+            self.assertEqual(list(expected.cid), list(long_df.cid))
+            np.testing.assert_array_equal(expected.value.values, long_df.value.values)
+
+    def test_stack_gctx_long(self):
+        expected_path = os.path.join(self.tmp, 'expected.csv')
+        reference_long(self.data_dfs).to_csv(expected_path, index=False)
+
+        out_path = stack.stack_gctx_long(self.gctx_paths, self.tmp, 'T', 'LEVEL2_MFI')
+        self.assertEqual(os.path.join(self.tmp, 'T_LEVEL2_MFI_n22x12.csv'), out_path)
+        with open(expected_path) as f, open(out_path) as g:
+            self.assertEqual(f.read(), g.read())
+
+    def test_stack_gctx_long_parquet(self):
+        try:
+            import pyarrow
+        except ImportError:
+            self.skipTest("pyarrow is not installed")
+
+        out_path = stack.stack_gctx_long(self.gctx_paths, self.tmp, 'T', 'LEVEL2_MFI', output_format='parquet')
+        self.assertTrue(out_path.endswith('T_LEVEL2_MFI_n22x12.parquet'))
+        expected = reference_long(self.data_dfs)
+        long_df = pd.read_parquet(out_path)
+        self.assertEqual(list(expected.rid), list(long_df.rid))
+        self.assertEqual(list(expected.cid), list(long_df.cid))
+        np.testing.assert_allclose(expected.value.values.astype(np.float64), long_df.value.values, equal_nan=True)
+
+    def test_stack_csv_data(self):
+        rng = np.random.RandomState(6)
+        build_paths = [os.path.join(self.tmp, culture) for culture in ['PR300', 'PR500']]
+        for (k, build_path) in enumerate(build_paths):
+            write_csv_build(build_path, os.path.basename(build_path), k, rng)
+
+        sig_id_cols = 'pert_plate,culture,pert_id,pert_idose,pert_time'
+        csv_chunk_rows = stack._csv_chunk_rows
+        stack._csv_chunk_rows = 7
+        try:
+            for key in ['LEVEL4_LFC', 'LEVEL5_LFC']:
+                fps = [os.path.join(x, 'B_{}.csv'.format(key)) for x in build_paths]
+                out_path = stack.stack_csv_data(fps, self.tmp, 'T', key, sig_id_cols=sig_id_cols)
+                logger.debug("out_path:  {}".format(out_path))
+
+                expected = reference_csv_data(fps, key, sig_id_cols)
+                prof_key = 'sig_id' if key == 'LEVEL5_LFC' else 'profile_id'
+                self.assertEqual(os.path.join(self.tmp, 'T_{}_n{}x{}.csv'.format(
+                    key, len(expected[prof_key].unique()), len(expected['feature_id'].unique()))), out_path)
+                pd.testing.assert_frame_equal(expected, pd.read_csv(out_path, dtype=str))
+                self.assertFalse(os.path.exists(os.path.join(self.tmp, 'T_{}.csv.tmp'.format(key))))
+        finally:
+            stack._csv_chunk_rows = csv_chunk_rows
+
+    def test_stack_keys(self):
+        rng = np.random.RandomState(6)
+        build_paths = [os.path.join(self.tmp, culture) for culture in ['PR300', 'PR500']]
+        for (k, build_path) in enumerate(build_paths):
+            write_csv_build(build_path, os.path.basename(build_path), k, rng)
+        fps = [os.path.join(x, 'B_compound_key.csv') for x in build_paths]
+        # the first build shares rows with the second and repeats some of its own
+        first = pd.read_csv(fps[0], dtype=str)
+        pd.concat([first, first.iloc[:2], pd.read_csv(fps[1], dtype=str).iloc[:3]]).to_csv(fps[0], index=False)
+
+        df = stack.stack_keys(fps)
+        expected = pd.concat([pd.read_csv(fp, dtype=str) for fp in fps]).drop_duplicates()
+        self.assertEqual(len(expected), len(df))
+        self.assertFalse(df.duplicated().any())
+        self.assertEqual(list(range(len(df))), list(df.index))
+        sorted_df = df.sort_values(list(df.columns)).reset_index(drop=True)
+        pd.testing.assert_frame_equal(sorted_df, df)
+
+    def test_estimate_memory(self):
+        fps = self.gctx_paths
+        size = sum([os.path.getsize(fp) for fp in fps])
+        self.assertEqual(stack._memory_overhead_bytes + 10 * size, stack.estimate_memory('metadata', fps))
+        self.assertEqual(stack._memory_overhead_bytes + 4 * size, stack.estimate_memory('gctx', fps))
+
+        # streamed keys only hold a block of their files
+        streamed_key_bytes = stack._streamed_key_bytes
+        stack._streamed_key_bytes = {'gctx': 100, 'csv_data': 100}
+        try:
+            self.assertEqual(stack._memory_overhead_bytes + 400, stack.estimate_memory('gctx', fps))
+            self.assertEqual(stack._memory_overhead_bytes + 10 * size, stack.estimate_memory('key', fps))
+        finally:
+            stack._streamed_key_bytes = streamed_key_bytes
+
+    def test_main_workers(self):
+        rng = np.random.RandomState(6)
+        build_paths = [os.path.join(self.tmp, culture) for culture in ['PR300', 'PR500']]
+        for (k, build_path) in enumerate(build_paths):
+            write_csv_build(build_path, os.path.basename(build_path), k, rng)
+            shutil.move(self.gctx_paths[k], build_path)
+        keys = 'LEVEL2_MFI,LEVEL3_LMFI,LEVEL4_LFC,LEVEL5_LFC,compound_key'
+
+        def run(out, extra):
+            args = stack.build_parser().parse_args(['-b', ','.join(build_paths), '-n', 'T', '-o', out, '-k', keys] + extra)
+            stack.main(args)
+            return {x: open(os.path.join(out, x)).read() for x in os.listdir(out)}
+
+        # without -w or -m the keys are stacked one after the other in this process
+        with mock.patch.object(stack, 'schedule_keys') as schedule_keys:
+            expected = run(os.path.join(self.tmp, 'sequential'), [])
+            self.assertFalse(schedule_keys.called)
+        self.assertEqual(5, len(expected))
+
+        for extra in [['-w', '1'], ['-w', '2'], ['-w', '3', '-m', '1']]:
+            logger.debug("extra:  {}".format(extra))
+            out = os.path.join(self.tmp, '_'.join(extra))
+            self.assertEqual(expected, run(out, extra))
+
+    def test_schedule_keys(self):
+        # with a budget smaller than any key, each key runs alone, largest first
+        events = []
+
+        class Executor(object):
+            def __init__(self, max_workers):
+                pass
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *args):
+                return False
+
+            def submit(self, fn, task):
+                events.append(('start', task[0]))
+                future = concurrent.futures.Future()
+                future.task = task
+                return future
+
+        def wait(futures, return_when):
+            # the first task started is the first to complete
+            future = futures[0]
+            future.set_result(future.task[0])
+            events.append(('done', future.task[0]))
+            return ({future}, set())
+
+        tasks = [('small',), ('large',), ('medium',)]
+        with mock.patch.object(concurrent.futures, 'ProcessPoolExecutor', Executor), \
+                mock.patch.object(concurrent.futures, 'wait', wait):
+            stack.schedule_keys(tasks, [1, 3, 2], 1, 2)
+        self.assertEqual([('start', 'large'), ('done', 'large'), ('start', 'medium'), ('done', 'medium'),
+                          ('start', 'small'), ('done', 'small')], events)
+
+        events[:] = []
+        with mock.patch.object(concurrent.futures, 'ProcessPoolExecutor', Executor), \
+                mock.patch.object(concurrent.futures, 'wait', wait):
+            stack.schedule_keys(tasks, [1, 3, 2], None, 2)
+        # without a budget two keys run at a time
+        self.assertEqual([('start', 'large'), ('start', 'medium'), ('done', 'large'), ('start', 'small')], events[:4])
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.DEBUG)
+
+    unittest.main()